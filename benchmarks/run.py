@@ -0,0 +1,272 @@
+"""Benchmarks of PyMemoize, which write their results as JSON.
+
+Run from the root of the repository::
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json
+
+Each result is the best time per operation (of ``--repeat`` runs of
+``--number`` operations). Expiry is driven by time travel (see
+``memoize.time``), so scenarios which wait for values to expire do not.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shelve
+import shutil
+import tempfile
+import threading
+import timeit
+from time import sleep as _sleep, time as _wall_time
+
+from memoize import Memoizer
+from memoize.time import sleep, start_time_travel
+
+
+BACKENDS = ('dict', 'shelve', 'fakeredis', 'django')
+
+
+class Results(object):
+
+    def __init__(self, number, repeat):
+        self.number = number
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name, func, number=None, **params):
+        """Record the best seconds per call of func."""
+        number = number or self.number
+        seconds = min(timeit.repeat(func, number=number, repeat=self.repeat)) / number
+        self.add(name, seconds, **params)
+        return seconds
+
+    def add(self, name, seconds, **params):
+        self.results.append(dict(name=name, params=params, seconds=seconds))
+        print('%-20s %-50s %10.2fus' % (name, _format_params(params), seconds * 1e6))
+
+    def count(self, name, value, **params):
+        """Record a measurement other than a time."""
+        self.results.append(dict(name=name, params=params, value=value))
+        print('%-20s %-50s %10.2f' % (name, _format_params(params), value))
+
+    def as_dict(self):
+        return dict(
+            meta=dict(
+                python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                platform=platform.platform(),
+                time=_wall_time(),
+                number=self.number,
+                repeat=self.repeat,
+            ),
+            results=self.results,
+        )
+
+
+def _format_params(params):
+    return ' '.join('%s=%s' % item for item in sorted(params.items()))
+
+
+def _result_id(result):
+    return result['name'], _format_params(result['params'])
+
+
+def _result_value(result):
+    return result['seconds'] if 'seconds' in result else result['value']
+
+
+# Stores; each returns the store and a function to clean up after it.
+
+def _dict_store():
+    return {}, lambda: None
+
+
+def _shelve_store():
+    path = tempfile.mkdtemp()
+    shelf = shelve.open(os.path.join(path, 'shelf'))
+    def close():
+        shelf.close()
+        shutil.rmtree(path)
+    return shelf, close
+
+
+def _fakeredis_store():
+    import fakeredis
+    import memoize.redis
+    return memoize.redis.Store(fakeredis.FakeRedis()), lambda: None
+
+
+def _django_store():
+    from django.conf import settings
+    if not settings.configured:
+        import django
+        settings.configure(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        })
+        django.setup()
+    import memoize.djangocache
+    return memoize.djangocache.Cache('default'), lambda: None
+
+
+_stores = dict(
+    dict=_dict_store,
+    shelve=_shelve_store,
+    fakeredis=_fakeredis_store,
+    django=_django_store,
+)
+
+
+# Benchmarks.
+
+def bench_get(results, backends):
+    """Hit, miss, and expired latency of Memoizer.get against each store."""
+
+    for backend in backends:
+
+        try:
+            store, close = _stores[backend]()
+        except ImportError as e:
+            print('skipping %s: %s' % (backend, e))
+            continue
+
+        try:
+            memo = Memoizer(store)
+            memo.get('hit', str, (1, ))
+            results.time('get.hit', lambda: memo.get('hit', str, (1, )), store=backend)
+
+            counter = itertools.count()
+            results.time('get.miss', lambda: memo.get('miss%d' % next(counter), str, (1, )),
+                store=backend)
+
+            # Every call finds an expired value; time travel expires it.
+            def expired():
+                sleep(2)
+                memo.get('expired', str, (1, ), max_age=1)
+            results.time('get.expired', expired, store=backend)
+
+        finally:
+            close()
+
+
+def bench_keys(results):
+    """Key building of decorated functions by arity and argument size."""
+
+    memo = Memoizer({})
+    sizes = dict(
+        small=1,
+        text='x' * 1024,
+        list=list(range(1000)),
+    )
+
+    for strategy in ('repr', 'hash'):
+        for arity in (0, 1, 4, 16):
+            names = ['a%d' % i for i in range(arity)]
+            namespace = {}
+            exec('def func(%s): pass' % ', '.join(names), namespace)
+            func = memo(key_strategy=strategy)(namespace['func'])
+            for size, value in sorted(sizes.items()):
+                if not arity and size != 'small':
+                    continue
+                args = (value, ) * arity
+                # Large arguments take milliseconds; don't wait all day.
+                number = max(1, results.number // 50) if size == 'list' else None
+                results.time('key', lambda: func.key(args), number, strategy=strategy,
+                    arity=arity, size=size)
+
+
+def bench_contention(results, threads=(2, 8, 32), rounds=20, work=0.001):
+    """Threads which all miss on one key at once; alone, and with single_flight.
+
+    Reports seconds per round (from an expired value to all threads having
+    one), and the number of times the value was calculated per round.
+
+    """
+
+    for opts in (dict(), dict(single_flight=True)):
+        for count in threads:
+
+            memo = Memoizer({})
+            calls = []
+            def compute():
+                calls.append(1)
+                _sleep(work)
+                return len(calls)
+
+            barrier = threading.Barrier(count + 1)
+            def worker():
+                for _ in range(rounds):
+                    barrier.wait()
+                    memo.get('key', compute, max_age=1, **opts)
+                    barrier.wait()
+
+            workers = [threading.Thread(target=worker) for _ in range(count)]
+            for thread in workers:
+                thread.start()
+
+            total = 0
+            for _ in range(rounds):
+                sleep(2) # Expire the value.
+                barrier.wait()
+                start = timeit.default_timer()
+                barrier.wait()
+                total += timeit.default_timer() - start
+            for thread in workers:
+                thread.join()
+
+            params = dict(threads=count, single_flight=bool(opts))
+            results.add('contention.round', total / rounds, **params)
+            results.count('contention.calls', float(len(calls)) / rounds, **params)
+
+
+def compare(old, new):
+    """Print the ratio of new to old timings for results in both."""
+    old = dict((_result_id(result), _result_value(result)) for result in old['results'])
+    print()
+    for result in new['results']:
+        before = old.get(_result_id(result))
+        if before:
+            print('%-20s %-50s %10.2fx' % (result['name'], _format_params(result['params']),
+                _result_value(result) / before))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=2000,
+        help='operations per timing (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='timings to take the best of (default: %(default)s)')
+    parser.add_argument('-b', '--backends', default=','.join(BACKENDS),
+        help='stores to benchmark (default: %(default)s)')
+    parser.add_argument('--threads', default='2,8,32',
+        help='thread counts for contention (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='file to write JSON results to')
+    parser.add_argument('-c', '--compare', help='JSON results to compare against')
+    args = parser.parse_args(argv)
+
+    start_time_travel()
+
+    results = Results(args.number, args.repeat)
+    bench_get(results, [x for x in args.backends.split(',') if x])
+    bench_keys(results)
+    bench_contention(results, [int(x) for x in args.threads.split(',')])
+
+    data = results.as_dict()
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(data, fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(json.load(fh), data)
+
+    return data
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""asyncio support.
+
+`Memoizer.aget` and memoized coroutine functions are implemented here so that
+the rest of the package remains importable on Python 2.
+
+Async stores provide coroutine methods `aget(key)`, `aset(key, data)`, and
+`adelete(key)`, and optionally `aget_many(keys)`, `attl(key)`, and
+`alock(key)` which returns a lock with coroutine `acquire(timeout)` and
+`release()` methods. Other stores (such as a plain dict) are used as is.
+
+Concurrent awaiters of the same key within an event loop share a single task
+which calculates the value.
+
+"""
+
+import asyncio
+import functools
+import inspect
+from timeit import default_timer as _timer
+
+from .core import (
+    DEFAULT_TIMEOUT, VALUE_INDEX, _data_etag, _data_ttl, _with_expiry, log, unpack_value,
+)
+from .func import BoundMethod, MemoizedFunction
+from .time import time
+
+
+async def store_get(store, key):
+    aget = getattr(store, 'aget', None)
+    if aget is not None:
+        return await aget(key)
+    return store.get(key)
+
+
+async def store_get_many(memo, store, keys):
+    aget_many = getattr(store, 'aget_many', None)
+    if aget_many is not None:
+        return await aget_many(keys)
+    if getattr(store, 'aget', None) is not None:
+        return [await store.aget(key) for key in keys]
+    return memo._store_get_many(store, keys)
+
+
+async def store_meta(memo, store, key):
+    """See `Memoizer._store_meta`; async stores always fetch the value."""
+    aget = getattr(store, 'aget', None)
+    if aget is not None:
+        return await aget(key)
+    return memo._store_meta(store, key)
+
+
+async def store_set(store, key, data):
+    aset = getattr(store, 'aset', None)
+    if aset is not None:
+        await aset(key, data)
+    else:
+        store[key] = data
+
+
+async def store_delete(store, key):
+    adelete = getattr(store, 'adelete', None)
+    try:
+        if adelete is not None:
+            await adelete(key)
+        else:
+            del store[key]
+    except KeyError:
+        pass
+
+
+async def aget(memo, key, func=None, args=(), kwargs=None, default=None, **opts):
+    """Asynchronous :meth:`Memoizer.get`.
+
+    ``func`` may be a coroutine function, or a regular one. Locks are taken
+    via the ``alock`` option or the store's ``alock`` method; synchronous
+    locks are not used.
+
+    """
+
+    kwargs = kwargs or {}
+    opts = memo._resolve_opts(opts)
+    memo._resolve_dynamic_opts(opts, args, kwargs)
+    key = await namespace(memo, key, opts)
+    store = opts['store']
+
+    if not isinstance(key, str):
+        raise TypeError('non-string key of type %s' % type(key))
+
+    data = await store_get(store, key)
+    if memo._is_usable(key, store, data, func, args, kwargs, opts, functools.partial(_refresh, memo)):
+        return unpack_value(data)
+
+    if func is None:
+        return default
+
+    # Shielded so that one cancelled awaiter does not cancel the others.
+    task = _flight(memo, key, store, func, args, kwargs, opts, data)
+    return await asyncio.shield(task)
+
+
+async def expand_opts(memo, key, opts):
+    """Asynchronous :meth:`Memoizer._expand_opts`."""
+    opts = memo._resolve_opts(opts)
+    return await namespace(memo, key, opts), opts['store'], opts
+
+
+async def adelete(memo, key, **opts):
+    """Asynchronous :meth:`Memoizer.delete`."""
+    key, store, opts = await expand_opts(memo, key, opts)
+    await store_delete(store, key)
+
+
+async def adelete_many(memo, keys, **opts):
+    """Asynchronous :meth:`Memoizer.delete_many`."""
+    for key in keys:
+        await adelete(memo, key, **opts)
+
+
+async def aexpire_at(memo, key, expiry, **opts):
+    """Asynchronous :meth:`Memoizer.expire_at`."""
+    key, store, opts = await expand_opts(memo, key, opts)
+    data = await store_get(store, key)
+    if data is None:
+        raise KeyError(key)
+    await store_set(store, key, _with_expiry(data, expiry))
+
+
+async def attl(memo, key, **opts):
+    """Asynchronous :meth:`Memoizer.ttl`."""
+    key, store, opts = await expand_opts(memo, key, opts)
+    attl = getattr(store, 'attl', None)
+    if attl is not None:
+        return await attl(key)
+    if getattr(store, 'aget', None) is None and hasattr(store, 'ttl'):
+        return store.ttl(key)
+    return _data_ttl(await store_meta(memo, store, key))
+
+
+async def aetag(memo, key, **opts):
+    """Asynchronous :meth:`Memoizer.etag`."""
+    key, store, opts = await expand_opts(memo, key, opts)
+    return _data_etag(await store_meta(memo, store, key))
+
+
+async def aexists(memo, key, **opts):
+    """Asynchronous :meth:`Memoizer.exists`."""
+    key, store, opts = await expand_opts(memo, key, opts)
+    return memo._data_exists(await store_meta(memo, store, key), opts)
+
+
+async def namespace(memo, key, opts):
+    """Asynchronous :meth:`Memoizer._namespace`."""
+    namespace = opts.get('namespace')
+    if namespace:
+        key = '%s:%s' % (namespace, key)
+    if opts.get('tags') or (namespace and opts.get('versioned_namespace')):
+        store = opts['store']
+        names = memo._generation_keys(opts)
+        generations = []
+        for name, data in zip(names, await store_get_many(memo, store, names)):
+            if data is None:
+                data = memo._new_generation()
+                await store_set(store, name, data)
+            generations.append(data[VALUE_INDEX])
+        key = '%s#%s' % (key, '.'.join(generations))
+    return key
+
+
+def _token(store, key):
+    return (id(asyncio.get_event_loop()), id(store), key)
+
+
+def _flight(memo, key, store, func, args, kwargs, opts, seen):
+    """Get the task calculating this key, starting one if needed."""
+
+    flights = memo._async_flights
+    token = _token(store, key)
+
+    task = flights.get(token)
+    if task is None:
+        task = asyncio.ensure_future(_compute(memo, key, store, func, args, kwargs, opts, seen))
+        flights[token] = task
+        def done(task):
+            if flights.get(token) is task:
+                del flights[token]
+        task.add_done_callback(done)
+
+    return task
+
+
+def _refresh(memo, key, store, func, args, kwargs, opts, data):
+    """Recalculate a value in the background; at most once per key."""
+
+    if _token(store, key) in memo._async_flights:
+        return
+
+    if memo._hooks:
+        memo._emit('refresh', opts)
+
+    def done(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error('error while refreshing %r', key, exc_info=task.exception())
+
+    _flight(memo, key, store, func, args, kwargs, opts, data).add_done_callback(done)
+
+
+async def _compute(memo, key, store, func, args, kwargs, opts, seen):
+
+    lock_func = opts.get('alock') or getattr(store, 'alock', None)
+    lock = lock_func and lock_func(key)
+    locked = False
+    if lock:
+        start = _timer()
+        locked = await lock.acquire(opts.get('timeout', DEFAULT_TIMEOUT))
+        if memo._hooks:
+            memo._emit('lock_wait' if locked else 'lock_timeout', opts, _timer() - start)
+
+    try:
+
+        # See Memoizer._compute. We always lead a flight, so look again; the
+        # previous flight may have stored the value since we fetched `seen`.
+        data = await store_get(store, key)
+        if memo._is_new(data, seen, opts):
+            return unpack_value(data)
+
+        start = _timer()
+        try:
+            value = func(*args, **kwargs)
+            if inspect.isawaitable(value):
+                value = await value
+        except Exception as e:
+            if memo._hooks:
+                memo._emit('error', opts, _timer() - start)
+            data = memo._exception_entry(e, opts)
+            if data is not None:
+                await store_set(store, key, data)
+            raise
+        duration = _timer() - start
+        if memo._hooks:
+            memo._emit('compute', opts, duration)
+
+        data = memo._result_entry(value, duration, opts)
+        if data is not None:
+            await store_set(store, key, data)
+
+    finally:
+        if locked:
+            await lock.release()
+
+    return value
+
+
+class AsyncMemoizedFunction(MemoizedFunction):
+    """A memoized coroutine function; calling it returns an awaitable.
+
+    So do `get`, `delete`, and `map`. The other methods are synchronous, as on a
+    `MemoizedFunction`; use their async counterparts (`aexists`, `attl`, etc.)
+    with async stores.
+
+    """
+
+    def __call__(self, *args, **kwargs):
+        args, kwargs = self._expand_args(args, kwargs)
+        return aget(self.cache, self._key(args, kwargs), self.func, args, kwargs, **self.opts)
+
+    def get(self, args=(), kwargs=None, **opts):
+        args, kwargs = self._expand_args(args, kwargs)
+        opts = self._expand_opts(opts)
+        return aget(self.cache, self._key(args, kwargs), self.func, args, kwargs, **opts)
+
+    async def map(self, iterable, func_many=None, **opts):
+        """Call the coroutine function for each tuple of positional arguments.
+
+        Values are fetched and calculated concurrently; ``func_many`` is not
+        supported.
+
+        """
+        if func_many is not None:
+            raise TypeError('func_many is not supported for coroutine functions')
+        opts = self._expand_opts(opts)
+        keys, args_list, kwargs_list = self._expand_many(iterable)
+        return await asyncio.gather(*[
+            aget(self.cache, key, self.func, args, kwargs, **opts)
+            for key, args, kwargs in zip(keys, args_list, kwargs_list)])
+
+    def warm(self, iterable, workers=4, executor=None, progress=None, **opts):
+        # Its threads would only store coroutines.
+        raise TypeError('use map to warm coroutine functions')
+
+    def delete(self, args=(), kwargs=None, **opts):
+        args, kwargs = self._expand_args(args, kwargs)
+        opts = self._expand_opts(opts, args, kwargs)
+        return adelete(self.cache, self._key(args, kwargs), **opts)
+
+    def aexpire(self, max_age, args=(), kwargs=None, **opts):
+        return self.aexpire_at(time() + max_age, args, kwargs, **opts)
+
+    def aexpire_at(self, expiry, args=(), kwargs=None, **opts):
+        args, kwargs = self._expand_args(args, kwargs)
+        opts = self._expiry_opts(opts, args, kwargs)
+        return aexpire_at(self.cache, self._key(args, kwargs), expiry, **opts)
+
+    def attl(self, args=(), kwargs=None, **opts):
+        args, kwargs = self._expand_args(args, kwargs)
+        opts = self._expand_opts(opts, args, kwargs)
+        return attl(self.cache, self._key(args, kwargs), **opts)
+
+    def aexists(self, args=(), kwargs=None, **opts):
+        args, kwargs = self._expand_args(args, kwargs)
+        opts = self._expand_opts(opts, args, kwargs)
+        return aexists(self.cache, self._key(args, kwargs), **opts)
+
+    def alast_etag(self, args=(), kwargs=None, **opts):
+        args, kwargs = self._expand_args(args, kwargs)
+        opts = self._expand_opts(opts, args, kwargs)
+        return aetag(self.cache, self._key(args, kwargs), **opts)
+
+    def _purge(self):
+        if getattr(self._resolved_opts()['store'], 'adelete', None) is None:
+            return MemoizedFunction._purge(self)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Left for an access from within the event loop.
+            return
+        keys = self._take_purge_keys()
+        if not keys:
+            return
+
+        def done(task):
+            if not task.cancelled() and task.exception() is not None:
+                log.error('error while purging %d keys', len(keys), exc_info=task.exception())
+
+        asyncio.ensure_future(adelete_many(self.cache, keys, **self._opts)).add_done_callback(done)
+
+
+class AsyncBoundMethod(BoundMethod, AsyncMemoizedFunction):
+    """A ``per_instance`` memoized coroutine method bound to its instance."""
+
+
+AsyncMemoizedFunction._bound_class = AsyncBoundMethod
@@ -0,0 +1,129 @@
+"""asyncio Redis store and lock, via `redis.asyncio`.
+
+These mirror :class:`memoize.redis.Store` and :class:`memoize.redis.Lock`,
+but implement the async store protocol described in :mod:`memoize.aio`.
+
+"""
+
+import asyncio
+import math
+import uuid
+
+from .core import EXPIRY_INDEX
+from .redis import Lock as _Lock, PickleSerializer
+from .time import time
+
+
+class Lock(object):
+    """Distributed lock using Redis SET NX PX; see `memoize.redis.Lock`."""
+
+    release_script = _Lock.release_script
+
+    def __init__(self, db, key, expires=60, poll_interval=1.0):
+        self.db = db
+        self.key = key
+        self.expires = expires
+        self.poll_interval = poll_interval
+        self.token = None
+
+    async def _try_acquire(self):
+        token = uuid.uuid4().hex
+        if await self.db.set(self.key, token, nx=True, px=int(self.expires * 1000)):
+            self.token = token
+            return True
+        return False
+
+    async def acquire(self, timeout):
+
+        if await self._try_acquire():
+            return True
+        if timeout <= 0:
+            return False
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.key)
+        try:
+            while True:
+
+                if await self._try_acquire():
+                    return True
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+
+                wait = min(remaining, self.poll_interval)
+                pttl = await self.db.pttl(self.key)
+                if pttl is not None and pttl >= 0:
+                    wait = min(wait, pttl / 1000.0)
+                await pubsub.get_message(timeout=wait)
+
+        finally:
+            await pubsub.unsubscribe(self.key)
+            await pubsub.aclose()
+
+    async def release(self):
+        token, self.token = self.token, None
+        if token is not None:
+            script = self.db.register_script(self.release_script)
+            await script(keys=[self.key], args=[token])
+
+
+class Store(object):
+    """Async Redis store which sets native expiry times.
+
+    Takes the same arguments as :class:`memoize.redis.Store`, but ``redis``
+    must be a ``redis.asyncio.Redis`` client.
+
+    """
+
+    def __init__(self, redis=None, url='redis://localhost:6379/0', serializer=None,
+        grace=0, lock_class=Lock):
+
+        if redis is None:
+            import redis.asyncio as redis_module
+            pool = redis_module.ConnectionPool.from_url(url)
+            redis = redis_module.Redis(connection_pool=pool)
+
+        self.redis = redis
+        self.serializer = serializer or PickleSerializer()
+        self.grace = grace
+        self.lock_class = lock_class
+
+    def _px(self, data):
+        expiry = data[EXPIRY_INDEX]
+        if expiry:
+            return int(math.ceil((expiry + self.grace - time()) * 1000))
+
+    def _loads(self, raw):
+        return None if raw is None else self.serializer.loads(raw)
+
+    async def aget(self, key):
+        return self._loads(await self.redis.get(key))
+
+    async def aget_many(self, keys):
+        if not keys:
+            return []
+        return [self._loads(raw) for raw in await self.redis.mget(keys)]
+
+    async def aset(self, key, data):
+        px = self._px(data)
+        if px is not None and px <= 0:
+            await self.redis.delete(key)
+        else:
+            await self.redis.set(key, self.serializer.dumps(data), px=px)
+
+    async def adelete(self, key):
+        if not await self.redis.delete(key):
+            raise KeyError(key)
+
+    async def attl(self, key):
+        pttl = await self.redis.pttl(key)
+        if pttl is None or pttl < 0:
+            return None
+        return max(0, pttl / 1000.0 - self.grace) or None
+
+    def alock(self, key):
+        return self.lock_class(self.redis, key + '.lock')
@@ -0,0 +1,317 @@
+"""Compact binary encoding of data tuples.
+
+An encoded entry is a fixed-size header holding the protocol, creation and
+expiry times, followed by the duration, the etag, and then the value as
+encoded by a codec.
+Stores can read the header via :func:`read_header` without decoding (or even
+fetching) the rest.
+
+Layout (all big-endian)::
+
+    B   format version (currently 1)
+    B   flags (see FLAG_*)
+    B   codec id
+    B   protocol version
+    d   creation time
+    d   expiry time (NaN for None)
+    I   length of the etag (0 for None)
+    d   seconds taken to calculate the value; only if FLAG_DURATION
+    ... etag; UTF-8 if FLAG_TEXT_ETAG, otherwise pickled
+    ... payload; zlib compressed if FLAG_COMPRESSED
+
+The payload is the codec's bytes, unless it has out-of-band buffers
+(FLAG_BUFFERS), in which case it is::
+
+    I   number of buffers
+    Q   length of the codec's bytes
+    Q*  length of each buffer
+    ... codec's bytes
+    ... each buffer
+
+"""
+
+import collections
+import pickle
+import struct
+import zlib
+
+from .core import (
+    PROTOCOL_INDEX, CREATION_INDEX, EXPIRY_INDEX, ETAG_INDEX, VALUE_INDEX, get_duration,
+)
+
+
+FORMAT_VERSION = 1
+
+FLAG_COMPRESSED = 1
+FLAG_BUFFERS = 2
+FLAG_TEXT_ETAG = 4
+FLAG_DURATION = 8
+
+HEADER = struct.Struct('>BBBBddI')
+HEADER_SIZE = HEADER.size
+
+_duration = struct.Struct('>d')
+_count = struct.Struct('>IQ')
+_length = struct.Struct('>Q')
+_nan = float('nan')
+
+PICKLE_BUFFERS = pickle.HIGHEST_PROTOCOL >= 5
+
+# Protocol 4+ pickles start with PROTO and FRAME opcodes.
+_FRAME_PREFIX = struct.Struct('<2scQ')
+_FRAME = b'\x95'
+
+Header = collections.namedtuple('Header', 'codec protocol creation expiry etag_size')
+
+
+class RawCodec(object):
+    """Values are bytes-like, and stored as is.
+
+    :param bool copy: Decode to ``bytes``; otherwise to a (read-only, if the
+        source is) ``memoryview`` of the encoded data, without copying it.
+
+    """
+
+    id = 0
+
+    def __init__(self, copy=True):
+        self.copy = copy
+
+    def dumps(self, value):
+        return value if isinstance(value, bytes) else memoryview(value).tobytes(), ()
+
+    def loads(self, raw, buffers):
+        return bytes(raw) if self.copy else memoryview(raw)
+
+
+def _strip_frame(raw):
+    """Drop the frame opcode from a pickle which consists of a single frame.
+
+    Frames are optional when unpickling, and are 9 bytes we don't need to ship.
+
+    """
+    if len(raw) > _FRAME_PREFIX.size:
+        proto, opcode, size = _FRAME_PREFIX.unpack_from(raw)
+        if opcode == _FRAME and size == len(raw) - _FRAME_PREFIX.size:
+            return proto + raw[_FRAME_PREFIX.size:]
+    return raw
+
+
+class PickleCodec(object):
+    """Values are pickled; large buffers are kept out-of-band with pickle 5.
+
+    Out-of-band buffers (e.g. of NumPy arrays and bytearrays) are decoded as
+    views of the encoded data instead of copies.
+
+    :param bool bytes_as_views: Also keep ``bytes`` values out-of-band, so
+        that they decode as ``memoryview`` objects without being copied.
+
+    """
+
+    id = 1
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL, out_of_band=True, bytes_as_views=False):
+        self.protocol = protocol
+        self.out_of_band = out_of_band and protocol >= 5 and PICKLE_BUFFERS
+        self.bytes_as_views = bytes_as_views and self.out_of_band
+
+    def dumps(self, value):
+        if not self.out_of_band:
+            return _strip_frame(pickle.dumps(value, self.protocol)), ()
+        if self.bytes_as_views and isinstance(value, bytes):
+            value = pickle.PickleBuffer(value)
+        buffers = []
+        raw = pickle.dumps(value, self.protocol, buffer_callback=buffers.append)
+        return _strip_frame(raw), [buffer.raw() for buffer in buffers]
+
+    def loads(self, raw, buffers):
+        if buffers:
+            return pickle.loads(raw, buffers=buffers)
+        return pickle.loads(raw)
+
+
+class MsgpackCodec(object):
+    """Values are encoded with msgpack (which must be installed)."""
+
+    id = 2
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, value):
+        return self._msgpack.packb(value, use_bin_type=True), ()
+
+    def loads(self, raw, buffers):
+        return self._msgpack.unpackb(raw, raw=False)
+
+
+_codec_classes = {}
+_codecs = {}
+
+
+def register_codec(cls):
+    """Register a codec class (by its ``id``) so entries using it can be decoded."""
+    _codec_classes[cls.id] = cls
+    return cls
+
+for _cls in (RawCodec, PickleCodec, MsgpackCodec):
+    register_codec(_cls)
+
+
+def get_codec(id_):
+    codec = _codecs.get(id_)
+    if codec is None:
+        try:
+            cls = _codec_classes[id_]
+        except KeyError:
+            raise ValueError('unknown codec %r' % id_)
+        codec = _codecs[id_] = cls()
+    return codec
+
+
+def read_header(raw):
+    """Read the header of an encoded entry; only its first HEADER_SIZE bytes are needed."""
+    version, flags, codec, protocol, creation, expiry, etag_size = HEADER.unpack_from(raw)
+    if version != FORMAT_VERSION:
+        raise ValueError('unknown format version %r' % version)
+    if expiry != expiry: # NaN
+        expiry = None
+    return Header(codec, str(protocol), creation, expiry, etag_size)
+
+
+def read_expiry(raw):
+    return read_header(raw).expiry
+
+
+def _etag_offset(flags):
+    return HEADER_SIZE + (_duration.size if flags & FLAG_DURATION else 0)
+
+
+class Envelope(object):
+    """Serializer of data tuples into the compact binary format.
+
+    This has the ``dumps``/``loads`` interface expected of serializers by
+    stores such as :class:`memoize.redis.Store`.
+
+    :param codec: Used to encode values; a :class:`PickleCodec` by default.
+        Any registered codec can be decoded, regardless of this.
+    :param int compress_threshold: Payloads of at least this many bytes are
+        compressed with zlib. None disables compression.
+    :param int compress_level: zlib compression level.
+
+    """
+
+    def __init__(self, codec=None, compress_threshold=None, compress_level=6):
+        self.codec = codec or PickleCodec()
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, data):
+
+        flags = 0
+
+        etag = data[ETAG_INDEX]
+        if etag is None:
+            etag = b''
+        elif isinstance(etag, str) and etag:
+            flags |= FLAG_TEXT_ETAG
+            etag = etag.encode('utf8')
+        else:
+            etag = _strip_frame(pickle.dumps(etag, pickle.HIGHEST_PROTOCOL))
+
+        raw, buffers = self.codec.dumps(data[VALUE_INDEX])
+        if buffers:
+            flags |= FLAG_BUFFERS
+            chunks = [_count.pack(len(buffers), len(raw))]
+            chunks.extend(_length.pack(memoryview(buffer).nbytes) for buffer in buffers)
+            chunks.append(raw)
+            chunks.extend(buffers)
+        else:
+            chunks = [raw]
+
+        if self.compress_threshold is not None:
+            size = sum(memoryview(chunk).nbytes for chunk in chunks)
+            if size >= self.compress_threshold:
+                flags |= FLAG_COMPRESSED
+                chunks = [zlib.compress(b''.join(chunks), self.compress_level)]
+
+        duration = get_duration(data)
+        if duration is None:
+            duration = b''
+        else:
+            flags |= FLAG_DURATION
+            duration = _duration.pack(duration)
+
+        expiry = data[EXPIRY_INDEX]
+        header = HEADER.pack(
+            FORMAT_VERSION,
+            flags,
+            self.codec.id,
+            int(data[PROTOCOL_INDEX]),
+            data[CREATION_INDEX],
+            _nan if expiry is None else expiry,
+            len(etag),
+        )
+        return b''.join([header, duration, etag] + chunks)
+
+    def meta_size(self, raw):
+        """Number of bytes needed by :meth:`loads_meta`; ``raw`` needs only the header."""
+        version, flags, _, _, _, _, etag_size = HEADER.unpack_from(raw)
+        return _etag_offset(flags) + etag_size
+
+    def _loads_meta(self, view):
+        version, flags, codec, protocol, creation, expiry, etag_size = HEADER.unpack_from(view)
+        if version != FORMAT_VERSION:
+            raise ValueError('unknown format version %r' % version)
+        if expiry != expiry:
+            expiry = None
+        duration = None
+        if flags & FLAG_DURATION:
+            duration, = _duration.unpack_from(view, HEADER_SIZE)
+        # Protocol 1 only lacked the duration; this upgrades it.
+        protocol = max(protocol, 2)
+        offset = _etag_offset(flags)
+        etag = None
+        if etag_size:
+            etag = view[offset:offset + etag_size]
+            etag = str(etag, 'utf8') if flags & FLAG_TEXT_ETAG else pickle.loads(etag)
+        return flags, codec, (str(protocol), creation, expiry, etag, None, duration), offset + etag_size
+
+    def loads_meta(self, raw):
+        """Decode the data tuple, except for its value (which is None).
+
+        Only the first :meth:`meta_size` bytes are needed.
+
+        """
+        return self._loads_meta(memoryview(raw))[2]
+
+    def loads(self, raw):
+
+        view = memoryview(raw)
+        flags, codec, meta, offset = self._loads_meta(view)
+
+        payload = view[offset:]
+        if flags & FLAG_COMPRESSED:
+            payload = memoryview(zlib.decompress(payload))
+
+        buffers = None
+        if flags & FLAG_BUFFERS:
+            count, size = _count.unpack_from(payload)
+            offset = _count.size
+            lengths = []
+            for _ in range(count):
+                lengths.append(_length.unpack_from(payload, offset)[0])
+                offset += _length.size
+            value_raw = payload[offset:offset + size]
+            offset += size
+            buffers = []
+            for length in lengths:
+                buffers.append(payload[offset:offset + length])
+                offset += length
+            payload = value_raw
+
+        decoder = self.codec if codec == self.codec.id else get_codec(codec)
+        value = decoder.loads(payload, buffers)
+
+        return meta[:VALUE_INDEX] + (value, ) + meta[VALUE_INDEX + 1:]
@@ -1,13 +1,115 @@
+import copy
+import inspect
+import logging
+import math
+import random
 import sys
+import threading
+from timeit import default_timer as _timer
 
 from .time import time
+from .flight import SingleFlight
 from .func import MemoizedFunction
-from .options import call_or_pass
+from .options import RegionDict, call_or_pass
+from .stats import Stats
 
 
 DEFAULT_TIMEOUT = 10
-CURRENT_PROTOCOL_VERSION = '1'
-PROTOCOL_INDEX, CREATION_INDEX, EXPIRY_INDEX, ETAG_INDEX, VALUE_INDEX = list(range(5))
+DEFAULT_REFRESH_WORKERS = 4
+CURRENT_PROTOCOL_VERSION = '2'
+PROTOCOL_INDEX, CREATION_INDEX, EXPIRY_INDEX, ETAG_INDEX, VALUE_INDEX, DURATION_INDEX = list(range(6))
+
+# Store keys of the generations of tags and namespaces.
+TAG_PREFIX = 'memoize.tag:'
+NAMESPACE_PREFIX = 'memoize.namespace:'
+
+
+log = logging.getLogger(__name__)
+
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda func: False)
+
+_refresh_executor = None
+_refresh_executor_lock = threading.Lock()
+
+
+class CachedException(object):
+    """Stored in place of a value when calculating it raised an exception
+    which is cached (see the ``cache_exceptions`` option).
+
+    """
+
+    __slots__ = ('exception', )
+
+    def __init__(self, exception):
+        self.exception = exception
+
+    def __reduce__(self):
+        return (CachedException, (self.exception, ))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.exception)
+
+
+def bare_exception(exception):
+    """A copy of an exception, without where (or while) it was raised."""
+    try:
+        exception = copy.copy(exception)
+    except Exception:
+        # Not copyable (e.g. it takes other arguments than its args).
+        pass
+    exception.__traceback__ = None
+    exception.__context__ = None
+    exception.__cause__ = None
+    return exception
+
+
+def unpack_value(data):
+    """The value of a data tuple; raises its exception if one was cached.
+
+    A fresh copy of the exception is raised each time, so that callers (or
+    threads) don't share one, nor see each other's tracebacks.
+
+    """
+    value = data[VALUE_INDEX]
+    if value.__class__ is CachedException:
+        raise bare_exception(value.exception)
+    return value
+
+
+def get_duration(data):
+    """Seconds it took to calculate the value of a data tuple, or None.
+
+    Protocol 1 tuples do not have it.
+
+    """
+    return data[DURATION_INDEX] if len(data) > DURATION_INDEX else None
+
+
+def _with_expiry(data, expiry):
+    """A copy of a data tuple with a new expiry time."""
+    data = list(data)
+    data[EXPIRY_INDEX] = expiry
+    return tuple(data)
+
+
+def _data_ttl(data):
+    """Seconds until a data tuple (or None) expires; None if never."""
+    expiry = data and data[EXPIRY_INDEX]
+    if expiry is not None:
+        return max(0, expiry - time()) or None
+
+
+def _data_etag(data):
+    return data and data[ETAG_INDEX]
+
+
+def _get_refresh_executor():
+    global _refresh_executor
+    with _refresh_executor_lock:
+        if _refresh_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _refresh_executor = ThreadPoolExecutor(DEFAULT_REFRESH_WORKERS)
+        return _refresh_executor
 
 
 class Memoizer(object):
@@ -16,35 +118,199 @@ class Memoizer(object):
     def __init__(self, store, **kwargs):
         kwargs['store'] = store
         self.regions = dict(default=kwargs)
+        self._flights = SingleFlight()
+        self._async_flights = {}
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        self._hooks = []
+        self._stats = None
 
-    def _expand_opts(self, key, opts):
-        region = None
-        while region != 'default':
+    def add_hook(self, hook):
+        """Call ``hook(event, region, namespace, duration)`` on events.
 
-            # We look in the original opts (ie. specific to this function call)
-            # for the region to start out in.
-            if region is None:
-                region = opts.get('region', 'default')
+        See `memoize.stats` for the events.
 
-            # We keep looking at the parent of the current region, simulating
-            # an inheritance chain.
-            else:
-                region = self.regions[region].get('parent', 'default')
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def _emit(self, event, opts, duration=None):
+        region = opts.get('region', 'default')
+        namespace = opts.get('namespace')
+        for hook in self._hooks:
+            hook(event, region, namespace, duration)
+
+    def enable_stats(self):
+        """Start collecting the stats returned by `stats()`."""
+        if self._stats is None:
+            self._stats = Stats()
+            self.add_hook(self._stats)
+        return self._stats
+
+    def disable_stats(self):
+        if self._stats is not None:
+            self.remove_hook(self._stats)
+            self._stats = None
+
+    def stats(self):
+        """Snapshot of stats by `(region, namespace)`; see `enable_stats()`."""
+        return self._stats.snapshot() if self._stats is not None else {}
+
+    @property
+    def regions(self):
+        return self._regions
+
+    @regions.setter
+    def regions(self, regions):
+        self._regions = RegionDict(regions)
+        self._region_cache = {}
+        self._region_cache_version = None
+
+    def _region_opts(self, name):
+        """The options of a region, merged with those of its parents.
+
+        These are cached until any region is modified.
+
+        """
+
+        regions = self._regions
+        if self._region_cache_version != regions.version:
+            self._region_cache = {}
+            self._region_cache_version = regions.version
 
-            # Apply the region settings to the options.
-            for k, v in self.regions[region].items():
-                opts.setdefault(k, v)
+        flat = self._region_cache.get(name)
+        if flat is None:
 
+            flat = {}
+            region = name
+            while True:
+
+                # Apply the region settings to the options.
+                for k, v in regions[region].items():
+                    flat.setdefault(k, v)
+
+                if region == 'default':
+                    break
+
+                # We keep looking at the parent of the current region,
+                # simulating an inheritance chain.
+                region = regions[region].get('parent', 'default')
+
+            self._region_cache[name] = flat
+
+        return flat
+
+    def _resolve_opts(self, opts):
+        """Return a new dict of the given options over those of their region."""
+        # We look in the original opts (ie. specific to this function call)
+        # for the region to start out in.
+        resolved = dict(self._region_opts(opts.get('region', 'default')))
+        resolved.update(opts)
+        return resolved
+
+    def _expand_opts(self, key, opts):
+        opts = self._resolve_opts(opts)
+        return self._namespace(key, opts), opts['store'], opts
+
+    def _namespace(self, key, opts, generations=None):
+        """The key as seen by the store.
+
+        The generations of any tags (and the namespace, if it is versioned)
+        are folded into the key, so that invalidating them orphans the entry.
+        Pass a dict as ``generations`` to remember them between calls.
+
+        """
         namespace = opts.get('namespace')
         if namespace:
             key = '%s:%s' % (namespace, key)
+        if opts.get('tags') or (namespace and opts.get('versioned_namespace')):
+            names = self._generation_keys(opts)
+            suffix = generations.get(names) if generations is not None else None
+            if suffix is None:
+                suffix = '.'.join(self._generations(opts['store'], names))
+                if generations is not None:
+                    generations[names] = suffix
+            key = '%s#%s' % (key, suffix)
+        return key
+
+    def _generation_keys(self, opts):
+        """Store keys of the generations which keys with these options include."""
+        names = []
+        namespace = opts.get('namespace')
+        if namespace and opts.get('versioned_namespace'):
+            names.append(NAMESPACE_PREFIX + namespace)
+        tags = opts.get('tags')
+        if tags:
+            if isinstance(tags, str):
+                raise TypeError('tags must be a list of strings')
+            if callable(tags):
+                raise TypeError('tags function was not called with arguments')
+            names.extend(TAG_PREFIX + tag for tag in sorted(set(tags)))
+        return tuple(names)
+
+    def _new_generation(self):
+        return (CURRENT_PROTOCOL_VERSION, time(), None, None, '%012x' % random.getrandbits(48), None)
+
+    def _generations(self, store, names):
+        """Current generations from the store; missing ones are started anew."""
+
+        get_many = getattr(store, 'get_many', None)
+        found = get_many(names) if get_many else [store.get(name) for name in names]
+
+        generations = []
+        missing = {}
+        for name, data in zip(names, found):
+            if data is None:
+                # New, or evicted; either way entries which depended on it
+                # must not be found.
+                data = missing[name] = self._new_generation()
+            generations.append(data[VALUE_INDEX])
+
+        if missing:
+            set_many = getattr(store, 'set_many', None)
+            if set_many:
+                set_many(missing)
+            else:
+                for name, data in missing.items():
+                    store[name] = data
 
-        store = opts['store']
-        return key, store
+        return generations
+
+    def invalidate_tag(self, tag, **opts):
+        """Invalidate all entries which were stored with the given tag.
+
+        The entries are not removed, but are no longer found, as they are
+        keyed on the previous generation of the tag.
+
+        """
+        store = self._resolve_opts(opts)['store']
+        store[TAG_PREFIX + tag] = self._new_generation()
+
+    def invalidate_namespace(self, namespace, **opts):
+        """Invalidate all entries in a namespace with `versioned_namespace`."""
+        store = self._resolve_opts(opts)['store']
+        store[NAMESPACE_PREFIX + namespace] = self._new_generation()
+
+    def _resolve_dynamic_opts(self, opts, args, kwargs):
+        """Resolve the options which may be functions of the arguments."""
+
+        # Resolve the etag.
+        opts['etag'] = call_or_pass(opts.get('etag') or opts.get('etagger'), args, kwargs)
+
+        # Resolve the expiry, as it is used for both checking and storing.
+        opts['expiry'] = call_or_pass(opts.get('expiry'), args, kwargs)
+        opts['max_age'] = call_or_pass(opts.get('max_age'), args, kwargs)
+
+        tags = opts.get('tags')
+        if tags is not None:
+            opts['tags'] = call_or_pass(tags, args, kwargs)
 
     def _has_expired(self, data, opts):
-        protocol, creation, old_expiry, old_etag, value = data
-        assert protocol == CURRENT_PROTOCOL_VERSION, 'wrong protocol version: %r' % protocol
+
+        # Protocol 1 tuples lack only the trailing duration.
+        protocol, creation, old_expiry, old_etag, value = data[:DURATION_INDEX]
 
         current_time = time()
 
@@ -68,7 +334,59 @@ class Memoizer(object):
         if max_age is not None and (creation + max_age) < current_time:
             return True
 
-    def get(self, key, func=None, args=(), kwargs=None, **opts):
+    def _expires_at(self, data, opts):
+        """The time at which the data expires given these options, or None."""
+
+        expiry = data[EXPIRY_INDEX]
+
+        new_expiry = opts.get('expiry')
+        if new_expiry and not (expiry and expiry < new_expiry):
+            expiry = new_expiry
+
+        max_age = opts.get('max_age')
+        if max_age is not None:
+            max_expiry = data[CREATION_INDEX] + max_age
+            if not (expiry and expiry < max_expiry):
+                expiry = max_expiry
+
+        return expiry
+
+    def _should_refresh(self, data, opts):
+        """Should fresh data be recalculated early (via refresh_ahead)?"""
+        expiry = self._expires_at(data, opts)
+        if not expiry:
+            return False
+        creation = data[CREATION_INDEX]
+        return time() >= creation + (expiry - creation) * opts['refresh_ahead']
+
+    def _expires_early(self, data, opts):
+        """Should fresh data be recalculated early (via early_expiry)?
+
+        This is "XFetch"; the closer the data is to expiring, and the longer it
+        took to calculate, the more likely it is to be recalculated now. So
+        only a few of the callers which share a value recalculate it, spread
+        out before it expires, instead of all of them when it does.
+
+        """
+        duration = get_duration(data)
+        expiry = duration and self._expires_at(data, opts)
+        if not expiry:
+            return False
+        beta = opts['early_expiry']
+        if beta is True:
+            beta = 1.0
+        # 1 - random() is in (0, 1], so its log is never infinite.
+        return time() - duration * beta * math.log(1.0 - random.random()) >= expiry
+
+    def _is_stale(self, data, opts):
+        """Can expired data still be served (via stale_ttl)?"""
+        etag = opts.get('etag')
+        if etag is not None and etag != data[ETAG_INDEX]:
+            return False
+        expiry = self._expires_at(data, opts)
+        return bool(expiry) and time() < expiry + opts['stale_ttl']
+
+    def get(self, key, func=None, args=(), kwargs=None, default=None, **opts):
         """Manually retrieve a value from the cache, calculating as needed.
 
         Params:
@@ -77,6 +395,8 @@ class Memoizer(object):
                 expired.
             args -> positional arguments to call the function with.
             kwargs -> keyword arguments to call the function with.
+            default -> returned if there is no (fresh) value and no func; so
+                that a cached None can be told apart from a miss.
 
         Keyword Params (options):
             These will be combined with region values (as selected by the
@@ -85,69 +405,538 @@ class Memoizer(object):
 
             namespace -> string prefix to apply to the key before get/set.
             lock -> lock constructor. See README.
+            timeout -> float seconds to wait for a lock (or another thread's
+                computation when using single_flight).
+            single_flight -> bool; threads in this process which miss on the
+                same key share a single call of func.
             expiry -> float unix expiration time.
             max_age -> float number of seconds until the value expires. Only
                 provide expiry OR max_age, not both.
+            stale_ttl -> float seconds after expiry for which the old value is
+                still returned while it is recalculated in the background.
+            refresh_ahead -> float fraction of the lifetime of a value after
+                which it is recalculated in the background.
+            early_expiry -> True or float "beta"; recalculate values before
+                they expire, with a probability which rises as they near their
+                expiry (faster for larger beta, and for slower funcs).
+            max_age_jitter -> float fraction of max_age by which the lifetimes
+                of new values are randomly shortened, so that values which are
+                calculated together do not all expire together.
+            executor -> object with a `submit(func, *args)` method to run
+                background recalculations; a shared thread pool by default.
+            min_compute_time -> float seconds; values which are calculated
+                faster are returned but not stored.
+            max_size -> int bytes; larger values are returned but not stored.
+            min_benefit -> float seconds of calculation per megabyte of value
+                below which values are returned but not stored.
+            sizeof -> function to measure the size of a data tuple for
+                max_size and min_benefit; the length of its pickled value (or
+                its buffer) by default.
+            tags -> list of strings (or a function of the arguments which
+                returns one) to invalidate the value by via `invalidate_tag`.
+            versioned_namespace -> bool; the namespace may be invalidated via
+                `invalidate_namespace`.
+            cache_exceptions -> exception class (or tuple of them) which, when
+                raised by func, are stored and raised again on later hits.
+            negative_values -> list of values (e.g. None) which are negative
+                results; they are compared by identity, or equality if of the
+                same type.
+            negative_max_age -> float seconds for which cached exceptions and
+                negative values are kept; otherwise the same as other values.
 
         """
-        kwargs = kwargs or {}
-        key, store = self._expand_opts(key, opts)
+        return self._get(key, func, args, kwargs, self._resolve_opts(opts), default)
 
-        # Resolve the etag.
-        opts['etag'] = call_or_pass(opts.get('etag') or opts.get('etagger'), args, kwargs)
+    def _get(self, key, func, args, kwargs, opts, default=None):
+        """`get`, with options already resolved into a dict we may modify."""
+
+        kwargs = kwargs or {}
+        self._resolve_dynamic_opts(opts, args, kwargs)
+        key = self._namespace(key, opts)
+        store = opts['store']
 
         if not isinstance(key, str):
             raise TypeError('non-string key of type %s' % type(key))
 
-        data = store.get(key)
-        if data is not None:
-            if not self._has_expired(data, opts):
-                return data[VALUE_INDEX]
+        data = self._fetch(key, store, opts)
+        if self._is_usable(key, store, data, func, args, kwargs, opts):
+            return unpack_value(data)
 
         if func is None:
+            return default
+
+        if opts.get('single_flight'):
+            return self._flights.run(
+                (id(store), key),
+                self._compute,
+                (key, store, func, args, kwargs, opts, data, True),
+                opts.get('timeout', DEFAULT_TIMEOUT),
+            )
+        return self._compute(key, store, func, args, kwargs, opts, data)
+
+    def _fetch(self, key, store, opts):
+        """Get data from the store, checking its metadata first if we have an etag.
+
+        When the store can fetch metadata apart from values, and the etag does
+        not match (or the value has otherwise expired), the value is never
+        fetched; the metadata is returned in its place (with a value of None).
+
+        """
+        meta = opts.get('etag') is not None and getattr(store, 'meta', None)
+        if not meta:
+            return store.get(key)
+        data = meta(key)
+        if data is None:
             return None
+        if self._has_expired(data, opts) and not (opts.get('stale_ttl') and self._is_stale(data, opts)):
+            return data
+        # It may have changed since; the full data is checked again.
+        return store.get(key)
+
+    def _store_meta(self, store, key):
+        """The data for a key with its value (if a store can leave it out), or None."""
+        meta = getattr(store, 'meta', None)
+        return meta(key) if meta else store.get(key)
+
+    def _is_usable(self, key, store, data, func, args, kwargs, opts, refresh=None):
+        """Can the data be returned? Schedules background refreshes as needed.
+
+        They are scheduled via `refresh`, which takes the same arguments as
+        `_refresh` (the default); so that `memoize.aio` shares this.
+
+        """
+
+        refresh = refresh or self._refresh
+
+        if data is None:
+            if self._hooks:
+                self._emit('miss', opts)
+            return False
+
+        if not self._has_expired(data, opts):
+            if func is not None and opts.get('early_expiry') and self._expires_early(data, opts):
+                if self._hooks:
+                    self._emit('early', opts)
+                return False
+            if self._hooks:
+                self._emit('hit', opts)
+            if func is not None and opts.get('refresh_ahead') and self._should_refresh(data, opts):
+                refresh(key, store, func, args, kwargs, opts, data)
+            return True
+
+        if func is not None and opts.get('stale_ttl') and self._is_stale(data, opts):
+            if self._hooks:
+                self._emit('stale', opts)
+            refresh(key, store, func, args, kwargs, opts, data)
+            return True
+
+        if self._hooks:
+            self._emit('expired', opts)
+
+        return False
+
+    def get_many(self, keys, func=None, args=None, kwargs=None, func_many=None, **opts):
+        """Retrieve many values from the cache, calculating as needed.
+
+        Values are fetched via a single call to the store's `get_many`, and
+        written via a single `set_many`, if the store has them.
+
+        Params:
+            keys -> list of strings to store/retrieve values from.
+            func -> callable to generate each value if it does not exist, or
+                has expired.
+            args -> list of positional argument tuples; one per key.
+            kwargs -> list of keyword argument dicts; one per key.
+            func_many -> callable to generate all missing values at once; it
+                is called with a list of positional argument tuples (one per
+                missing key) and must return a list of values. Used instead
+                of func if provided.
+
+        Keyword Params (options):
+            The same as for `get`, except that values are calculated without
+            locking.
+
+        Returns a list of values; one per key.
+
+        """
+
+        keys, args, kwargs, opts, key_opts = self._prepare_many(keys, args, kwargs, opts)
+        store = opts['store']
+
+        # Background refreshes are done one key at a time.
+        refresh_func = func
+        if func is None and func_many is not None:
+            refresh_func = lambda *args: func_many([args])[0]
+
+        found = self._store_get_many(store, keys)
+
+        values = [None] * len(keys)
+        missing = []
+        for i, data in enumerate(found):
+            if self._is_usable(keys[i], store, data, refresh_func, args[i], kwargs[i], key_opts[i]):
+                values[i] = unpack_value(data)
+            else:
+                missing.append(i)
+
+        if not missing or (func is None and func_many is None):
+            return values
+
+        if func_many is not None:
+            try:
+                computed, duration = self._call(func_many, ([args[i] for i in missing], ), {}, opts)
+            except Exception as e:
+                # As if each of them raised it.
+                self._store_many(store, self._exception_entries(e, missing, keys, key_opts))
+                raise
+            computed = list(computed)
+            if len(computed) != len(missing):
+                raise ValueError('func_many returned %d values for %d arguments' % (
+                    len(computed), len(missing)))
+            # We can only assume they each took an equal share.
+            durations = [duration and duration / len(missing)] * len(missing)
+        else:
+            computed = []
+            durations = []
+            for i in missing:
+                try:
+                    value, duration = self._call(func, args[i], kwargs[i], opts)
+                except Exception as e:
+                    # Keep the values calculated before it too.
+                    entries = self._result_entries(missing, computed, durations, keys, key_opts)
+                    entries.update(self._exception_entries(e, [i], keys, key_opts))
+                    self._store_many(store, entries)
+                    raise
+                computed.append(value)
+                durations.append(duration)
+
+        for i, value in zip(missing, computed):
+            values[i] = value
+        self._store_many(store, self._result_entries(missing, computed, durations, keys, key_opts))
+
+        return values
+
+    def _result_entries(self, indices, values, durations, keys, key_opts):
+        """The data tuples to store for values calculated by `get_many`."""
+        entries = {}
+        for i, value, duration in zip(indices, values, durations):
+            data = self._result_entry(value, duration, key_opts[i])
+            if data is not None:
+                entries[keys[i]] = data
+        return entries
+
+    def _exception_entries(self, exception, indices, keys, key_opts):
+        """The data tuples to store for keys of `get_many` whose calculation raised."""
+        entries = {}
+        for i in indices:
+            data = self._exception_entry(exception, key_opts[i])
+            if data is not None:
+                entries[keys[i]] = data
+        return entries
+
+    def _store_many(self, store, to_store):
+        set_many = getattr(store, 'set_many', None)
+        if set_many:
+            set_many(to_store)
+        else:
+            for key, data in to_store.items():
+                store[key] = data
+
+    def _prepare_many(self, keys, args, kwargs, opts):
+        """Resolve the keys, arguments, and options of `get_many` and friends.
+
+        Returns store keys, lists of args and kwargs, the resolved options, and
+        a copy of them for each key with its dynamic options resolved.
+
+        """
+
+        keys = list(keys)
+        args = list(args) if args is not None else [()] * len(keys)
+        kwargs = list(kwargs) if kwargs is not None else [None] * len(keys)
+        kwargs = [x or {} for x in kwargs]
+        if not (len(keys) == len(args) == len(kwargs)):
+            raise ValueError('keys, args, and kwargs must be the same length')
+
+        opts = self._resolve_opts(opts)
+
+        key_opts = []
+        generations = {}
+        for i, key in enumerate(keys):
+            if not isinstance(key, str):
+                raise TypeError('non-string key of type %s' % type(key))
+            opts_i = dict(opts)
+            self._resolve_dynamic_opts(opts_i, args[i], kwargs[i])
+            keys[i] = self._namespace(key, opts_i, generations)
+            key_opts.append(opts_i)
+
+        return keys, args, kwargs, opts, key_opts
+
+    def _store_get_many(self, store, keys):
+        get_many = getattr(store, 'get_many', None)
+        return get_many(keys) if get_many else [store.get(key) for key in keys]
+
+    def warm(self, keys, func, args=None, kwargs=None, workers=4, executor=None,
+             progress=None, **opts):
+        """Calculate and store the values which are missing (or expired).
+
+        Existing values are checked for via a single call to the store's
+        `get_many`, if it has one, and missing ones are calculated in parallel.
+        Each is calculated via the usual locking (so concurrent warmers, or
+        requests, don't duplicate work), and errors are collected rather than
+        raised. See `memoize.warm`.
+
+        Params:
+            keys -> list of strings to store values at.
+            func -> callable to generate each value.
+            args -> list of positional argument tuples; one per key.
+            kwargs -> list of keyword argument dicts; one per key.
+            workers -> number of threads to calculate values with.
+            executor -> object with a `submit(func, *args, **kwargs)` method
+                which returns a future (e.g. a `concurrent.futures` process
+                pool) to call func via instead of calling it directly.
+            progress -> callable which is passed the report as each value is
+                done; it is called from the worker threads.
+
+        Keyword Params (options):
+            The same as for `get`.
+
+        Returns a `memoize.warm.WarmReport`.
+
+        """
+        from .warm import warm
+        return warm(self, keys, func, args, kwargs, workers, executor, progress, opts)
+
+    def _refresh(self, key, store, func, args, kwargs, opts, data):
+        """Recalculate a value in the background; at most once per key."""
+
+        token = (id(store), key)
+        with self._refreshing_lock:
+            if token in self._refreshing:
+                return
+            self._refreshing.add(token)
+
+        if self._hooks:
+            self._emit('refresh', opts)
+
+        def refresh():
+            try:
+                self._compute(key, store, func, args, kwargs, opts, data)
+            except Exception:
+                log.exception('error while refreshing %r', key)
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(token)
+
+        executor = opts.get('executor') or _get_refresh_executor()
+        try:
+            executor.submit(refresh)
+        except Exception:
+            with self._refreshing_lock:
+                self._refreshing.discard(token)
+            raise
+
+    def _compute(self, key, store, func, args, kwargs, opts, seen=None, recheck=False):
+        """Calculate and store a value, under the lock if there is one.
+
+        The store is looked at again first if the lock was acquired, or if
+        `recheck`; as when leading a single flight, the previous flight may
+        have stored the value since we fetched `seen`.
+
+        """
 
         # Prioritize passed options over a store's native lock.
         lock_func = opts.get('lock') or getattr(store, 'lock', None)
         lock = lock_func and lock_func(key)
-        locked = lock and lock.acquire(opts.get('timeout', DEFAULT_TIMEOUT))
+        if lock and self._hooks:
+            start = _timer()
+            locked = lock.acquire(opts.get('timeout', DEFAULT_TIMEOUT))
+            self._emit('lock_wait' if locked else 'lock_timeout', opts, _timer() - start)
+        else:
+            locked = lock and lock.acquire(opts.get('timeout', DEFAULT_TIMEOUT))
 
         try:
-            value = func(*args, **kwargs)
+
+            # Whoever held the lock before us has likely just computed the
+            # value, so look again before doing the work ourselves. What we
+            # saw before may not have expired if we are refreshing early.
+            if locked or recheck:
+                data = self._fetch(key, store, opts)
+                if self._is_new(data, seen, opts):
+                    return unpack_value(data)
+
+            try:
+                value, duration = self._call(func, args, kwargs, opts)
+            except Exception as e:
+                data = self._exception_entry(e, opts)
+                if data is not None:
+                    store[key] = data
+                raise
+
+            data = self._result_entry(value, duration, opts)
+            if data is not None:
+                store[key] = data
+
         finally:
             if locked:
                 lock.release()
 
+        return value
+
+    def _is_new(self, data, seen, opts):
+        """Is data found after taking a lock fresh, and not what we saw before?"""
+        return (data is not None and not self._has_expired(data, opts) and
+            (seen is None or data[CREATION_INDEX] != seen[CREATION_INDEX]))
+
+    def _call(self, func, args, kwargs, opts):
+        """Call func, and time it (to be stored with its value).
+
+        Returns the value, and the seconds it took.
+
+        """
+
+        hooks = self._hooks
+        start = _timer()
+        try:
+            value = func(*args, **kwargs)
+        except Exception:
+            if hooks:
+                self._emit('error', opts, _timer() - start)
+            raise
+        duration = _timer() - start
+        if hooks:
+            self._emit('compute', opts, duration)
+        return value, duration
+
+    def _admit(self, data, duration, opts):
+        """Should freshly calculated data be stored? See the admission options."""
+
+        min_compute_time = opts.get('min_compute_time')
+        if min_compute_time and duration < min_compute_time:
+            admitted = False
+
+        else:
+            max_size = opts.get('max_size')
+            min_benefit = opts.get('min_benefit')
+            if max_size is None and not min_benefit:
+                return True
+            from .stores import default_sizeof
+            size = (opts.get('sizeof') or default_sizeof)(data)
+            admitted = (
+                (max_size is None or size <= max_size) and
+                (not min_benefit or duration * 1e6 >= min_benefit * size)
+            )
+
+        if not admitted and self._hooks:
+            self._emit('reject', opts)
+        return admitted
+
+    def _result_entry(self, value, duration, opts):
+        """The data tuple to store for a calculated value, or None if not admitted."""
+        data = self._entry(value, opts, duration)
+        if self._is_negative(value, opts) or self._admit(data, duration, opts):
+            return data
+
+    def _exception_entry(self, exception, opts):
+        """The data tuple to store for an exception, or None if it is not cached."""
+        cache_exceptions = opts.get('cache_exceptions')
+        if cache_exceptions and isinstance(exception, cache_exceptions):
+            return self._entry(CachedException(bare_exception(exception)), opts)
+
+    def _is_negative(self, value, opts):
+        """Is this a negative result? These bypass the admission options."""
+        negatives = opts.get('negative_values')
+        if negatives:
+            for negative in negatives:
+                if value is negative or (type(value) is type(negative) and value == negative):
+                    return True
+        return False
+
+    def _entry(self, value, opts, duration=None):
+        """Build the data tuple for a freshly calculated value."""
+
         creation = time()
-        expiry = call_or_pass(opts.get('expiry'), args, kwargs)
-        max_age = call_or_pass(opts.get('max_age'), args, kwargs)
+        expiry = opts.get('expiry')
+        max_age = opts.get('max_age')
+        negative_max_age = opts.get('negative_max_age')
+        if negative_max_age is not None and (
+            value.__class__ is CachedException or self._is_negative(value, opts)
+        ):
+            max_age = negative_max_age if max_age is None else min(max_age, negative_max_age)
         if max_age is not None:
+            jitter = opts.get('max_age_jitter')
+            if jitter:
+                max_age *= 1.0 - jitter * random.random()
             expiry = min(x for x in (expiry, creation + max_age) if x is not None)
 
         # Need to be careful as this is the only place where we do not use the
         # lovely index constants.
-        store[key] = (CURRENT_PROTOCOL_VERSION, creation, expiry, opts.get('etag'), value)
-
-        return value
+        return (CURRENT_PROTOCOL_VERSION, creation, expiry, opts.get('etag'), value, duration)
+
+    def aget(self, key, func=None, args=(), kwargs=None, default=None, **opts):
+        """Asynchronous `get`, returning an awaitable. See `memoize.aio`."""
+        from .aio import aget
+        return aget(self, key, func, args, kwargs, default, **opts)
+
+    def adelete(self, key, **opts):
+        """Asynchronous `delete`, returning an awaitable."""
+        from .aio import adelete
+        return adelete(self, key, **opts)
+
+    def aexpire_at(self, key, expiry, **opts):
+        """Asynchronous `expire_at`, returning an awaitable."""
+        from .aio import aexpire_at
+        return aexpire_at(self, key, expiry, **opts)
+
+    def aexpire(self, key, max_age, **opts):
+        """Asynchronous `expire`, returning an awaitable."""
+        from .aio import aexpire_at
+        return aexpire_at(self, key, time() + max_age, **opts)
+
+    def attl(self, key, **opts):
+        """Asynchronous `ttl`, returning an awaitable."""
+        from .aio import attl
+        return attl(self, key, **opts)
+
+    def aetag(self, key, **opts):
+        """Asynchronous `etag`, returning an awaitable."""
+        from .aio import aetag
+        return aetag(self, key, **opts)
+
+    def aexists(self, key, **opts):
+        """Asynchronous `exists`, returning an awaitable."""
+        from .aio import aexists
+        return aexists(self, key, **opts)
 
     def delete(self, key, **opts):
         """Remove a key from the cache."""
-        key, store = self._expand_opts(key, opts)
+        key, store, opts = self._expand_opts(key, opts)
         try:
             del store[key]
         except KeyError:
             pass
 
+    def delete_many(self, keys, **opts):
+        """Remove many keys from the cache; at once if the store supports it."""
+        opts = self._resolve_opts(opts)
+        store = opts['store']
+        generations = {}
+        keys = [self._namespace(key, opts, generations) for key in keys]
+        delete_many = getattr(store, 'delete_many', None)
+        if delete_many:
+            delete_many(keys)
+            return
+        for key in keys:
+            try:
+                del store[key]
+            except KeyError:
+                pass
+
     def expire_at(self, key, expiry, **opts):
         """Set the explicit unix expiry time of a key."""
-        key, store = self._expand_opts(key, opts)
+        key, store, opts = self._expand_opts(key, opts)
         data = store.get(key)
-        if data is not None:
-            data = list(data)
-            data[EXPIRY_INDEX] = expiry
-            store[key] = tuple(data)
-        else:
+        if data is None:
             raise KeyError(key)
+        store[key] = _with_expiry(data, expiry)
 
     def expire(self, key, max_age, **opts):
         """Set the maximum age of a given key, in seconds."""
@@ -155,25 +944,21 @@ class Memoizer(object):
 
     def ttl(self, key, **opts):
         """Get the time-to-live of a given key; None if not set."""
-        key, store = self._expand_opts(key, opts)
+        key, store, opts = self._expand_opts(key, opts)
         if hasattr(store, 'ttl'):
             return store.ttl(key)
-        data = store.get(key)
-        if data is None:
-            return None
-        expiry = data[EXPIRY_INDEX]
-        if expiry is not None:
-            return max(0, expiry - time()) or None
+        return _data_ttl(self._store_meta(store, key))
 
     def etag(self, key, **opts):
-        key, store = self._expand_opts(key, opts)
-        data = store.get(key)
-        return data and data[ETAG_INDEX]
+        key, store, opts = self._expand_opts(key, opts)
+        return _data_etag(self._store_meta(store, key))
 
     def exists(self, key, **opts):
         """Return if a key exists in the cache."""
-        key, store = self._expand_opts(key, opts)
-        data = store.get(key)
+        key, store, opts = self._expand_opts(key, opts)
+        return self._data_exists(self._store_meta(store, key), opts)
+
+    def _data_exists(self, data, opts):
         # Note that we do not actually delete the thing here as the max_age
         # just for this call may have triggered a False.
         if not data or self._has_expired(data, opts):
@@ -190,6 +975,9 @@ class Memoizer(object):
             return lambda func: self(func, *args, **opts)
 
         master_key = ','.join(map(repr, args)) if args else None
+        if _iscoroutinefunction(func):
+            from .aio import AsyncMemoizedFunction
+            return AsyncMemoizedFunction(self, func, master_key, opts)
         return MemoizedFunction(self, func, master_key, opts)
 
 
@@ -0,0 +1,531 @@
+"""Persistent store on an append-only log with a memory-mapped hash index.
+
+Files in the store's directory::
+
+    CURRENT     the generation of the live log and index (0 if missing)
+    log.N       append-only log of records
+    index.N     hash table from keys to the offsets of their latest records
+    lock        held (via fcntl) by writers
+
+A log starts with LOG_MAGIC, and each record is (all big-endian)::
+
+    I   CRC32 of the rest of the record
+    I   flags (see RECORD_*)
+    I   length of the key
+    I   length of the value
+    ... key (UTF-8)
+    ... value; a data tuple encoded by an Envelope (see memoize.codec)
+
+An index is a header (see INDEX_HEADER) followed by an open-addressing table of
+``(64-bit key hash, log offset)`` slots. Slots are never freed; deleting a key
+points its slot at a tombstone record.
+
+Writers (threads and processes) serialize on the lock file, but readers take
+no locks at all. A slot is only filled in after its record has been written,
+and its offset is written before its hash, so readers never see a partial
+record. Growing the index or compacting the log produces new files, and then
+marks the old index as retired so that other processes switch over.
+
+When opened, records which were appended after the index was last updated
+(e.g. by a writer which crashed) are replayed, a torn record at the end of the
+log is truncated, and a missing or unreadable index is rebuilt from the log.
+
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from .codec import Envelope, HEADER, HEADER_SIZE, read_header
+from .time import time
+
+
+log = logging.getLogger(__name__)
+
+
+LOG_MAGIC = b'MEMOLOG1'
+INDEX_MAGIC = b'MEMOIDX1'
+
+RECORD_TOMBSTONE = 1
+
+RECORD = struct.Struct('>IIII')
+_record_body = struct.Struct('>III')
+_crc = struct.Struct('>I')
+
+# Magic, capacity, used slots, indexed log size, garbage bytes, retired.
+INDEX_HEADER = struct.Struct('>8sQQQQQ')
+SLOT = struct.Struct('>QQ')
+
+_u64 = struct.Struct('>Q')
+
+_CAPACITY = 8
+_USED = 16
+_INDEXED = 24
+_GARBAGE = 32
+_RETIRED = 40
+
+
+def _hash(encoded_key):
+    value, = _u64.unpack(hashlib.blake2b(encoded_key, digest_size=8).digest())
+    return value or 1 # Zero marks an empty slot.
+
+
+def _write_all(fh, data):
+    view = memoryview(data)
+    while view:
+        view = view[fh.write(view):]
+
+
+def _new_index(path, capacity):
+    """Create an empty index; it is written elsewhere and moved into place."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w+b') as fh:
+        fh.truncate(INDEX_HEADER.size + capacity * SLOT.size)
+        index = mmap.mmap(fh.fileno(), 0)
+    INDEX_HEADER.pack_into(index, 0, INDEX_MAGIC, capacity, 0, len(LOG_MAGIC), 0, 0)
+    return index, tmp_path
+
+
+def _insert(index, capacity, hash_, offset):
+    i = hash_ % capacity
+    while True:
+        pos = INDEX_HEADER.size + i * SLOT.size
+        if not _u64.unpack_from(index, pos)[0]:
+            SLOT.pack_into(index, pos, hash_, offset)
+            return
+        i = (i + 1) % capacity
+
+
+class _Files(object):
+    """The log and index of one generation.
+
+    These are replaced, not modified, when the index is grown or the log is
+    compacted, so readers can keep using the ones they started with.
+
+    """
+
+    def __init__(self, generation, log, index):
+        self.generation = generation
+        self.log = log
+        self.index = index
+        self.capacity = self.get(_CAPACITY)
+        self._view = None
+
+    def get(self, field):
+        return _u64.unpack_from(self.index, field)[0]
+
+    def set(self, field, value):
+        _u64.pack_into(self.index, field, value)
+
+    def add(self, field, value):
+        self.set(field, self.get(field) + value)
+
+    def view(self, end):
+        """A view of the log which extends to at least ``end``, or None."""
+        view = self._view
+        if view is None or len(view) < end:
+            size = os.fstat(self.log.fileno()).st_size
+            if size < end:
+                return None
+            view = self._view = memoryview(mmap.mmap(self.log.fileno(), size, access=mmap.ACCESS_READ))
+        return view
+
+    def record(self, offset, verify=False):
+        """Read a record as ``(flags, key, value, size)``; None if incomplete."""
+        view = self.view(offset + RECORD.size)
+        if view is None:
+            return None
+        crc, flags, key_size, value_size = RECORD.unpack_from(view, offset)
+        start = offset + RECORD.size
+        end = start + key_size + value_size
+        view = self.view(end)
+        if view is None:
+            return None
+        if verify and crc != zlib.crc32(view[offset + _crc.size:end]) & 0xffffffff:
+            return None
+        return flags, view[start:start + key_size], view[start + key_size:end], end - offset
+
+    def find(self, key, hash_):
+        """Find the slot of a key; returns ``(slot position, log offset, record)``.
+
+        The offset and record are None if the key is not in the index, in which
+        case the position is of the empty slot it would go into.
+
+        """
+        index = self.index
+        capacity = self.capacity
+        i = hash_ % capacity
+        while True:
+            pos = INDEX_HEADER.size + i * SLOT.size
+            slot_hash, offset = SLOT.unpack_from(index, pos)
+            if not slot_hash:
+                return pos, None, None
+            if slot_hash == hash_:
+                record = self.record(offset)
+                if record is not None and record[1] == key:
+                    return pos, offset, record
+            i = (i + 1) % capacity
+
+    def slots(self):
+        index = self.index
+        for i in range(self.capacity):
+            hash_, offset = SLOT.unpack_from(index, INDEX_HEADER.size + i * SLOT.size)
+            if hash_:
+                yield hash_, offset
+
+
+class DiskStore(object):
+    """Persistent store which may be shared by processes on one host.
+
+    Lookups are a hash and a probe of a memory-mapped index, and values are
+    decoded directly from the memory-mapped log (so large buffers are not
+    copied; see :class:`memoize.codec.PickleCodec`). This requires ``fcntl``,
+    and so is not available on Windows.
+
+    :param str path: Directory to keep the files in; created if needed.
+    :param envelope: The :class:`memoize.codec.Envelope` to encode values with.
+    :param float grace: Seconds past their expiry for which values are kept.
+    :param int capacity: Initial number of slots in the index.
+    :param float max_load: Fraction of the slots which may be used before the
+        index is doubled in size.
+    :param float compact_ratio: Fraction of the log which must be garbage
+        (overwritten, deleted, or expired values) for
+        :meth:`needs_compaction` to be true.
+    :param float compact_interval: Seconds between checks (on a background
+        thread) of whether the log needs compaction. None disables them.
+    :param bool sync: Flush the log to disk after each write.
+
+    """
+
+    def __init__(self, path, envelope=None, grace=0, capacity=1024, max_load=0.5,
+                 compact_ratio=0.5, compact_interval=None, sync=False):
+
+        self.path = path
+        self.envelope = envelope or Envelope()
+        self.grace = grace
+        self.capacity = capacity
+        self.max_load = max_load
+        self.compact_ratio = compact_ratio
+        self.sync = sync
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._files = None
+        with self._writing():
+            pass
+
+        self._closed = threading.Event()
+        if compact_interval:
+            thread = threading.Thread(target=self._compact_loop, args=(compact_interval, ))
+            thread.daemon = True
+            thread.start()
+
+    def _join(self, name):
+        return os.path.join(self.path, name)
+
+    def _paths(self, generation):
+        return self._join('log.%d' % generation), self._join('index.%d' % generation)
+
+    def _read_generation(self):
+        try:
+            with open(self._join('CURRENT')) as fh:
+                return int(fh.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _write_generation(self, generation):
+        path = self._join('CURRENT')
+        with open(path + '.tmp', 'w') as fh:
+            fh.write('%d\n' % generation)
+        os.rename(path + '.tmp', path)
+
+    class _Writing(object):
+
+        def __init__(self, store):
+            self.store = store
+
+        def __enter__(self):
+            store = self.store
+            store._thread_lock.acquire()
+            try:
+                # Locks are held by open files, which are shared with forks.
+                if store._pid != os.getpid():
+                    store._lock_file = open(store._join('lock'), 'a+b')
+                    store._pid = os.getpid()
+                fcntl.flock(store._lock_file.fileno(), fcntl.LOCK_EX)
+            except:
+                store._thread_lock.release()
+                raise
+            try:
+                files = store._files
+                if (files is None or files.get(_RETIRED) or
+                    os.fstat(files.log.fileno()).st_nlink == 0):
+                    store._open()
+            except:
+                self.__exit__()
+                raise
+            return store._files
+
+        def __exit__(self, *exc_info):
+            try:
+                fcntl.flock(self.store._lock_file.fileno(), fcntl.LOCK_UN)
+            finally:
+                self.store._thread_lock.release()
+
+    def _writing(self):
+        """Context manager which holds the write lock, and yields the current files."""
+        return self._Writing(self)
+
+    def _open(self):
+        """Open (and recover) the current generation; the write lock must be held."""
+
+        generation = self._read_generation()
+        log_path, index_path = self._paths(generation)
+
+        fd = os.open(log_path, os.O_RDWR | os.O_CREAT, 0o644)
+        log_file = os.fdopen(fd, 'r+b', 0)
+        size = os.fstat(fd).st_size
+        if size < len(LOG_MAGIC):
+            log_file.truncate(0)
+            _write_all(log_file, LOG_MAGIC)
+            size = len(LOG_MAGIC)
+        elif log_file.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError('%s is not a log' % log_path)
+
+        index = None
+        try:
+            with open(index_path, 'r+b') as fh:
+                index = mmap.mmap(fh.fileno(), 0)
+        except (IOError, OSError, ValueError):
+            pass
+        if index is not None:
+            magic, capacity, _, indexed = INDEX_HEADER.unpack_from(index)[:4]
+            if (magic != INDEX_MAGIC or len(index) != INDEX_HEADER.size + capacity * SLOT.size
+                or indexed > size):
+                if magic == INDEX_MAGIC:
+                    _u64.pack_into(index, _RETIRED, 1)
+                index = None
+        if index is None:
+            if size > len(LOG_MAGIC):
+                log.warning('rebuilding index of %s' % log_path)
+            index, tmp_path = _new_index(index_path, self.capacity)
+            os.rename(tmp_path, index_path)
+
+        files = self._files = _Files(generation, log_file, index)
+
+        # Replay anything written after the index was last updated.
+        offset = files.get(_INDEXED)
+        while offset < size:
+            record = files.record(offset, verify=True)
+            if record is None:
+                log.warning('truncating torn record at %d of %s' % (offset, log_path))
+                log_file.truncate(offset)
+                break
+            flags, key, _, record_size = record
+            self._put(bytes(key), offset, record_size, flags)
+            offset += record_size
+            files = self._files
+        files.set(_INDEXED, offset)
+
+    def _put(self, key, offset, size, flags=0):
+        """Point the index at a new record; the write lock must be held."""
+
+        files = self._files
+        hash_ = _hash(key)
+        pos, old_offset, record = files.find(key, hash_)
+
+        if old_offset is None:
+            if flags & RECORD_TOMBSTONE:
+                files.add(_GARBAGE, size)
+                return
+            _u64.pack_into(files.index, pos + _u64.size, offset)
+            _u64.pack_into(files.index, pos, hash_)
+            files.add(_USED, 1)
+            if files.get(_USED) > files.capacity * self.max_load:
+                self._grow()
+            return
+
+        if old_offset == offset:
+            # Already indexed, before a crash.
+            return
+        files.add(_GARBAGE, record[3] + (size if flags & RECORD_TOMBSTONE else 0))
+        _u64.pack_into(files.index, pos + _u64.size, offset)
+
+    def _grow(self):
+        """Double the size of the index; the write lock must be held."""
+        old = self._files
+        capacity = old.capacity * 2
+        index_path = self._paths(old.generation)[1]
+        index, tmp_path = _new_index(index_path, capacity)
+        for hash_, offset in old.slots():
+            _insert(index, capacity, hash_, offset)
+        for field in (_USED, _INDEXED, _GARBAGE):
+            _u64.pack_into(index, field, old.get(field))
+        os.rename(tmp_path, index_path)
+        old.set(_RETIRED, 1)
+        self._files = _Files(old.generation, old.log, index)
+
+    def _append(self, items, flags=0):
+        """Append records for ``(key, value)`` pairs, and index them.
+
+        The write lock must be held.
+
+        """
+        fh = self._files.log
+        offset = fh.seek(0, os.SEEK_END)
+        for key, value in items:
+            body = _record_body.pack(flags, len(key), len(value))
+            crc = zlib.crc32(value, zlib.crc32(key, zlib.crc32(body))) & 0xffffffff
+            record = b''.join((_crc.pack(crc), body, key, value))
+            _write_all(fh, record)
+            if self.sync:
+                os.fsync(fh.fileno())
+            self._put(key, offset, len(record), flags)
+            offset += len(record)
+            self._files.set(_INDEXED, offset)
+
+    def _current(self):
+        files = self._files
+        if files.get(_RETIRED):
+            with self._writing() as files:
+                pass
+        return files
+
+    def _is_dead(self, value):
+        expiry = HEADER.unpack_from(value)[5] # NaN (for None) is never less.
+        return expiry + self.grace < time()
+
+    def _find(self, key):
+        """The value of the live record for key, or None."""
+        key = key.encode('utf8')
+        record = self._current().find(key, _hash(key))[2]
+        if record is None or record[0] & RECORD_TOMBSTONE or self._is_dead(record[2]):
+            return None
+        return record[2]
+
+    def get(self, key):
+        value = self._find(key)
+        if value is not None:
+            return self.envelope.loads(value)
+
+    def meta(self, key):
+        """The data tuple for a key without decoding its value (which is None)."""
+        value = self._find(key)
+        if value is not None:
+            return self.envelope.loads_meta(value)
+
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def __setitem__(self, key, data):
+        item = (key.encode('utf8'), self.envelope.dumps(data))
+        with self._writing():
+            self._append([item])
+
+    def set_many(self, mapping):
+        items = [(key.encode('utf8'), self.envelope.dumps(data)) for key, data in mapping.items()]
+        with self._writing():
+            self._append(items)
+
+    def __delitem__(self, key):
+        encoded = key.encode('utf8')
+        with self._writing() as files:
+            record = files.find(encoded, _hash(encoded))[2]
+            if record is None or record[0] & RECORD_TOMBSTONE:
+                raise KeyError(key)
+            self._append([(encoded, b'')], RECORD_TOMBSTONE)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def ttl(self, key):
+        value = self._find(key)
+        if value is not None:
+            expiry = read_header(value[:HEADER_SIZE]).expiry
+            if expiry is not None:
+                return max(0, expiry - time()) or None
+
+    def garbage(self):
+        """Approximate number of bytes in the log which compaction would drop."""
+        files = self._current()
+        garbage = files.get(_GARBAGE)
+        for _, offset in files.slots():
+            record = files.record(offset)
+            if record is not None and not record[0] & RECORD_TOMBSTONE and self._is_dead(record[2]):
+                garbage += record[3]
+        return garbage
+
+    def needs_compaction(self):
+        files = self._current()
+        size = files.get(_INDEXED) - len(LOG_MAGIC)
+        return size > 0 and self.garbage() > size * self.compact_ratio
+
+    def compact(self):
+        """Rewrite the log and index with only the live values."""
+
+        with self._writing() as old:
+
+            generation = old.generation + 1
+            log_path, index_path = self._paths(generation)
+
+            live = []
+            for hash_, offset in old.slots():
+                record = old.record(offset)
+                if record is None or record[0] & RECORD_TOMBSTONE or self._is_dead(record[2]):
+                    continue
+                live.append((hash_, offset, record[3]))
+
+            capacity = self.capacity
+            while len(live) > capacity * self.max_load:
+                capacity *= 2
+            index, tmp_path = _new_index(index_path, capacity)
+
+            # Copy records in log order, to keep reads of the new log sequential.
+            live.sort(key=lambda item: item[1])
+            view = old.view(old.get(_INDEXED))
+            new_offset = len(LOG_MAGIC)
+            with open(log_path, 'wb') as fh:
+                fh.write(LOG_MAGIC)
+                for hash_, offset, size in live:
+                    fh.write(view[offset:offset + size])
+                    _insert(index, capacity, hash_, new_offset)
+                    new_offset += size
+                fh.flush()
+                os.fsync(fh.fileno())
+
+            _u64.pack_into(index, _USED, len(live))
+            _u64.pack_into(index, _INDEXED, new_offset)
+            index.flush()
+            os.rename(tmp_path, index_path)
+
+            self._write_generation(generation)
+            old.set(_RETIRED, 1)
+            self._files = _Files(generation, open(log_path, 'r+b', 0), index)
+            for path in self._paths(old.generation):
+                os.unlink(path)
+
+    def _compact_loop(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                if self.needs_compaction():
+                    self.compact()
+            except Exception:
+                log.exception('error while compacting %s' % self.path)
+
+    def close(self):
+        """Stop background compaction."""
+        self._closed.set()
@@ -1,43 +1,117 @@
-import time
+import math
 
 from django.conf import settings
 from django.core.cache import caches
 
+from .core import EXPIRY_INDEX, VALUE_INDEX
+from .time import time
+
+
+META_SUFFIX = '.meta'
+
 
 class Cache(object):
+    """Store which proxies to one of Django's caches.
+
+    Django drops values once their expiry times (rounded up to whole seconds,
+    which is all that Django supports) pass, so expired values are never
+    fetched.
+
+    :param str name: The name of the cache in ``settings.CACHES``.
+    :param bool separate_meta: Also store the metadata of each value (its data
+        tuple with a value of None) under its own key, so that etags and expiry
+        times are checked without fetching (large) values.
+    :param float grace: Seconds past their expiry for which Django keeps values
+        (e.g. to be served via the ``stale_ttl`` option).
+
     """
-    Will simply proxy cache calls to django's internal
-    cache framework
-    """
-    def __init__(self, name='default'):
+
+    def __init__(self, name='default', separate_meta=False, grace=0):
         self._cache = caches[name]
+        self.separate_meta = separate_meta
+        self.grace = grace
+
+    def _timeout(self, value):
+        """Seconds until Django should drop the data; None for never."""
+        expiry = value[EXPIRY_INDEX]
+        if expiry:
+            # Round up so that Django never drops a value before we would; as
+            # truncating sub-second timeouts to 0 would not store them at all.
+            seconds = expiry + self.grace - time()
+            return int(math.ceil(seconds)) if seconds > 0 else -1
+
+    def _with_meta(self, key, value):
+        items = {key: value}
+        if self.separate_meta:
+            items[key + META_SUFFIX] = value[:VALUE_INDEX] + (None, ) + value[VALUE_INDEX + 1:]
+        return items
+
+    def _keys(self, keys):
+        if not self.separate_meta:
+            return list(keys)
+        return [k for key in keys for k in (key, key + META_SUFFIX)]
 
     def get(self, key):
         return self._cache.get(key)
 
-    def delete(self, key):
-        return self._cache.delete(key)
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
 
-    def expire_at(self, key, max_age):
-        raise NotImplementedError('Unsupported by django cache backend')
+    @property
+    def meta(self):
+        if self.separate_meta:
+            return self._meta
 
-    def exists(self, key):
-        return self.get(key) is not None
+    def _meta(self, key):
+        return self._cache.get(key + META_SUFFIX)
 
-    def __getitem__(self):
-        return self.get(key)
+    def get_many(self, keys):
+        found = self._cache.get_many(keys)
+        return [found.get(key) for key in keys]
 
     def __setitem__(self, key, value):
-        expiry = value[2]
-        seconds = None
-        if expiry:
-            # this is a bit ugly, but django's cache framework
-            # requires an expiry in seconds
-            # to we reverse-compute that value from the expiry given in the
-            # data tuple
-            now = time.time()
-            seconds = int(expiry - now)
-        return self._cache.set(key, value, seconds)
-
-    def __delitem__(key):
-        return self.delete(key)
+        if self.separate_meta:
+            self._cache.set_many(self._with_meta(key, value), self._timeout(value))
+        else:
+            self._cache.set(key, value, self._timeout(value))
+
+    def set_many(self, mapping):
+        # Django can only set many values with the same timeout.
+        by_timeout = {}
+        for key, value in mapping.items():
+            by_timeout.setdefault(self._timeout(value), {}).update(self._with_meta(key, value))
+        for seconds, chunk in by_timeout.items():
+            self._cache.set_many(chunk, seconds)
+
+    def delete(self, key):
+        """Delete a key; returns if it existed."""
+        if self.separate_meta:
+            self._cache.delete(key + META_SUFFIX)
+        return bool(self._cache.delete(key))
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def delete_many(self, keys):
+        self._cache.delete_many(self._keys(keys))
+
+    def expire_at(self, key, expiry):
+        """Set the expiry time of a key; raises KeyError if it does not exist.
+
+        The data tuple is rewritten, as it carries the expiry time (which
+        Django's ``touch`` would leave as it was).
+
+        """
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        self[key] = data[:EXPIRY_INDEX] + (expiry, ) + data[EXPIRY_INDEX + 1:]
+
+    def exists(self, key):
+        return self._cache.has_key(key)
+
+    __contains__ = exists
@@ -0,0 +1,60 @@
+"""In-process single-flight calls.
+
+Threads which ask for the same key while a value is being computed wait on
+the first thread's call and share its result, instead of all computing it.
+
+"""
+
+import sys
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def run(self, key, func, args=(), timeout=None):
+        """Call ``func(*args)``, or wait for an identical call to finish.
+
+        Waiters that are not done within ``timeout`` seconds give up and call
+        ``func`` themselves. Exceptions are raised in every waiter.
+
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.event.wait(timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.value
+            return func(*args)
+
+        try:
+            call.value = func(*args)
+        except BaseException:
+            call.error = sys.exc_info()[1]
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.value
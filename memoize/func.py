@@ -1,12 +1,216 @@
 import inspect
 import sys
+import uuid
+import weakref
 
 if sys.version_info[0] >= 3:
     getargspec = lambda func: inspect.getfullargspec(func)[:4]
 else:
     getargspec = inspect.getargspec
 
-from .options import OptionProperty
+from .options import OptionProperty, VersionedDict, readonly
+
+
+def _inspect(func):
+    try:
+        spec_args, varargs, varkw, spec_defaults = getargspec(func)
+    except TypeError:
+        # Builtins and other callables without an inspectable signature; we
+        # can only key them on exactly what they were called with.
+        spec_args, varargs, varkw, spec_defaults = (), True, True, None
+    return tuple(spec_args), varargs, varkw, tuple(spec_defaults or ())
+
+
+def compile_normalizer(func):
+    """Build a ``normalize(args, kwargs)`` function specialized for ``func``.
+
+    It returns the positional arguments (including those passed by keyword,
+    and any defaults) as a list, and a dict of the remaining keywords.
+    Keywords passed to the returned function are never mutated.
+
+    """
+
+    spec_args, varargs, varkw, spec_defaults = _inspect(func)
+    offset = len(spec_args) - len(spec_defaults)
+
+    def normalize(args, kwargs):
+
+        # We need to normalize the signature of the function. This is only
+        # really possible if we wrap the "real" function.
+        if kwargs:
+
+            # Insert kwargs into the args list by name.
+            kwargs = dict(kwargs)
+            orig_args = args
+            args = []
+            used = 0
+            for name in spec_args:
+                if name in kwargs:
+                    args.append(kwargs.pop(name))
+                elif used < len(orig_args):
+                    args.append(orig_args[used])
+                    used += 1
+                else:
+                    break
+            args.extend(orig_args[used:])
+
+        else:
+            args = list(args)
+
+        # Add on as many defaults as we need to.
+        if spec_defaults:
+            args.extend(spec_defaults[len(args) - offset:])
+
+        return args, kwargs
+
+    return normalize
+
+
+def key_repr(value):
+    """The ``repr`` of an argument in keys; via its ``__memokey__`` if it has one.
+
+    So that e.g. two instances of a model with the same primary key have the
+    same keys, however they ``repr``. Only the arguments themselves are
+    checked, not their contents.
+
+    """
+    cls = type(value)
+    memokey = getattr(cls, '__memokey__', None)
+    if memokey is None:
+        return repr(value)
+    name = '%s.%s' % (cls.__module__, getattr(cls, '__qualname__', cls.__name__))
+    return '<%s %r>' % (name, memokey(value))
+
+
+def key_prefix(func, master_key=None):
+    prefix = '%s.%s' % (func.__module__, func.__name__)
+    if master_key:
+        prefix = master_key + ':' + prefix
+    return prefix
+
+
+def compile_key(func, master_key=None):
+    """Build a ``key(args, kwargs)`` function specialized for ``func``.
+
+    The signature is inspected once here instead of on every call, and the
+    common shapes (no arguments, no defaults, no keywords) get a fast path
+    which skips the normalization entirely.
+
+    """
+
+    spec_args, varargs, varkw, spec_defaults = _inspect(func)
+    num_args = len(spec_args)
+    offset = num_args - len(spec_defaults)
+
+    prefix = key_prefix(func, master_key) + '('
+    normalize = compile_normalizer(func)
+
+    def generic_key(args, kwargs):
+
+        args, kwargs = normalize(args, kwargs)
+
+        arg_str_chunks = list(map(key_repr, args))
+        if kwargs:
+            for name, value in kwargs.items():
+                arg_str_chunks.append('%s=%s' % (name, key_repr(value)))
+
+        return prefix + ', '.join(arg_str_chunks) + ')'
+
+    if not (spec_args or varargs or varkw):
+        constant = prefix + ')'
+        def zero_arg_key(args, kwargs):
+            if args or kwargs:
+                return generic_key(args, kwargs)
+            return constant
+        return zero_arg_key
+
+    if not spec_defaults:
+        def positional_key(args, kwargs):
+            if kwargs:
+                return generic_key(args, kwargs)
+            return prefix + ', '.join(map(key_repr, args)) + ')'
+        return positional_key
+
+    def default_key(args, kwargs):
+        if kwargs:
+            return generic_key(args, kwargs)
+        if len(args) < num_args:
+            args = tuple(args) + spec_defaults[len(args) - offset:]
+        return prefix + ', '.join(map(key_repr, args)) + ')'
+    return default_key
+
+
+def key_function(func, master_key=None, strategy=None):
+    """Build the key function for ``func`` with the given ``key_strategy``."""
+    if strategy is None or strategy == 'repr':
+        return compile_key(func, master_key)
+    if strategy == 'hash':
+        from .keys import compile_hashed_key
+        return compile_hashed_key(func, master_key)
+    if callable(strategy):
+        return strategy(func, master_key)
+    raise ValueError('unknown key_strategy %r' % (strategy, ))
+
+
+class InstanceKey(str):
+    """Stands in for an instance in the keys of ``per_instance`` methods."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return str(self)
+
+
+def instance_key(obj):
+    """A key unique to ``obj``."""
+    cls = type(obj)
+    name = '%s.%s' % (cls.__module__, getattr(cls, '__qualname__', cls.__name__))
+    # Not its id, as those are reused (and differ between processes).
+    return InstanceKey('<%s #%s>' % (name, uuid.uuid4().hex))
+
+
+# How many keys of each instance are deleted once it is gone; any more are
+# left to expire.
+MAX_INSTANCE_KEYS = 256
+
+
+class InstanceState(object):
+    """What ``per_instance`` methods keep on instances without a ``__memokey__``.
+
+    Only the instance's token and the keys written with it; nothing which
+    refers back to the instance, so it is freed as soon as it is unused.
+
+    """
+
+    __slots__ = ('identity', 'keys', 'owner')
+
+    def __init__(self, obj):
+        self.identity = instance_key(obj)
+        self.keys = set()
+        # Copies of the instance have copies of its __dict__.
+        self.owner = weakref.ref(obj)
+
+    def __reduce__(self):
+        # Pickled (or deep-copied) instances get their own.
+        return _unpickle_none, ()
+
+
+def _unpickle_none():
+    return None
+
+
+class CompiledKey(object):
+    """The key function of a :class:`MemoizedFunction`, compiled on first use."""
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        cell = obj._compiled
+        if cell[0] is None:
+            strategy = obj._resolved_opts().get('key_strategy')
+            cell[0] = key_function(obj.func, obj.master_key, strategy)
+        key = obj._key = cell[0]
+        return key
 
 
 class MemoizedFunction(object):
@@ -15,6 +219,8 @@ class MemoizedFunction(object):
     max_age = OptionProperty('max_age')
     expiry = OptionProperty('expiry')
 
+    _key = CompiledKey()
+
     def __init__(self, cache, func, master_key, opts, args=None, kwargs=None):
         self.cache = cache
         self.func = func
@@ -22,26 +228,105 @@ class MemoizedFunction(object):
         self.opts = opts
         self.args = args or ()
         self.kwargs = kwargs or {}
+        # The region may not be defined yet, so these options are read on
+        # first use: the compiled key (shared with bound copies), and whether
+        # we are per_instance.
+        self._compiled = [None]
+        self._per_instance = None
+
+        # Where per_instance methods keep their InstanceState on instances,
+        # and the keys of those which are gone, to delete on the next access.
+        self._state_name = '_memoized_%s_%x' % (func.__name__, id(self))
+        self._purge_keys = []
+
+        # Shared with bound copies: [options view, regions version, opts version].
+        self._resolved = [None, None, None]
+
+    @property
+    def opts(self):
+        return self._opts
+
+    @opts.setter
+    def opts(self, opts):
+        self._opts = opts if isinstance(opts, VersionedDict) else VersionedDict(opts)
 
     def __get__(self, obj, owner=None):
-        if obj is not None:
-            return self.bind(obj)
-        else:
+        if obj is None:
             return self
+        per_instance = self._per_instance
+        if per_instance is None:
+            per_instance = self._per_instance = bool(self._resolved_opts().get('per_instance'))
+        if per_instance:
+            return self._bind_instance(obj)
+        return self.bind(obj)
+
+    def _bind_instance(self, obj):
+        """Create the BoundMethod for obj, without the ``repr`` of it in keys.
+
+        Instances with a ``__memokey__`` are keyed on it as usual (so on every
+        call, in case it changes), and others on the token in their
+        :class:`InstanceState`. The keys written with a token are deleted on
+        the next access after its instance is gone (not from within the
+        garbage collector).
+
+        """
+
+        if self._purge_keys:
+            self._purge()
+
+        key = self._key
+        if getattr(type(obj), '__memokey__', None) is None:
+            try:
+                state = obj.__dict__.get(self._state_name)
+                if state is None or state.owner() is not obj:
+                    state = obj.__dict__[self._state_name] = InstanceState(obj)
+                    weakref.finalize(obj, self._purge_keys.extend, state.keys)
+            except (AttributeError, TypeError):
+                # Without a __dict__ (or weak references); bound as usual.
+                return self.bind(obj)
+            identity = state.identity
+            written = state.keys
+
+            def bound_key(args, kwargs):
+                result = key((identity, ) + tuple(args[1:]), kwargs)
+                if len(written) < MAX_INSTANCE_KEYS:
+                    written.add(result)
+                return result
+
+        else:
+            bound_key = key
+
+        bound = object.__new__(self._bound_class)
+        bound.__dict__.update(self.__dict__)
+        bound._instance = obj
+        bound._key = bound_key
+        return bound
+
+    def _take_purge_keys(self):
+        keys = self._purge_keys[:]
+        del self._purge_keys[:len(keys)]
+        # Tags which are functions of the arguments can't be found again.
+        if callable(self._resolved_opts().get('tags')):
+            return []
+        return keys
+
+    def _purge(self):
+        """Delete the values of instances which are gone."""
+        keys = self._take_purge_keys()
+        if keys:
+            self.cache.delete_many(keys, **self._opts)
 
     def __repr__(self):
         return '<%s of %s via %s>' % (self.__class__.__name__, self.func, self.cache)
 
     def bind(self, *args, **kwargs):
         args, kwargs = self._expand_args(args, kwargs)
-        return self.__class__(
-            self.cache,
-            self.func,
-            self.master_key,
-            self.opts,
-            args,
-            kwargs,
-        )
+        # Copy everything else, including the compiled key and option caches.
+        bound = object.__new__(self.__class__)
+        bound.__dict__.update(self.__dict__)
+        bound.args = args
+        bound.kwargs = kwargs
+        return bound
 
     def _expand_args(self, args, new_kwargs):
         args = self.args + args
@@ -49,79 +334,146 @@ class MemoizedFunction(object):
         kwargs.update(new_kwargs or {})
         return args, kwargs
 
-    def _expand_opts(self, opts):
-        for k, v in self.opts.items():
-            opts.setdefault(k, v)
+    def _expand_opts(self, opts, args=None, kwargs=None):
+        """Merge the given options over ours (and those of our region).
 
-    def key(self, args=(), kwargs=None):
+        With arguments, options which may be functions of them are resolved,
+        wherever they were set.
 
-        # We need to normalize the signature of the function. This is only
-        # really possible if we wrap the "real" function.
-        kwargs = kwargs or {}
-        spec_args, _, _, spec_defaults = getargspec(self.func)
-
-        # Insert kwargs into the args list by name.
-        orig_args = list(args)
-        args = []
-        for i, name in enumerate(spec_args):
-            if name in kwargs:
-                args.append(kwargs.pop(name))
-            elif orig_args:
-                args.append(orig_args.pop(0))
-            else:
-                break
-
-        args.extend(orig_args)
+        """
+        opts = self._merge_opts(opts)
+        if args is not None:
+            self.cache._resolve_dynamic_opts(opts, args, kwargs)
+        return opts
 
-        # Add on as many defaults as we need to.
-        if spec_defaults:
-            offset = len(spec_args) - len(spec_defaults)
-            args.extend(spec_defaults[len(args) - offset:])
+    def _expiry_opts(self, opts, args, kwargs):
+        """Options for setting the expiry; which overrides ours."""
+        opts = self._expand_opts(opts, args, kwargs)
+        del opts['max_age'], opts['expiry']
+        return opts
+
+    def _resolved_opts(self):
+        """Read-only view of our options merged over those of our region.
+
+        This is cached until either our options or the regions are modified.
 
-        arg_str_chunks = list(map(repr, args))
-        for pair in kwargs.items():
-            arg_str_chunks.append('%s=%r' % pair)
-        arg_str = ', '.join(arg_str_chunks)
+        """
+        cell = self._resolved
+        view = cell[0]
+        regions_version = self.cache._regions.version
+        if view is None or cell[1] != regions_version or cell[2] != self._opts.version:
+            view = readonly(self.cache._resolve_opts(self._opts))
+            cell[:] = [view, regions_version, self._opts.version]
+        return view
 
-        key = '%s.%s(%s)' % (self.func.__module__, self.func.__name__, arg_str)
-        return self.master_key + ':' + key if self.master_key else key
+    def _merge_opts(self, opts):
+        """Resolve the given options over ours (and those of our region)."""
+        if 'region' in opts:
+            # A different region; we need to start from scratch.
+            merged = dict(self._opts)
+            merged.update(opts)
+            return self.cache._resolve_opts(merged)
+        merged = dict(self._resolved_opts())
+        merged.update(opts)
+        return merged
+
+    def key(self, args=(), kwargs=None):
+        return self._key(args, kwargs)
 
     def __call__(self, *args, **kwargs):
-        args, copy_kwargs = self._expand_args(args, kwargs)
-        return self.cache.get(self.key(args, copy_kwargs), self.func, args, kwargs, **self.opts)
+        args, kwargs = self._expand_args(args, kwargs)
+        return self.cache._get(self._key(args, kwargs), self.func, args, kwargs, dict(self._resolved_opts()))
 
     def get(self, args=(), kwargs=None, **opts):
         args, kwargs = self._expand_args(args, kwargs)
-        self._expand_opts(opts)
-        return self.cache.get(self.key(args, kwargs), self.func, args, kwargs, **opts)
+        return self.cache._get(self._key(args, kwargs), self.func, args, kwargs, self._merge_opts(opts))
+
+    def _expand_many(self, iterable):
+        """Keys, args, and kwargs for each tuple of positional arguments."""
+        args_list = []
+        kwargs_list = []
+        keys = []
+        for args in iterable:
+            args, kwargs = self._expand_args(tuple(args), None)
+            args_list.append(args)
+            kwargs_list.append(kwargs)
+            keys.append(self._key(args, kwargs))
+        return keys, args_list, kwargs_list
+
+    def map(self, iterable, func_many=None, **opts):
+        """Call the function for each tuple of positional arguments.
+
+        All values are fetched from the store at once, and only the missing
+        ones are calculated; via one call of ``func_many`` (see
+        :meth:`Memoizer.get_many`) if provided.
+
+        """
+        opts = self._expand_opts(opts)
+        keys, args_list, kwargs_list = self._expand_many(iterable)
+        return self.cache.get_many(keys, self.func, args_list, kwargs_list, func_many, **opts)
+
+    def warm(self, iterable, workers=4, executor=None, progress=None, **opts):
+        """Calculate and store values for each tuple of positional arguments.
+
+        Values which are already stored are skipped. See :meth:`Memoizer.warm`.
+
+        """
+        opts = self._expand_opts(opts)
+        keys, args_list, kwargs_list = self._expand_many(iterable)
+        return self.cache.warm(keys, self.func, args_list, kwargs_list, workers,
+            executor, progress, **opts)
 
     def delete(self, args=(), kwargs=None, **opts):
         args, kwargs = self._expand_args(args, kwargs)
-        self._expand_opts(opts)
-        self.cache.delete(self.key(args, kwargs))
+        opts = self._expand_opts(opts, args, kwargs)
+        self.cache.delete(self.key(args, kwargs), **opts)
 
     def expire(self, max_age, args=(), kwargs=None, **opts):
         args, kwargs = self._expand_args(args, kwargs)
-        self._expand_opts(opts)
-        self.cache.expire(self.key(args, kwargs), max_age)
+        opts = self._expiry_opts(opts, args, kwargs)
+        self.cache.expire(self.key(args, kwargs), max_age, **opts)
 
     def expire_at(self, max_age, args=(), kwargs=None, **opts):
         args, kwargs = self._expand_args(args, kwargs)
-        self._expand_opts(opts)
-        self.cache.expire_at(self.key(args, kwargs), max_age)
+        opts = self._expiry_opts(opts, args, kwargs)
+        self.cache.expire_at(self.key(args, kwargs), max_age, **opts)
 
     def ttl(self, args=(), kwargs=None, **opts):
         args, kwargs = self._expand_args(args, kwargs)
-        self._expand_opts(opts)
-        return self.cache.ttl(self.key(args, kwargs))
+        opts = self._expand_opts(opts, args, kwargs)
+        return self.cache.ttl(self.key(args, kwargs), **opts)
 
     def exists(self, args=(), kwargs=None, **opts):
         args, kwargs = self._expand_args(args, kwargs)
-        self._expand_opts(opts)
-        return self.cache.exists(self.key(args, kwargs))
+        opts = self._expand_opts(opts, args, kwargs)
+        return self.cache.exists(self.key(args, kwargs), **opts)
 
     def last_etag(self, args=(), kwargs=None, **opts):
         args, kwargs = self._expand_args(args, kwargs)
-        self._expand_opts(opts)
-        return self.cache.etag(self.key(args, kwargs))
-    
\ No newline at end of file
+        opts = self._expand_opts(opts, args, kwargs)
+        return self.cache.etag(self.key(args, kwargs), **opts)
+    
+
+class BoundMethod(MemoizedFunction):
+    """A ``per_instance`` method bound to its instance.
+
+    It is keyed on the instance's ``__memokey__`` if it has one; otherwise on
+    a token unique to it, in which case its values are deleted once it is gone
+    (up to :data:`MAX_INSTANCE_KEYS` of them; any more are left to expire).
+
+    """
+
+    def __repr__(self):
+        return '<%s of %s on %r via %s>' % (self.__class__.__name__, self.func,
+            self._instance, self.cache)
+
+    def __reduce__(self):
+        # Pickled (or deep-copied) instances bind afresh.
+        return _unpickle_none, ()
+
+    def _expand_args(self, args, new_kwargs):
+        args, kwargs = MemoizedFunction._expand_args(self, args, new_kwargs)
+        return (self._instance, ) + args, kwargs
+
+
+MemoizedFunction._bound_class = BoundMethod
@@ -0,0 +1,159 @@
+"""Hashed keys, for functions with large arguments.
+
+The default keys of memoized functions include the ``repr`` of every
+argument, which can be huge. With ``key_strategy='hash'`` they are instead
+the function's name followed by a digest of a canonical encoding of the
+(normalized) arguments, so their length is bounded::
+
+    @memo(key_strategy='hash')
+    def func(rows): pass
+
+    func.key(([1, 2, 3], ))
+    # return > 'mymodule.func:3b56faf6eebce94df4847833ff353b48'
+
+Arguments are encoded by type, so that ``1``, ``1.0``, ``'1'`` and ``True``
+have different keys, as do ``[1]`` and ``(1, )``. Dicts and sets are encoded
+in a stable order. Buffers (e.g. bytes, and NumPy arrays) are hashed directly
+without copying where possible, and pandas objects via
+``pandas.util.hash_pandas_object``.
+
+An object may define a ``__memokey__()`` method which returns something (of
+any supported type) to encode in its place. For classes you can't modify, use
+:func:`register_memokey`. Anything else is encoded via its type and ``repr``.
+
+"""
+
+import hashlib
+
+from .func import InstanceKey, compile_normalizer, key_prefix
+
+
+DEFAULT_DIGEST_SIZE = 16
+
+_memokeys = {InstanceKey: str}
+
+
+def register_memokey(cls, func):
+    """Register a function to call (in place of ``__memokey__``) for ``cls``."""
+    _memokeys[cls] = func
+
+
+def _pandas_memokey(value):
+    import pandas
+    key = [type(value).__name__, pandas.util.hash_pandas_object(value, index=True).values]
+    columns = getattr(value, 'columns', None)
+    if columns is not None:
+        key.append(list(columns))
+    return key
+
+
+def _find_memokey(cls):
+    for base in cls.__mro__:
+        func = _memokeys.get(base)
+        if func is not None:
+            return func
+    func = getattr(cls, '__memokey__', None)
+    if func is None and cls.__module__.split('.', 1)[0] == 'pandas':
+        func = _pandas_memokey
+    return func
+
+
+def _atom(update, tag, data):
+    update(b'%s%d:' % (tag, len(data)))
+    update(data)
+
+
+def _encode(update, value):
+
+    cls = type(value)
+
+    if value is None:
+        update(b'N')
+    elif cls is bool:
+        update(b'T' if value else b'F')
+    elif cls is int:
+        _atom(update, b'i', b'%d' % value)
+    elif cls is float:
+        _atom(update, b'f', repr(value).encode('ascii'))
+    elif cls is str:
+        _atom(update, b'u', value.encode('utf8', 'surrogatepass'))
+    elif cls is bytes:
+        _atom(update, b'b', value)
+
+    elif cls is tuple or cls is list:
+        update(b'%s%d:' % (b't' if cls is tuple else b'l', len(value)))
+        for item in value:
+            _encode(update, item)
+
+    elif cls is dict:
+        items = sorted((canonical(k), canonical(v)) for k, v in value.items())
+        update(b'd%d:' % len(items))
+        for k, v in items:
+            update(k)
+            update(v)
+
+    elif cls is set or cls is frozenset:
+        items = sorted(canonical(item) for item in value)
+        update(b's%d:' % len(items))
+        for item in items:
+            update(item)
+
+    else:
+        memokey = _find_memokey(cls)
+        if memokey is not None:
+            update(b'k')
+            _encode(update, memokey(value))
+            return
+
+        try:
+            view = memoryview(value)
+        except TypeError:
+            view = None
+        if view is not None:
+            # The type matters, as e.g. arrays of different dtypes may have
+            # the same bytes.
+            _atom(update, b'm', ('%s.%s %s %r' % (cls.__module__, cls.__name__,
+                view.format, view.shape)).encode('utf8'))
+            if not view.c_contiguous:
+                view = view.tobytes()
+            elif view.ndim != 1 or view.format != 'B':
+                view = view.cast('B')
+            _atom(update, b'B', view)
+            return
+
+        _atom(update, b'r', ('%s.%s %r' % (cls.__module__, cls.__name__, value)).encode('utf8'))
+
+
+def canonical(value):
+    """Encode ``value`` as stable bytes; equal values have equal encodings."""
+    chunks = []
+    _encode(chunks.append, value)
+    return b''.join(chunks)
+
+
+def hash_args(args, kwargs=None, digest_size=DEFAULT_DIGEST_SIZE):
+    """Hex digest of the canonical encoding of arguments."""
+    hasher = hashlib.blake2b(digest_size=digest_size)
+    update = hasher.update
+    _encode(update, tuple(args))
+    if kwargs:
+        _encode(update, kwargs)
+    return hasher.hexdigest()
+
+
+def compile_hashed_key(func, master_key=None, digest_size=DEFAULT_DIGEST_SIZE):
+    """Build a ``key(args, kwargs)`` function for ``func`` which hashes arguments.
+
+    Keys are the function's name (after ``master_key``, if given), a colon, and
+    ``2 * digest_size`` hex digits.
+
+    """
+
+    prefix = key_prefix(func, master_key) + ':'
+    normalize = compile_normalizer(func)
+
+    def hashed_key(args, kwargs):
+        args, kwargs = normalize(args, kwargs)
+        return prefix + hash_args(args, kwargs, digest_size)
+
+    return hashed_key
@@ -0,0 +1,168 @@
+"""Store which keeps each value in its own file, read back via mmap.
+
+Values are encoded with :class:`memoize.codec.Envelope`. Out-of-band buffers
+(such as those of NumPy arrays, and bytes values by default) are returned as
+read-only views of the mapped file, so large values are never copied on a
+hit. Files are replaced atomically, and existing views remain valid after
+their file is replaced or deleted.
+
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import struct
+import uuid
+
+from .codec import Envelope, PickleCodec, HEADER_SIZE, read_header
+from .core import EXPIRY_INDEX
+from .time import time
+
+
+_key_length = struct.Struct('>I')
+
+
+class MmapStore(object):
+    """File-per-key store for large values.
+
+    :param str path: Directory to keep the files in; created if needed.
+    :param envelope: A :class:`memoize.codec.Envelope`; by default one which
+        returns bytes values as memoryviews. Compression defeats zero-copy.
+    :param float grace: Seconds past their expiry for which files are kept.
+
+    """
+
+    def __init__(self, path, envelope=None, grace=0):
+        self.path = path
+        self.envelope = envelope or Envelope(PickleCodec(bytes_as_views=True))
+        self.grace = grace
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _open(self, key):
+        """Map the file for key; returns (view, offset of envelope) or None."""
+
+        try:
+            fh = open(self._path(key), 'rb')
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        with fh:
+            if not os.fstat(fh.fileno()).st_size:
+                return None
+            view = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+
+        # Hashes may collide; the full key is stored in the file.
+        encoded = key.encode('utf8')
+        size, = _key_length.unpack_from(view)
+        offset = _key_length.size + size
+        if view[_key_length.size:offset] != encoded:
+            return None
+
+        return view, offset
+
+    def _is_dead(self, expiry):
+        return bool(expiry) and expiry + self.grace < time()
+
+    def get(self, key):
+        found = self._open(key)
+        if found is None:
+            return None
+        view, offset = found
+        if self._is_dead(read_header(view[offset:offset + HEADER_SIZE]).expiry):
+            self._remove(key)
+            return None
+        return self.envelope.loads(view[offset:])
+
+    def meta(self, key):
+        """The data tuple for a key without decoding its value (which is None)."""
+        found = self._open(key)
+        if found is None:
+            return None
+        view, offset = found
+        data = self.envelope.loads_meta(view[offset:])
+        if self._is_dead(data[EXPIRY_INDEX]):
+            return None
+        return data
+
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def __setitem__(self, key, data):
+
+        path = self._path(key)
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        encoded = key.encode('utf8')
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as fh:
+                fh.write(_key_length.pack(len(encoded)))
+                fh.write(encoded)
+                fh.write(self.envelope.dumps(data))
+            os.rename(tmp_path, path) # Atomic replace on POSIX.
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _remove(self, key):
+        try:
+            os.unlink(self._path(key))
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def __delitem__(self, key):
+        if self._open(key) is None or not self._remove(key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def ttl(self, key):
+        found = self._open(key)
+        if found is None:
+            return None
+        view, offset = found
+        expiry = read_header(view[offset:offset + HEADER_SIZE]).expiry
+        if expiry is not None:
+            return max(0, expiry - time()) or None
+
+    def purge(self):
+        """Remove the files of all expired values."""
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            for name in file_names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    with open(path, 'rb') as fh:
+                        size, = _key_length.unpack(fh.read(_key_length.size))
+                        fh.seek(size, os.SEEK_CUR)
+                        expiry = read_header(fh.read(HEADER_SIZE)).expiry
+                except (IOError, OSError, struct.error, ValueError):
+                    continue
+                if self._is_dead(expiry):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
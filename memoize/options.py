@@ -1,5 +1,80 @@
+import itertools
 from functools import partial
-from collections import Callable
+try:
+    from collections.abc import Callable
+except ImportError: # Python 2.
+    from collections import Callable
+
+
+try:
+    from types import MappingProxyType as readonly
+except ImportError: # Python 2.
+    readonly = dict
+
+
+# Shared between all VersionedDicts so that a replaced dict can never be
+# mistaken for the original.
+_versions = itertools.count(1)
+
+
+class VersionedDict(dict):
+    """A dict which gets a new `version` whenever it (or a child) is modified."""
+
+    _parent = None
+
+    def __init__(self, *args, **kwargs):
+        super(VersionedDict, self).__init__()
+        self.version = next(_versions)
+        self.update(*args, **kwargs)
+
+    def _changed(self):
+        self.version = next(_versions)
+        if self._parent is not None:
+            self._parent._changed()
+
+    def _adopt(self, value):
+        return value
+
+    def __setitem__(self, key, value):
+        super(VersionedDict, self).__setitem__(key, self._adopt(value))
+        self._changed()
+
+    def __delitem__(self, key):
+        super(VersionedDict, self).__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            super(VersionedDict, self).__setitem__(key, self._adopt(value))
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, *args):
+        value = super(VersionedDict, self).pop(*args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super(VersionedDict, self).popitem()
+        self._changed()
+        return item
+
+    def clear(self):
+        super(VersionedDict, self).clear()
+        self._changed()
+
+
+class RegionDict(VersionedDict):
+    """Mapping of region names to their (versioned) option dicts."""
+
+    def _adopt(self, value):
+        region = VersionedDict(value)
+        region._parent = self
+        return region
 
 
 def call_or_pass(value, args, kwargs):
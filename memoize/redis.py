@@ -1,68 +1,278 @@
-"""Redis lock and store wrapper.
+"""Redis lock and store.
 
-The lock implementation was mostly lifted from
-http://chris-lamb.co.uk/2010/06/07/distributing-locking-python-and-redis/
+The lock implementation follows the single instance pattern from
+https://redis.io/commands/set and https://redis.io/topics/distlock
 
 """
 
-import shelve
+from __future__ import absolute_import
 
-from .time import time, sleep
+import math
+import pickle
+import uuid
+
+from .core import EXPIRY_INDEX
+from .time import time
+
+try:
+    from time import monotonic as _monotonic
+except ImportError: # Python 2.
+    from time import time as _monotonic
+
+
+# Bytes to read for metadata, which covers the header and most etags.
+META_PREFETCH = 128
 
 
 class Lock(object):
 
-    def __init__(self, db, key, expires=60):
+    # Only delete the lock if we still own it, and wake up anyone waiting.
+    release_script = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            redis.call('del', KEYS[1])
+            redis.call('publish', KEYS[1], 'released')
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, db, key, expires=60, poll_interval=1.0):
         """
-        Distributed locking using Redis SETNX and GETSET.
+        Distributed locking using Redis SET NX PX.
 
         Usage::
 
-            with Lock('my_lock'):
-                print "Critical section"
+            lock = Lock(db, 'my_lock')
+            if lock.acquire(timeout=10):
+                try:
+                    print("Critical section")
+                finally:
+                    lock.release()
 
-        :param  expires     We consider any existing lock older than
-                            ``expires`` seconds to be invalid in order to
-                            detect crashed clients. This value must be higher
-                            than it takes the critical section to execute.
-        :param  timeout     If another client has already obtained the lock,
-                            sleep for a maximum of ``timeout`` seconds before
-                            giving up. A value of 0 means we never wait.
+        :param  expires     Redis drops the lock after ``expires`` seconds in
+                            order to recover from crashed clients. This value
+                            must be higher than it takes the critical section
+                            to execute.
+        :param  poll_interval   Waiters are woken via pub/sub when the lock is
+                            released, but will also check at least this often
+                            in case the lock expired instead.
         """
 
         self.db = db
         self.key = key
         self.expires = expires
+        self.poll_interval = poll_interval
+        self.token = None
+
+    def _try_acquire(self):
+        token = uuid.uuid4().hex
+        if self.db.set(self.key, token, nx=True, px=int(self.expires * 1000)):
+            self.token = token
+            return True
+        return False
 
     def acquire(self, timeout):
-        delay = 0.1
-        while timeout >= 0:
-            expires = time() + self.expires + 1
 
-            if self.db.setnx(self.key, expires):
-                # We gained the lock; enter critical section
-                return True
+        if self._try_acquire():
+            return True
+        if timeout <= 0:
+            return False
 
-            current_value = self.db.get(self.key)
+        deadline = _monotonic() + timeout
+        pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.key)
+        try:
+            while True:
 
-            # We found an expired lock and nobody raced us to replacing it
-            if current_value and float(current_value) < time() and \
-               self.db.getset(self.key, expires) == current_value:
+                # Try again now that we are subscribed, since it may have been
+                # released before we were listening.
+                if self._try_acquire():
                     return True
 
-            sleep(min(timeout, delay))
-            timeout -= delay
-            delay *= 2
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    return False
 
-        return False
+                # Wait at most until the lock would expire by itself.
+                wait = min(remaining, self.poll_interval)
+                pttl = self.db.pttl(self.key)
+                if pttl is not None and pttl >= 0:
+                    wait = min(wait, pttl / 1000.0)
+                pubsub.get_message(timeout=wait)
+
+        finally:
+            pubsub.close()
 
     def release(self):
-        self.db.delete(self.key)
+        token, self.token = self.token, None
+        if token is not None:
+            script = self.db.register_script(self.release_script)
+            script(keys=[self.key], args=[token])
+
+
+class PickleSerializer(object):
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, data):
+        return pickle.dumps(data, self.protocol)
+
+    def loads(self, raw):
+        return pickle.loads(raw)
+
+
+class Store(object):
+    """Redis store which sets native expiry times.
+
+    :param redis: A ``redis.Redis`` client; one is created from ``url`` (and a
+        shared connection pool) if not given.
+    :param str url: Redis URL to connect to if no client is given.
+    :param serializer: Object with ``dumps(data)`` and ``loads(raw)`` methods
+        used to encode the data tuples; pickle by default. With a
+        :class:`memoize.codec.Envelope`, etags and expiry times are checked
+        (via :attr:`meta`) by reading only the start of values.
+    :param float grace: Seconds past their expiry for which Redis keeps values
+        (e.g. to be served via the ``stale_ttl`` option).
+    :param lock_class: Called with ``(redis, key)`` to construct locks.
+
+    """
+
+    def __init__(self, redis=None, url='redis://localhost:6379/0', serializer=None,
+        grace=0, lock_class=Lock):
+
+        if redis is None:
+            import redis as redis_module
+            pool = redis_module.ConnectionPool.from_url(url)
+            redis = redis_module.Redis(connection_pool=pool)
+
+        self.redis = redis
+        self.serializer = serializer or PickleSerializer()
+        self.grace = grace
+        self.lock_class = lock_class
+
+    def _px(self, data):
+        """Milliseconds until Redis should drop the data; None for never."""
+        expiry = data[EXPIRY_INDEX]
+        if expiry:
+            # Round up so that Redis never drops a value before we would.
+            return int(math.ceil((expiry + self.grace - time()) * 1000))
+
+    def _loads(self, raw):
+        return None if raw is None else self.serializer.loads(raw)
+
+    def get(self, key):
+        return self._loads(self.redis.get(key))
+
+    @property
+    def meta(self):
+        """``meta(key)`` if the serializer can decode metadata alone, else None."""
+        if hasattr(self.serializer, 'loads_meta'):
+            return self._meta
+
+    def _meta(self, key):
+        raw = self.redis.getrange(key, 0, META_PREFETCH - 1)
+        if not raw:
+            return None
+        size = self.serializer.meta_size(raw)
+        if size > len(raw):
+            raw = self.redis.getrange(key, 0, size - 1)
+        return self.serializer.loads_meta(raw)
+
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [self._loads(raw) for raw in self.redis.mget(keys)]
+
+    def _set(self, redis, key, data):
+        px = self._px(data)
+        if px is not None and px <= 0:
+            redis.delete(key)
+        else:
+            redis.set(key, self.serializer.dumps(data), px=px)
+
+    def __setitem__(self, key, data):
+        self._set(self.redis, key, data)
+
+    def set_many(self, mapping):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, data in mapping.items():
+            self._set(pipe, key, data)
+        pipe.execute()
+
+    def __delitem__(self, key):
+        if not self.redis.delete(key):
+            raise KeyError(key)
+
+    def delete_many(self, keys):
+        if keys:
+            self.redis.delete(*keys)
+
+    def __contains__(self, key):
+        return bool(self.redis.exists(key))
+
+    def ttl(self, key):
+        # Negative values signal a missing key or one without an expiry.
+        pttl = self.redis.pttl(key)
+        if pttl is None or pttl < 0:
+            return None
+        return max(0, pttl / 1000.0 - self.grace) or None
+
+    def lock(self, key):
+        return self.lock_class(self.redis, key + '.lock')
+
+
+class Invalidator(object):
+    """Fan out key invalidations to peers via Redis pub/sub.
+
+    For use with :class:`memoize.stores.TieredStore`, so that setting or
+    deleting a key in one process drops it from the local tier of the others.
+    Messages from ourselves are ignored.
+
+    """
+
+    def __init__(self, redis, channel='memoize:invalidate', sleep_time=0.1):
+        self.redis = redis
+        self.channel = channel
+        self.sleep_time = sleep_time
+        self.id = uuid.uuid4().hex
+        self._callbacks = []
+        self._pubsub = None
+        self._thread = None
+
+    def publish(self, key):
+        self.redis.publish(self.channel, '%s %s' % (self.id, key))
+
+    def subscribe(self, callback):
+        """Call ``callback(key)`` for every key invalidated by a peer."""
+        self._callbacks.append(callback)
+        if self._thread is None:
+            self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{self.channel: self._handle})
+            self._thread = self._pubsub.run_in_thread(sleep_time=self.sleep_time, daemon=True)
+
+    def _handle(self, message):
+        data = message['data']
+        if isinstance(data, bytes):
+            data = data.decode('utf8')
+        sender, key = data.split(' ', 1)
+        if sender != self.id:
+            for callback in self._callbacks:
+                callback(key)
+
+    def close(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread.join()
+            self._pubsub.close()
+            self._thread = self._pubsub = None
 
 
-def wrap(redis, lock_class=Lock):
-    def lock(key):
-        return lock_class(redis, key + '.lock')
-    db = shelve.Shelf(redis)
-    db.lock = lock
-    return db
+def wrap(redis, lock_class=Lock, **kwargs):
+    return Store(redis, lock_class=lock_class, **kwargs)
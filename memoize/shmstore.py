@@ -0,0 +1,217 @@
+"""Store in memory which is shared by forked processes.
+
+This is for pre-fork servers (e.g. gunicorn with ``preload_app``): create the
+store in the master process, and every worker shares one cache, so a value
+calculated by one worker is served to all of the others.
+
+The arena is a single anonymous shared mmap, split into fixed-size slots. Keys
+hash to a bucket of ``ways`` consecutive slots, and may be in any of them; when
+a bucket is full, an expired entry or else the least recently used one is
+evicted. Buckets are guarded by a fixed set of (striped) locks, which are
+created along with the arena, and so must also be created before forking.
+
+Each slot is (all big-endian)::
+
+    Q   key hash (0 if the slot is empty)
+    d   last used time
+    d   expiry time (NaN for None)
+    I   length of the key
+    I   length of the value
+    ... key (UTF-8)
+    ... value; a data tuple encoded by an Envelope (see memoize.codec)
+
+"""
+
+import hashlib
+import mmap
+import multiprocessing
+import struct
+
+from .codec import Envelope
+from .core import EXPIRY_INDEX
+from .time import time
+
+
+SLOT_HEADER = struct.Struct('>QddII')
+
+_u64 = struct.Struct('>Q')
+_double = struct.Struct('>d')
+_nan = float('nan')
+
+
+def _hash(encoded_key):
+    value, = _u64.unpack(hashlib.blake2b(encoded_key, digest_size=8).digest())
+    return value or 1 # Zero marks an empty slot.
+
+
+class _Lock(object):
+    """Adapts a multiprocessing lock to the interface of store locks."""
+
+    def __init__(self, lock):
+        self._lock = lock
+
+    def acquire(self, timeout):
+        return self._lock.acquire(True, timeout if timeout >= 0 else None)
+
+    def release(self):
+        self._lock.release()
+
+
+class SharedMemoryStore(object):
+    """Fixed-size store in memory shared with forked processes.
+
+    :param int entries: Number of slots; rounded up to a multiple of ``ways``.
+    :param int slot_size: Size in bytes of each slot, which must hold the
+        key and encoded value (and a 32 byte header). Larger values are not
+        stored.
+    :param int ways: Number of slots in each bucket.
+    :param int stripes: Number of locks guarding the buckets.
+    :param int lock_stripes: Number of locks handed out by :meth:`lock`, which
+        are shared by the keys which hash to them. They are reentrant, so that
+        a memoized function may call another whose key shares its lock.
+    :param envelope: The :class:`memoize.codec.Envelope` to encode values with.
+    :param float grace: Seconds past their expiry for which values are kept.
+    :param context: A ``multiprocessing`` context to create locks with.
+
+    """
+
+    def __init__(self, entries=1024, slot_size=4096, ways=8, stripes=64, lock_stripes=64,
+                 envelope=None, grace=0, context=None):
+
+        context = context or multiprocessing
+
+        self.buckets = max(1, -(-entries // ways))
+        self.ways = ways
+        self.slot_size = slot_size
+        self.envelope = envelope or Envelope()
+        self.grace = grace
+
+        self._locks = [context.Lock() for _ in range(stripes)]
+        self._key_locks = [context.RLock() for _ in range(lock_stripes)]
+
+        # Eviction counters (one per stripe) come before the slots.
+        self._base = stripes * _u64.size
+        self._bucket_size = ways * slot_size
+        self._arena = mmap.mmap(-1, self._base + self.buckets * self._bucket_size)
+
+    def _locate(self, key):
+        encoded = key.encode('utf8')
+        hash_ = _hash(encoded)
+        bucket = hash_ % self.buckets
+        stripe = bucket % len(self._locks)
+        return encoded, hash_, stripe, self._base + bucket * self._bucket_size
+
+    def _find(self, encoded, hash_, start):
+        """Position of the slot with the given key, or None; the lock must be held."""
+        arena = self._arena
+        key_start = SLOT_HEADER.size
+        key_end = key_start + len(encoded)
+        for pos in range(start, start + self._bucket_size, self.slot_size):
+            if (_u64.unpack_from(arena, pos)[0] == hash_ and
+                arena[pos + key_start:pos + key_end] == encoded):
+                return pos
+
+    def _victim(self, start, stripe, now):
+        """Position of the slot to replace in a bucket; the lock must be held."""
+        arena = self._arena
+        oldest = None
+        oldest_used = None
+        for pos in range(start, start + self._bucket_size, self.slot_size):
+            hash_, used, expiry, _, _ = SLOT_HEADER.unpack_from(arena, pos)
+            if not hash_ or expiry + self.grace < now:
+                return pos
+            if oldest is None or used < oldest_used:
+                oldest = pos
+                oldest_used = used
+        counter = stripe * _u64.size
+        _u64.pack_into(arena, counter, _u64.unpack_from(arena, counter)[0] + 1)
+        return oldest
+
+    def get(self, key):
+        encoded, hash_, stripe, start = self._locate(key)
+        arena = self._arena
+        with self._locks[stripe]:
+            pos = self._find(encoded, hash_, start)
+            if pos is None:
+                return None
+            _, _, expiry, key_size, value_size = SLOT_HEADER.unpack_from(arena, pos)
+            now = time()
+            if expiry + self.grace < now: # NaN (for None) is never less.
+                return None
+            _double.pack_into(arena, pos + _u64.size, now)
+            value_start = pos + SLOT_HEADER.size + key_size
+            raw = arena[value_start:value_start + value_size]
+        return self.envelope.loads(raw)
+
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def __setitem__(self, key, data):
+
+        raw = self.envelope.dumps(data)
+        encoded, hash_, stripe, start = self._locate(key)
+        arena = self._arena
+        fits = SLOT_HEADER.size + len(encoded) + len(raw) <= self.slot_size
+        expiry = data[EXPIRY_INDEX]
+        now = time()
+
+        with self._locks[stripe]:
+            pos = self._find(encoded, hash_, start)
+            if not fits:
+                # Don't leave an older value behind.
+                if pos is not None:
+                    _u64.pack_into(arena, pos, 0)
+                return
+            if pos is None:
+                pos = self._victim(start, stripe, now)
+            SLOT_HEADER.pack_into(arena, pos, hash_, now, _nan if expiry is None else expiry,
+                len(encoded), len(raw))
+            key_start = pos + SLOT_HEADER.size
+            arena[key_start:key_start + len(encoded)] = encoded
+            arena[key_start + len(encoded):key_start + len(encoded) + len(raw)] = raw
+
+    def __delitem__(self, key):
+        encoded, hash_, stripe, start = self._locate(key)
+        with self._locks[stripe]:
+            pos = self._find(encoded, hash_, start)
+            if pos is None:
+                raise KeyError(key)
+            _u64.pack_into(self._arena, pos, 0)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        """Number of occupied slots (including expired ones); this does not lock."""
+        arena = self._arena
+        return sum(1 for pos in range(self._base, len(arena), self.slot_size)
+            if _u64.unpack_from(arena, pos)[0])
+
+    @property
+    def evictions(self):
+        return sum(_u64.unpack_from(self._arena, i * _u64.size)[0] for i in range(len(self._locks)))
+
+    def clear(self):
+        arena = self._arena
+        for i, lock in enumerate(self._locks):
+            with lock:
+                for bucket in range(i, self.buckets, len(self._locks)):
+                    start = self._base + bucket * self._bucket_size
+                    for pos in range(start, start + self._bucket_size, self.slot_size):
+                        _u64.pack_into(arena, pos, 0)
+
+    def ttl(self, key):
+        encoded, hash_, stripe, start = self._locate(key)
+        with self._locks[stripe]:
+            pos = self._find(encoded, hash_, start)
+            if pos is None:
+                return None
+            expiry = _double.unpack_from(self._arena, pos + _u64.size + _double.size)[0]
+        if expiry == expiry and expiry + self.grace >= time(): # Not NaN, nor dead.
+            return max(0, expiry - time()) or None
+
+    def lock(self, key):
+        return _Lock(self._key_locks[_hash(key.encode('utf8')) % len(self._key_locks)])
@@ -0,0 +1,109 @@
+"""Hit/miss counters and timing histograms.
+
+A :class:`Memoizer` calls each of its hooks as
+``hook(event, region, namespace, duration)`` where ``duration`` is in seconds
+for timed events, and None otherwise. Events are:
+
+- ``hit``: a fresh value was found.
+- ``stale``: an expired value was returned while being refreshed.
+- ``miss``: no value was found.
+- ``expired``: a value was found, but it had expired.
+- ``early``: a fresh value was found, but is recalculated early (see the
+  ``early_expiry`` option).
+- ``refresh``: a background refresh was scheduled.
+- ``lock_wait`` (timed): a lock was acquired.
+- ``lock_timeout`` (timed): a lock could not be acquired in time.
+- ``compute`` (timed): a value was calculated.
+- ``error`` (timed): calculating a value raised an exception.
+- ``reject``: a calculated value was not stored, due to the admission
+  options (``min_compute_time``, ``max_size``, or ``min_benefit``).
+
+No work is done for any of this if there are no hooks.
+
+"""
+
+import bisect
+import threading
+
+
+#: Upper bounds (in seconds) of the histogram buckets; the last is unbounded.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        buckets = dict(zip(BUCKETS + (float('inf'), ), self.counts))
+        return dict(
+            count=self.count,
+            total=self.total,
+            mean=self.total / self.count if self.count else None,
+            min=self.min,
+            max=self.max,
+            buckets=buckets,
+        )
+
+
+class Stats(object):
+    """A hook which collects counts and timings by region and namespace."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._timings = {}
+
+    def __call__(self, event, region, namespace, duration=None):
+        group = (region, namespace)
+        with self._lock:
+            counts = self._counts.get(group)
+            if counts is None:
+                counts = self._counts[group] = {}
+            counts[event] = counts.get(event, 0) + 1
+            if duration is not None:
+                histogram = self._timings.get((group, event))
+                if histogram is None:
+                    histogram = self._timings[(group, event)] = Histogram()
+                histogram.add(duration)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._timings.clear()
+
+    def snapshot(self):
+        """Get a dict mapping ``(region, namespace)`` to their stats.
+
+        Each contains a ``counts`` dict of event counts, a ``timings`` dict of
+        histogram snapshots for timed events, and the ``hit_ratio`` (hits and
+        stale hits over all lookups; None before any lookups).
+
+        """
+        with self._lock:
+            out = {}
+            for group, counts in self._counts.items():
+                lookups = sum(counts.get(x, 0) for x in ('hit', 'stale', 'miss', 'expired', 'early'))
+                hits = counts.get('hit', 0) + counts.get('stale', 0)
+                out[group] = dict(
+                    counts=dict(counts),
+                    timings=dict(
+                        (event, histogram.snapshot())
+                        for (g, event), histogram in self._timings.items()
+                        if g == group
+                    ),
+                    hit_ratio=float(hits) / lookups if lookups else None,
+                )
+            return out
@@ -0,0 +1,434 @@
+"""Bundled in-process stores.
+
+A plain ``dict`` works as a store, but it grows without bound and never drops
+expired values unless they happen to be read again. :class:`MemoryStore`
+limits itself by entry count and/or (approximate) bytes, and throws out
+expired values first. :class:`TieredStore` puts one in front of a shared
+store.
+
+"""
+
+import heapq
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+from .core import PROTOCOL_INDEX, EXPIRY_INDEX, VALUE_INDEX
+from .time import time
+
+
+def default_sizeof(data):
+    """Approximate the size of a data tuple by its pickled value (or buffer)."""
+    value = data[VALUE_INDEX]
+    try:
+        return memoryview(value).nbytes
+    except TypeError:
+        pass
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class FrequencySketch(object):
+    """Count-min sketch of approximate access frequencies, as used by TinyLFU.
+
+    Counters saturate at 15 and are all halved after ``sample_size``
+    increments, so that the sketch favours recent popularity.
+
+    """
+
+    # Each row multiplies the hash by its own odd constant, and takes the top
+    # bits of the product as the index.
+    seeds = (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9, 0x27d4eb2f165667c5)
+
+    def __init__(self, capacity):
+        width = 16
+        while width < capacity * 4:
+            width *= 2
+        self._shift = 64 - width.bit_length() + 1
+        self._rows = [[0] * width for _ in self.seeds]
+        self._sample_size = max(10 * capacity, 16)
+        self._additions = 0
+
+    def _indices(self, key):
+        h = hash(key) & 0xffffffffffffffff
+        shift = self._shift
+        return [((h * seed) & 0xffffffffffffffff) >> shift for seed in self.seeds]
+
+    def increment(self, key):
+        for row, i in zip(self._rows, self._indices(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._age()
+
+    def frequency(self, key):
+        return min(row[i] for row, i in zip(self._rows, self._indices(key)))
+
+    def _age(self):
+        self._additions //= 2
+        for row in self._rows:
+            for i, count in enumerate(row):
+                row[i] = count >> 1
+
+
+class _Shard(object):
+
+    def __init__(self, max_entries, max_bytes, policy):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (data, size); LRU first.
+        self.expiries = [] # Heap of (expiry, key); may hold stale items.
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self.sketch = FrequencySketch(max_entries or 1024) if policy == 'tinylfu' else None
+
+
+class _KeyLock(object):
+
+    def __init__(self, store, key):
+        self._store = store
+        self.key = key
+        self._entry = None
+
+    def acquire(self, timeout):
+        self._entry = entry = self._store._checkout_lock(self.key)
+        if entry[0].acquire(True, timeout if timeout >= 0 else -1):
+            return True
+        self._store._checkin_lock(self.key, entry)
+        return False
+
+    def release(self):
+        entry, self._entry = self._entry, None
+        entry[0].release()
+        self._store._checkin_lock(self.key, entry)
+
+
+class MemoryStore(object):
+    """Bounded, thread-safe, in-process store.
+
+    :param int max_entries: Maximum number of entries to hold.
+    :param int max_bytes: Maximum total size of values, as measured by
+        ``sizeof`` (the length of the pickled value by default).
+    :param str policy: ``'lru'`` evicts the least recently used entry.
+        ``'tinylfu'`` additionally refuses to admit a new entry if it has been
+        requested (via ``get``) no more often than the entry it would evict.
+        Updates of entries which are already stored are always admitted.
+    :param int shards: Keys are spread across this many independently locked
+        shards to reduce contention; limits are split evenly between them.
+    :param float grace: Seconds past their expiry for which entries are kept
+        (e.g. to be served via the ``stale_ttl`` option).
+    :param sizeof: ``sizeof(data_tuple) -> int``.
+
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, policy='lru', shards=16,
+        grace=0, sizeof=None):
+
+        if policy not in ('lru', 'tinylfu'):
+            raise ValueError('unknown policy %r' % policy)
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.grace = grace
+        self.sizeof = sizeof or default_sizeof
+
+        shard_entries = max_entries and max(1, -(-max_entries // shards))
+        shard_bytes = max_bytes and max(1, -(-max_bytes // shards))
+        self._shards = [_Shard(shard_entries, shard_bytes, policy) for _ in range(shards)]
+
+        self._key_locks = {}
+        self._key_locks_mutex = threading.Lock()
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _is_dead(self, data, now):
+        expiry = data[EXPIRY_INDEX]
+        return bool(expiry) and expiry + self.grace < now
+
+    def _remove(self, shard, key):
+        data, size = shard.entries.pop(key)
+        shard.bytes -= size
+
+    def _purge_expired(self, shard, now):
+        heap = shard.expiries
+        while heap and heap[0][0] + self.grace < now:
+            expiry, key = heapq.heappop(heap)
+            entry = shard.entries.get(key)
+            # The heap is not updated when entries are, so double check.
+            if entry is not None and entry[0][EXPIRY_INDEX] == expiry:
+                self._remove(shard, key)
+
+    def _is_full(self, shard, extra_entries=0, extra_bytes=0):
+        return (
+            (shard.max_entries is not None and len(shard.entries) + extra_entries > shard.max_entries) or
+            (shard.max_bytes is not None and shard.bytes + extra_bytes > shard.max_bytes)
+        )
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            if shard.sketch is not None:
+                shard.sketch.increment(key)
+            entry = shard.entries.get(key)
+            if entry is None:
+                return default
+            data = entry[0]
+            if self._is_dead(data, time()):
+                self._remove(shard, key)
+                return default
+            shard.entries.move_to_end(key)
+            return data
+
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def __setitem__(self, key, data):
+
+        size = self.sizeof(data) if self.max_bytes is not None else 0
+        now = time()
+        shard = self._shard(key)
+
+        with shard.lock:
+
+            present = key in shard.entries
+            if present:
+                self._remove(shard, key)
+
+            if self._is_dead(data, now):
+                return
+            if shard.max_bytes is not None and size > shard.max_bytes:
+                return
+
+            self._purge_expired(shard, now)
+
+            # Only new keys must earn their place; the sketch was incremented
+            # when they were looked up.
+            if shard.sketch is not None and not present:
+                if shard.entries and self._is_full(shard, 1, size):
+                    victim = next(iter(shard.entries))
+                    if shard.sketch.frequency(key) <= shard.sketch.frequency(victim):
+                        return
+
+            while shard.entries and self._is_full(shard, 1, size):
+                self._remove(shard, next(iter(shard.entries)))
+                shard.evictions += 1
+
+            shard.entries[key] = (data, size)
+            shard.bytes += size
+            expiry = data[EXPIRY_INDEX]
+            if expiry:
+                heapq.heappush(shard.expiries, (expiry, key))
+
+            # Drop heap items for entries which have since been replaced.
+            if len(shard.expiries) > 2 * len(shard.entries) + 64:
+                shard.expiries = [(data[EXPIRY_INDEX], key)
+                    for key, (data, _) in shard.entries.items() if data[EXPIRY_INDEX]]
+                heapq.heapify(shard.expiries)
+
+    def __delitem__(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            self._remove(shard, key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    @property
+    def bytes(self):
+        return sum(shard.bytes for shard in self._shards)
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self._shards)
+
+    def keys(self):
+        keys = []
+        for shard in self._shards:
+            with shard.lock:
+                keys.extend(shard.entries)
+        return keys
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+                shard.expiries = []
+                shard.bytes = 0
+
+    def purge(self):
+        """Remove all expired entries."""
+        now = time()
+        for shard in self._shards:
+            with shard.lock:
+                self._purge_expired(shard, now)
+
+    def ttl(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        expiry = data[EXPIRY_INDEX]
+        if expiry is not None:
+            return max(0, expiry - time()) or None
+
+    def lock(self, key):
+        return _KeyLock(self, key)
+
+    def _checkout_lock(self, key):
+        with self._key_locks_mutex:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry
+
+    def _checkin_lock(self, key, entry):
+        with self._key_locks_mutex:
+            entry[1] -= 1
+            if not entry[1]:
+                self._key_locks.pop(key, None)
+
+
+class TieredStore(object):
+    """Two-tier store; a small local store in front of a shared remote one.
+
+    Reads check the local store first, then the remote store, remembering
+    remote hits locally. Writes go to both.
+
+    :param local: The local store, e.g. a :class:`MemoryStore`.
+    :param remote: The shared store, e.g. a :class:`memoize.redis.Store`.
+    :param float local_max_age: Maximum seconds to keep a value locally before
+        checking the remote store again, since other processes may have
+        replaced it.
+    :param invalidator: Optional object with ``publish(key)`` and
+        ``subscribe(callback)`` methods (e.g. :class:`memoize.redis.Invalidator`)
+        to tell peers to drop their local copy of a key whenever it is set or
+        deleted.
+
+    """
+
+    def __init__(self, local, remote, local_max_age=None, invalidator=None):
+        self.local = local
+        self.remote = remote
+        self.local_max_age = local_max_age
+        self.invalidator = invalidator
+        if invalidator is not None:
+            invalidator.subscribe(self.invalidate_local)
+
+    # Local entries wrap the real data tuple as their value, with their own
+    # expiry so that the local store drops them on time.
+    def _wrap(self, data, now):
+        expiry = data[EXPIRY_INDEX]
+        if self.local_max_age is not None:
+            local_expiry = now + self.local_max_age
+            if not (expiry and expiry < local_expiry):
+                expiry = local_expiry
+        return (data[PROTOCOL_INDEX], now, expiry, None, data)
+
+    def _get_local(self, key, now):
+        entry = self.local.get(key)
+        if entry is None:
+            return None
+        expiry = entry[EXPIRY_INDEX]
+        if expiry and expiry < now:
+            return None
+        return entry[VALUE_INDEX]
+
+    def _set_local(self, key, data, now):
+        entry = self._wrap(data, now)
+        expiry = entry[EXPIRY_INDEX]
+        if expiry and expiry < now:
+            self.invalidate_local(key)
+        else:
+            self.local[key] = entry
+
+    def invalidate_local(self, key):
+        try:
+            del self.local[key]
+        except KeyError:
+            pass
+
+    def _publish(self, key):
+        if self.invalidator is not None:
+            self.invalidator.publish(key)
+
+    def get(self, key):
+        now = time()
+        data = self._get_local(key, now)
+        if data is None:
+            data = self.remote.get(key)
+            if data is not None:
+                self._set_local(key, data, now)
+        return data
+
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def get_many(self, keys):
+        now = time()
+        found = [self._get_local(key, now) for key in keys]
+        missing = [i for i, data in enumerate(found) if data is None]
+        if missing:
+            missing_keys = [keys[i] for i in missing]
+            get_many = getattr(self.remote, 'get_many', None)
+            remote = get_many(missing_keys) if get_many else [self.remote.get(key) for key in missing_keys]
+            for i, data in zip(missing, remote):
+                if data is not None:
+                    found[i] = data
+                    self._set_local(keys[i], data, now)
+        return found
+
+    def __setitem__(self, key, data):
+        self.remote[key] = data
+        self._set_local(key, data, time())
+        self._publish(key)
+
+    def set_many(self, mapping):
+        set_many = getattr(self.remote, 'set_many', None)
+        if set_many:
+            set_many(mapping)
+        else:
+            for key, data in mapping.items():
+                self.remote[key] = data
+        now = time()
+        for key, data in mapping.items():
+            self._set_local(key, data, now)
+            self._publish(key)
+
+    def __delitem__(self, key):
+        self.invalidate_local(key)
+        self._publish(key)
+        del self.remote[key]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def ttl(self, key):
+        ttl = getattr(self.remote, 'ttl', None)
+        if ttl is not None:
+            return ttl(key)
+        data = self.get(key)
+        if data is None:
+            return None
+        expiry = data[EXPIRY_INDEX]
+        if expiry is not None:
+            return max(0, expiry - time()) or None
+
+    def lock(self, key):
+        lock = getattr(self.remote, 'lock', None) or getattr(self.local, 'lock', None)
+        return lock(key) if lock else None
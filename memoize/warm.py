@@ -0,0 +1,99 @@
+"""Pre-populating caches; see :meth:`Memoizer.warm`."""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as _timer
+
+
+log = logging.getLogger(__name__)
+
+
+class WarmReport(object):
+    """Progress of a warming; updated as values are done.
+
+    :ivar int total: Number of keys.
+    :ivar int skipped: Number which were already in the store.
+    :ivar int computed: Number which were calculated (or were found to have
+        been calculated by someone else while waiting for their lock).
+    :ivar list failed: ``(key, exception)`` pairs for those which raised.
+    :ivar float elapsed: Seconds since starting.
+
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.skipped = 0
+        self.computed = 0
+        self.failed = []
+        self._start = _timer()
+        self._finished = None
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.skipped + self.computed + len(self.failed)
+
+    @property
+    def elapsed(self):
+        return (self._finished or _timer()) - self._start
+
+    @property
+    def rate(self):
+        """Values calculated per second."""
+        elapsed = self.elapsed
+        return self.computed / elapsed if elapsed else 0.0
+
+    def _finish(self):
+        self._finished = _timer()
+
+    def __repr__(self):
+        return '<%s %d/%d done; %d skipped, %d computed, %d failed; %.1f/s>' % (
+            self.__class__.__name__, self.done, self.total, self.skipped,
+            self.computed, len(self.failed), self.rate)
+
+
+def warm(memo, keys, func, args=None, kwargs=None, workers=4, executor=None,
+         progress=None, opts=None):
+    """Implementation of :meth:`Memoizer.warm`."""
+
+    keys, args, kwargs, opts, key_opts = memo._prepare_many(keys, args, kwargs, opts or {})
+    store = opts['store']
+    found = memo._store_get_many(store, keys)
+
+    report = WarmReport(len(keys))
+    missing = [i for i, data in enumerate(found)
+        if data is None or memo._has_expired(data, key_opts[i])]
+    report.skipped = len(keys) - len(missing)
+    if progress is not None and report.skipped:
+        progress(report)
+
+    call = func
+    if executor is not None:
+        # The lock is held (and the value stored) by our thread, while the
+        # executor does the work.
+        call = lambda *args, **kwargs: executor.submit(func, *args, **kwargs).result()
+
+    def run(i):
+        try:
+            memo._compute(keys[i], store, call, args[i], kwargs[i], key_opts[i], found[i])
+        except Exception as e:
+            log.exception('error while warming %r', keys[i])
+            with report._lock:
+                report.failed.append((keys[i], e))
+        else:
+            with report._lock:
+                report.computed += 1
+        if progress is not None:
+            progress(report)
+
+    if missing:
+        pool = ThreadPoolExecutor(max(1, min(workers, len(missing))))
+        try:
+            for _ in pool.map(run, missing):
+                pass
+        finally:
+            pool.shutdown()
+
+    report._finish()
+    return report
@@ -0,0 +1,312 @@
+import asyncio
+from unittest import skipIf
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from memoize.aio import AsyncMemoizedFunction
+
+from .common import *
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsync(TestCase):
+
+    def test_aget(self):
+
+        async def func(x):
+            return self.append_args(x)
+
+        async def main():
+            self.assertEqual(await self.memo.aget('key', func, (1, )), 1)
+            self.assertEqual(await self.memo.aget('key', func, (1, )), 1)
+            self.assertEqual(await self.memo.aget('key'), 1)
+
+            # Regular functions work too.
+            self.assertEqual(await self.memo.aget('other', self.append_args), 2)
+
+            await self.memo.adelete('key')
+            self.assertEqual(await self.memo.aget('key', func, (1, )), 3)
+
+        run(main())
+        self.assertEqual(self.store['key'][VALUE_INDEX], 3)
+
+    def test_tags(self):
+
+        async def main():
+            self.assertEqual(await self.memo.aget('key', self.append_args, tags=['x']), 1)
+            self.assertEqual(await self.memo.aget('key', self.append_args, tags=['x']), 1)
+            self.memo.invalidate_tag('x')
+            self.assertEqual(await self.memo.aget('key', self.append_args, tags=['x']), 2)
+
+        run(main())
+
+    def test_decorator(self):
+
+        @self.memo(max_age=1)
+        async def func(x):
+            await asyncio.sleep(0)
+            return self.append_args(x)
+
+        self.assertIsInstance(func, AsyncMemoizedFunction)
+
+        async def main():
+            self.assertEqual(await func(1), 1)
+            self.assertEqual(await func(1), 1)
+            self.assertEqual(await func(2), 2)
+            self.assertTrue(func.exists((1, )))
+            await func.delete((1, ))
+            self.assertFalse(func.exists((1, )))
+            self.assertFalse(await func.aexists((1, )))
+
+        run(main())
+
+        # The result is cached, not the coroutine.
+        self.assertEqual(self.store[func.key((2, ))][VALUE_INDEX], 2)
+
+    def test_map(self):
+
+        @self.memo
+        async def func(x):
+            await asyncio.sleep(0)
+            return self.append_args(x)
+
+        async def main():
+            self.assertEqual(await func(1), 1)
+            self.assertEqual(await func.map([(1, ), (2, ), (3, )]), [1, 2, 3])
+            self.assertEqual(await func.map([(2, ), (3, )]), [2, 3])
+            with self.assertRaises(TypeError):
+                await func.map([(1, )], func_many=lambda args, kwargs: [])
+
+        run(main())
+        self.assertEqual(self.store[func.key((3, ))][VALUE_INDEX], 3)
+        with self.assertRaises(TypeError):
+            func.warm([(4, )])
+
+    def test_method(self):
+
+        memo = self.memo
+
+        class A(object):
+            @memo
+            async def func(self, x):
+                return x * 2
+
+        async def main():
+            self.assertEqual(await A().func(2), 4)
+
+        run(main())
+
+    def test_per_instance_method(self):
+
+        class AsyncDict(dict):
+
+            async def aget(self, key):
+                return self.get(key)
+
+            async def aset(self, key, data):
+                self[key] = data
+
+            async def adelete(self, key):
+                self.pop(key, None)
+
+        store = AsyncDict()
+        memo = Memoizer(store)
+
+        class A(object):
+
+            def __init__(self):
+                self.calls = 0
+
+            @memo(per_instance=True)
+            async def func(self, x):
+                self.calls += 1
+                return x * 2
+
+        async def main():
+            a = A()
+            self.assertEqual(await a.func(2), 4)
+            self.assertEqual(await a.func(2), 4)
+            self.assertEqual(a.calls, 1)
+            self.assertEqual(len(store), 1)
+
+            # Deleted in the background once the instance is gone.
+            del a
+            b = A()
+            self.assertEqual(await b.func(2), 4)
+            await asyncio.sleep(0)
+            self.assertEqual(len(store), 1)
+
+        run(main())
+
+    def test_shared_task(self):
+
+        calls = []
+
+        @self.memo
+        async def slow(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x
+
+        async def main():
+            return await asyncio.gather(*[slow(1) for _ in range(10)])
+
+        self.assertEqual(run(main()), [1] * 10)
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.memo._async_flights, {})
+
+    def test_recheck(self):
+
+        calls = []
+
+        @self.memo
+        async def func():
+            calls.append(1)
+            return 'new'
+
+        class Store(dict):
+
+            fetches = 0
+
+            async def aget(self, key):
+                # The previous flight finishes just after our first fetch.
+                self.fetches += 1
+                if self.fetches == 1:
+                    return None
+                return (CURRENT_PROTOCOL_VERSION, time(), None, None, 'stored', 0)
+
+        async def main():
+            return await func.get(store=Store())
+
+        self.assertEqual(run(main()), 'stored')
+        self.assertEqual(calls, [])
+
+    def test_exception(self):
+
+        @self.memo
+        async def fails():
+            raise ValueError('nope')
+
+        async def main():
+            with self.assertRaises(ValueError):
+                await fails()
+
+        run(main())
+        self.assertEqual(self.store, {})
+
+    def test_stale(self):
+
+        async def func():
+            return self.append_args()
+
+        async def main():
+            opts = dict(max_age=1, stale_ttl=10)
+            self.assertEqual(await self.memo.aget('key', func, **opts), 1)
+            sleep(2)
+            self.assertEqual(await self.memo.aget('key', func, **opts), 1)
+            await asyncio.sleep(0.01)
+            self.assertEqual(await self.memo.aget('key', func, **opts), 2)
+
+        run(main())
+
+    def test_early_expiry(self):
+
+        async def func():
+            return self.append_args()
+
+        async def main():
+            # Slow to calculate, and about to expire.
+            self.store['key'] = (CURRENT_PROTOCOL_VERSION, time(), time() + 1, None, 'old', 1e6)
+            self.assertEqual(await self.memo.aget('key', func, early_expiry=True), 1)
+            self.assertEqual(await self.memo.aget('key', func), 1)
+
+        run(main())
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestAsyncRedis(TestCase):
+
+    def test_store(self):
+
+        import memoize.aioredis
+
+        async def main():
+
+            redis = fakeredis.FakeAsyncRedis()
+            await redis.flushdb()
+            store = memoize.aioredis.Store(redis)
+            memo = Memoizer(store)
+
+            calls = []
+
+            @memo(max_age=10)
+            async def func(x):
+                calls.append(x)
+                await asyncio.sleep(0.01)
+                return x * 2
+
+            self.assertEqual(await asyncio.gather(func(1), func(1), func(2)), [2, 2, 4])
+            self.assertEqual(sorted(calls), [1, 2])
+            self.assertAlmostEqual(await store.attl(func.key((1, ))), 10, 1)
+            self.assertEqual(await store.aget_many([func.key((1, )), 'x']), [
+                await store.aget(func.key((1, ))), None])
+
+            self.assertTrue(await func.aexists((1, )))
+            self.assertAlmostEqual(await func.attl((1, )), 10, 1)
+            self.assertIsNone(await func.alast_etag((1, )))
+            await func.aexpire(5, (1, ))
+            self.assertAlmostEqual(await memo.attl(func.key((1, ))), 5, 1)
+
+            await func.delete((1, ))
+            self.assertIsNone(await store.aget(func.key((1, ))))
+            self.assertFalse(await func.aexists((1, )))
+            self.assertIsNone(await func.attl((1, )))
+            with self.assertRaises(KeyError):
+                await func.aexpire_at(time() + 5, (1, ))
+
+            # Generations of tags are fetched at once.
+            self.assertEqual(await memo.aget('tagged', str, (1, ), tags=['a', 'b']), '1')
+            await memo.aexpire('tagged', 5, tags=['a', 'b'])
+            self.assertTrue(await memo.aexists('tagged', tags=['a', 'b']))
+            self.assertFalse(await memo.aexists('tagged', tags=['a', 'c']))
+
+        run(main())
+
+    def test_lock(self):
+
+        import memoize.aioredis
+
+        async def main():
+
+            redis = fakeredis.FakeAsyncRedis()
+            await redis.flushdb()
+            a = memoize.aioredis.Lock(redis, 'key')
+            b = memoize.aioredis.Lock(redis, 'key', poll_interval=30)
+
+            self.assertTrue(await a.acquire(0))
+            self.assertFalse(await b.acquire(0))
+
+            async def release_soon():
+                await asyncio.sleep(0.05)
+                await a.release()
+
+            results = await asyncio.gather(b.acquire(5), release_soon())
+            self.assertTrue(results[0])
+
+            # Not ours anymore.
+            await a.release()
+            self.assertTrue(await redis.exists('key'))
+            await b.release()
+            self.assertFalse(await redis.exists('key'))
+
+        run(main())
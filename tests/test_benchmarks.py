@@ -0,0 +1,214 @@
+"""Micro-benchmarks.
+
+These only assert very loose bounds (so as not to be flaky), but report the
+measured timings when run with ``-s`` (or ``nosetests -s``).
+
+"""
+
+import dbm
+import itertools
+import json
+import os
+import shelve
+import shutil
+import tempfile
+import timeit
+
+from .common import *
+
+
+def best_of(func, number=2000, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def report(name, seconds, baseline=None):
+    if baseline:
+        print('%s: %.2fus (%.1fx)' % (name, seconds * 1e6, seconds / baseline))
+    else:
+        print('%s: %.2fus' % (name, seconds * 1e6))
+
+
+class TestHitLatency(TestCase):
+
+    def test_hit_vs_dict(self):
+
+        @self.memo
+        def add(a, b):
+            return a + b
+
+        @self.memo
+        def zero():
+            return 1
+
+        add(1, 2)
+        zero()
+
+        raw = {'key': 3}
+        baseline = best_of(lambda: raw['key'])
+        report('dict lookup', baseline)
+
+        key_time = best_of(lambda: add.key((1, 2), {}))
+        report('key (positional)', key_time, baseline)
+
+        hit_time = best_of(lambda: add(1, 2))
+        report('hit (positional)', hit_time, baseline)
+
+        zero_time = best_of(zero)
+        report('hit (zero args)', zero_time, baseline)
+
+        # Key construction should not dominate a cache hit.
+        self.assertLess(key_time, hit_time)
+
+
+class TestMethodHits(TestCase):
+
+    def test_per_instance(self):
+
+        memo = self.memo
+
+        class A(object):
+
+            def __init__(self):
+                self.rows = list(range(100))
+
+            def __repr__(self):
+                return 'A(%r)' % self.rows
+
+            @memo
+            def bound(self, x):
+                return x
+
+            @memo(per_instance=True)
+            def per_instance(self, x):
+                return x
+
+        a = A()
+        a.bound(1)
+        a.per_instance(1)
+
+        bound_time = best_of(lambda: a.bound(1))
+        report('method hit (bound on access)', bound_time)
+        per_instance_time = best_of(lambda: a.per_instance(1))
+        report('method hit (per_instance)', per_instance_time, bound_time)
+
+        # No binding, nor repr of the instance.
+        self.assertLess(per_instance_time, bound_time)
+
+
+class TestHookOverhead(TestCase):
+
+    def test_hooks(self):
+
+        self.memo.get('key', str)
+        hit = lambda: self.memo.get('key', str)
+        hook = lambda *args: None
+
+        # Interleaved, so that they all see the same noise.
+        without, with_noop, with_stats = [], [], []
+        for _ in range(5):
+            without.append(best_of(hit, repeat=1))
+            self.memo.add_hook(hook)
+            with_noop.append(best_of(hit, repeat=1))
+            self.memo.enable_stats()
+            with_stats.append(best_of(hit, repeat=1))
+            self.memo.disable_stats()
+            self.memo.remove_hook(hook)
+
+        without, with_noop, with_stats = min(without), min(with_noop), min(with_stats)
+        report('hit (no hooks)', without)
+        report('hit (no-op hook)', with_noop, without)
+        report('hit (stats)', with_stats, without)
+
+        # Without hooks, there is nothing but a truthiness check.
+        self.assertLess(without, with_stats * 1.5)
+
+
+class TestRegionResolution(TestCase):
+
+    def test_region_chain(self):
+
+        self.memo.regions['a'] = dict(max_age=60, namespace='a')
+        self.memo.regions['b'] = dict(parent='a', etag='x')
+        self.memo.regions['c'] = dict(parent='b', timeout=5)
+
+        @self.memo(region='c')
+        def deep():
+            return 1
+
+        @self.memo
+        def shallow():
+            return 1
+
+        deep()
+        shallow()
+
+        shallow_time = best_of(shallow)
+        report('hit (default region)', shallow_time)
+        deep_time = best_of(deep)
+        report('hit (3 levels of regions)', deep_time, shallow_time)
+        resolve_time = best_of(lambda: self.memo._resolve_opts({'region': 'c'}))
+        report('resolve region options', resolve_time)
+
+
+class TestDiskStore(TestCase):
+
+    def setUp(self):
+        super(TestDiskStore, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_vs_shelve(self):
+
+        from memoize.diskstore import DiskStore
+
+        data = (CURRENT_PROTOCOL_VERSION, time(), None, None, list(range(100)))
+        keys = ['key%d' % i for i in range(1000)]
+
+        shelf = shelve.open(os.path.join(self.path, 'shelf'))
+        store = DiskStore(os.path.join(self.path, 'disk'))
+        counter = itertools.count()
+
+        def shelf_set():
+            shelf[keys[next(counter) % 1000]] = data
+        def store_set():
+            store[keys[next(counter) % 1000]] = data
+
+        shelf_set_time = best_of(shelf_set, number=1000, repeat=3)
+        report('set (shelve via %s)' % dbm.whichdb(os.path.join(self.path, 'shelf')), shelf_set_time)
+        store_set_time = best_of(store_set, number=1000, repeat=3)
+        report('set (DiskStore)', store_set_time, shelf_set_time)
+
+        shelf_get_time = best_of(lambda: shelf[keys[next(counter) % 1000]])
+        report('get (shelve)', shelf_get_time)
+        store_get_time = best_of(lambda: store.get(keys[next(counter) % 1000]))
+        report('get (DiskStore)', store_get_time, shelf_get_time)
+
+        shelf.close()
+
+        # Lookups are O(1) in the size of the store.
+        self.assertLess(store_get_time, 1e-3)
+
+
+class TestRunner(TestCase):
+
+    def test_json(self):
+
+        from benchmarks.run import main
+
+        path = tempfile.mkdtemp()
+        try:
+            output = os.path.join(path, 'results.json')
+            main(['-n', '5', '-r', '1', '-b', 'dict', '--threads', '2', '-o', output])
+            with open(output) as fh:
+                data = json.load(fh)
+        finally:
+            shutil.rmtree(path)
+
+        names = set(result['name'] for result in data['results'])
+        self.assertEqual(names, set(['get.hit', 'get.miss', 'get.expired', 'key',
+            'contention.round', 'contention.calls']))
+        for result in data['results']:
+            if result['name'] == 'contention.calls' and result['params']['single_flight']:
+                self.assertEqual(result['value'], 1)
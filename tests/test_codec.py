@@ -0,0 +1,132 @@
+import pickle
+from unittest import skipIf
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from memoize.codec import *
+
+from .common import *
+
+
+def entry(value, etag=None, expiry=None, duration=None):
+    return (CURRENT_PROTOCOL_VERSION, 1234.5, expiry, etag, value, duration)
+
+
+class TestEnvelope(TestCase):
+
+    def test_roundtrip(self):
+        envelope = Envelope()
+        for data in (
+            entry(None),
+            entry({'a': [1, 2, 3]}, etag='etag', expiry=2345.5, duration=0.25),
+            entry(b'bytes', etag=('tuple', 1)),
+        ):
+            self.assertEqual(envelope.loads(envelope.dumps(data)), data)
+
+    def test_header(self):
+        raw = Envelope().dumps(entry('x' * 1000, etag='etag', expiry=2345.5))
+        header = read_header(raw[:HEADER_SIZE])
+        self.assertEqual(header.protocol, CURRENT_PROTOCOL_VERSION)
+        self.assertEqual(header.creation, 1234.5)
+        self.assertEqual(header.expiry, 2345.5)
+        self.assertEqual(header.codec, PickleCodec.id)
+        self.assertEqual(read_expiry(Envelope().dumps(entry(1))), None)
+
+    def test_smaller_than_pickle(self):
+        data = entry(12345)
+        self.assertLess(len(Envelope().dumps(data)), len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+
+    def test_protocol_1(self):
+        # Written before durations were stored; they are upgraded on reading.
+        raw, _ = PickleCodec().dumps('old')
+        raw = HEADER.pack(FORMAT_VERSION, FLAG_TEXT_ETAG, PickleCodec.id, 1, 1234.5,
+            float('nan'), 4) + b'etag' + raw
+        self.assertEqual(Envelope().loads(raw),
+            (CURRENT_PROTOCOL_VERSION, 1234.5, None, 'etag', 'old', None))
+        self.assertEqual(Envelope().meta_size(raw), HEADER_SIZE + 4)
+
+    def test_compression(self):
+        data = entry('x' * 10000)
+        plain = Envelope().dumps(data)
+        compressed = Envelope(compress_threshold=1024).dumps(data)
+        self.assertLess(len(compressed), len(plain) / 10)
+        self.assertEqual(Envelope().loads(compressed), data)
+
+        # Small values are left alone.
+        self.assertEqual(Envelope(compress_threshold=1024).dumps(entry(1)), Envelope().dumps(entry(1)))
+
+    @skipIf(not PICKLE_BUFFERS, 'requires pickle protocol 5')
+    def test_out_of_band(self):
+        value = [bytearray(b'x' * 1000), bytearray(b'y' * 10)]
+        raw = Envelope().dumps(entry(value))
+        self.assertEqual(Envelope().loads(raw)[VALUE_INDEX], value)
+        self.assertEqual(Envelope(compress_threshold=0).loads(Envelope(compress_threshold=0).dumps(entry(value)))[VALUE_INDEX], value)
+
+    def test_raw(self):
+        envelope = Envelope(RawCodec())
+        raw = envelope.dumps(entry(b'payload'))
+        self.assertTrue(raw.endswith(b'payload'))
+        self.assertEqual(envelope.loads(raw)[VALUE_INDEX], b'payload')
+
+        # Any envelope can read any registered codec.
+        self.assertEqual(Envelope().loads(raw)[VALUE_INDEX], b'payload')
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        envelope = Envelope(MsgpackCodec())
+        data = entry({'a': [1, 2, 3]}, etag='etag')
+        self.assertEqual(envelope.loads(envelope.dumps(data)), data)
+
+    def test_memoizer(self):
+
+        class Store(dict):
+            envelope = Envelope()
+            def __setitem__(self, key, data):
+                dict.__setitem__(self, key, self.envelope.dumps(data))
+            def get(self, key):
+                raw = dict.get(self, key)
+                return None if raw is None else self.envelope.loads(raw)
+
+        memo = Memoizer(Store())
+        self.assertEqual(memo.get('key', self.append_args, max_age=10, etag='a'), 1)
+        self.assertEqual(memo.get('key', self.append_args, max_age=10, etag='a'), 1)
+        self.assertEqual(memo.etag('key'), 'a')
+        self.assertAlmostEqual(memo.ttl('key'), 10, 1)
+
+
+@skipIf(numpy is None, 'numpy is not installed')
+class TestZeroCopy(TestCase):
+
+    def test_array_view(self):
+        envelope = Envelope()
+        raw = envelope.dumps(entry(numpy.arange(1000)))
+        value = envelope.loads(raw)[VALUE_INDEX]
+        self.assertEqual(value.sum(), 499500)
+        self.assertFalse(value.flags.writeable)
+        self.assertTrue(numpy.shares_memory(value, numpy.frombuffer(raw, dtype=numpy.uint8)))
+
+    def test_bytes_as_views(self):
+        envelope = Envelope(PickleCodec(bytes_as_views=True))
+        value = envelope.loads(envelope.dumps(entry(b'x' * 1000)))[VALUE_INDEX]
+        self.assertIsInstance(value, memoryview)
+        self.assertTrue(value.readonly)
+        self.assertEqual(value, b'x' * 1000)
+
+        # The plain codec still hands back bytes.
+        value = Envelope().loads(Envelope().dumps(entry(b'x' * 1000)))[VALUE_INDEX]
+        self.assertEqual(value, b'x' * 1000)
+        self.assertIsInstance(value, bytes)
+
+    def test_raw_view(self):
+        envelope = Envelope(RawCodec(copy=False))
+        value = envelope.loads(envelope.dumps(entry(b'payload')))[VALUE_INDEX]
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(value, b'payload')
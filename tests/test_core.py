@@ -1,3 +1,9 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import sleep as _sleep
+
+from memoize.stores import MemoryStore
+
 from .common import *
 
 
@@ -40,4 +46,596 @@ class TestCore(TestCase):
         # It does not go up here.
         assert self.memo.get('key', self.append_args) == 3
 
-    
\ No newline at end of file
+    def test_recheck_after_lock(self):
+
+        memo = self.memo
+        store = self.store
+
+        class Lock(object):
+            # Simulate another worker computing the value while we wait.
+            def __init__(self, key):
+                self.key = key
+            def acquire(self, timeout):
+                store[self.key] = (CURRENT_PROTOCOL_VERSION, time(), None, None, 'other')
+                return True
+            def release(self):
+                pass
+
+        self.assertEqual(memo.get('key', self.append_args, lock=Lock), 'other')
+        self.assertEqual(self.records, [])
+
+    def test_single_flight(self):
+
+        import threading
+        import time as real_time
+
+        started = threading.Event()
+        finish = threading.Event()
+
+        def slow():
+            started.set()
+            finish.wait(5)
+            return self.append_args()
+
+        results = []
+        def worker():
+            results.append(self.memo.get('key', slow, single_flight=True))
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+
+        started.wait(5)
+        real_time.sleep(0.05) # Give the others a chance to join the flight.
+        finish.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(len(self.records), 1)
+
+    def test_single_flight_recheck(self):
+
+        # We missed, but by the time we lead a flight the previous one has
+        # stored the value.
+        class Store(dict):
+            stale = True
+            def get(self, key):
+                if self.stale:
+                    self.stale = False
+                    return None
+                return dict.get(self, key)
+
+        store = Store()
+        memo = Memoizer(store)
+        store['key'] = (CURRENT_PROTOCOL_VERSION, time(), None, None, 'other')
+        self.assertEqual(memo.get('key', self.append_args, single_flight=True), 'other')
+        self.assertEqual(self.records, [])
+
+    def test_single_flight_exception(self):
+
+        def fails():
+            raise ValueError('nope')
+
+        self.assertRaises(ValueError, self.memo.get, 'key', fails, single_flight=True)
+        self.assertNotIn((id(self.store), 'key'), self.memo._flights)
+        self.assertEqual(self.memo.get('key', self.append_args, single_flight=True), 1)
+
+    def test_stale_while_revalidate(self):
+
+        jobs = []
+        class Deferred(object):
+            def submit(self, func, *args):
+                jobs.append((func, args))
+
+        opts = dict(max_age=1, stale_ttl=10, executor=Deferred())
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 1)
+        sleep(2)
+
+        # Expired, but the stale value is served and a refresh is queued once.
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 1)
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 1)
+        self.assertEqual(len(jobs), 1)
+
+        func, args = jobs.pop()
+        func(*args)
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 2)
+        self.assertEqual(jobs, [])
+
+        # Past the stale window we block on the calculation as usual.
+        sleep(20)
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 3)
+        self.assertEqual(jobs, [])
+
+    def test_stale_etag_mismatch(self):
+
+        jobs = []
+        class Deferred(object):
+            def submit(self, func, *args):
+                jobs.append((func, args))
+
+        opts = dict(max_age=1, stale_ttl=10, executor=Deferred())
+        self.assertEqual(self.memo.get('key', self.append_args, etag='a', **opts), 1)
+        sleep(2)
+        self.assertEqual(self.memo.get('key', self.append_args, etag='b', **opts), 2)
+        self.assertEqual(jobs, [])
+
+    def test_refresh_ahead(self):
+
+        class Immediate(object):
+            def submit(self, func, *args):
+                func(*args)
+
+        opts = dict(max_age=10, refresh_ahead=0.5, executor=Immediate())
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 1)
+        sleep(2)
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 1)
+        sleep(4)
+
+        # The old value is returned, but the new one is already there.
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 1)
+        self.assertEqual(self.memo.get('key', self.append_args, **opts), 2)
+
+    def test_get_many(self):
+
+        calls = []
+        class Store(dict):
+            def get_many(self, keys):
+                calls.append(('get_many', list(keys)))
+                return [self.get(key) for key in keys]
+            def set_many(self, mapping):
+                calls.append(('set_many', sorted(mapping)))
+                self.update(mapping)
+
+        store = Store()
+        memo = Memoizer(store, namespace='ns')
+        memo.get('b', lambda: 'B')
+
+        values = memo.get_many(['a', 'b', 'c'], lambda x: x * 2, [(1, ), (2, ), (3, )])
+        self.assertEqual(values, [2, 'B', 6])
+        self.assertEqual(calls, [
+            ('get_many', ['ns:a', 'ns:b', 'ns:c']),
+            ('set_many', ['ns:a', 'ns:c']),
+        ])
+
+        del calls[:]
+        self.assertEqual(memo.get_many(['a', 'b', 'c']), [2, 'B', 6])
+        self.assertEqual(calls, [('get_many', ['ns:a', 'ns:b', 'ns:c'])])
+        self.assertEqual(memo.get_many(['a', 'x']), [2, None])
+
+    def test_get_many_func_many(self):
+
+        batches = []
+        def func_many(args_list):
+            batches.append(args_list)
+            return [sum(args) for args in args_list]
+
+        self.memo.get('b', lambda: 'B')
+        values = self.memo.get_many(['a', 'b', 'c'], args=[(1, 2), (), (3, 4)], func_many=func_many, max_age=1)
+        self.assertEqual(values, [3, 'B', 7])
+        self.assertEqual(batches, [[(1, 2), (3, 4)]])
+        self.assertAlmostEqual(self.memo.ttl('a'), 1, 2)
+
+        self.assertRaises(ValueError, self.memo.get_many, ['x', 'y'], func_many=lambda args: [1])
+        self.assertRaises(ValueError, self.memo.get_many, ['x', 'y'], args=[()])
+
+    def test_map(self):
+
+        @self.memo
+        def add(a, b=10):
+            return self.append_args(a, b)
+
+        self.assertEqual(add.map([(1, 2), (3, )]), [1, 2])
+        self.assertEqual(add.map([(1, 2), (3, ), (4, 5)]), [1, 2, 3])
+        self.assertEqual(add(3, 10), 2)
+        self.assertEqual(len(self.records), 3)
+
+        @self.memo
+        def double(x):
+            return x * 2
+
+        self.assertEqual(double.map([(1, ), (2, )], func_many=lambda args: [a * 3 for a, in args]), [3, 6])
+        self.assertEqual(double(1), 3)
+
+
+class TestInvalidation(TestCase):
+
+    def test_tags(self):
+
+        get = lambda key, tags: self.memo.get(key, self.append_args, (key, ), tags=tags)
+        self.assertEqual(get('a', ['x']), 1)
+        self.assertEqual(get('b', ['x', 'y']), 2)
+        self.assertEqual(get('c', ['y']), 3)
+        self.assertEqual(get('a', ['x']), 1)
+
+        self.memo.invalidate_tag('x')
+        self.assertEqual(get('a', ['x']), 4)
+        self.assertEqual(get('b', ['x', 'y']), 5)
+        self.assertEqual(get('c', ['y']), 3)
+
+        # Tag order doesn't matter.
+        self.assertEqual(get('b', ['y', 'x']), 5)
+
+    def test_dynamic_tags(self):
+
+        @self.memo(tags=lambda user_id, item: ['user:%d' % user_id])
+        def profile(user_id, item):
+            return self.append_args(user_id, item)
+
+        self.assertEqual(profile(1, 'a'), 1)
+        self.assertEqual(profile(2, 'a'), 2)
+        self.assertTrue(profile.exists((1, 'a')))
+        self.memo.invalidate_tag('user:1')
+        self.assertFalse(profile.exists((1, 'a')))
+        self.assertEqual(profile(1, 'a'), 3)
+        self.assertEqual(profile(2, 'a'), 2)
+
+        profile.delete((2, 'a'))
+        self.assertEqual(profile(2, 'a'), 4)
+
+    def test_region_dynamic_tags(self):
+
+        self.memo.regions['users'] = dict(tags=lambda user_id: ['user:%d' % user_id], max_age=60)
+
+        @self.memo(region='users')
+        def profile(user_id):
+            return self.append_args(user_id)
+
+        self.assertEqual(profile(1), 1)
+        self.assertTrue(profile.exists((1, )))
+        self.assertAlmostEqual(profile.ttl((1, )), 60, 1)
+        profile.expire(10, (1, ))
+        self.assertAlmostEqual(profile.ttl((1, )), 10, 1)
+        self.assertIsNone(profile.last_etag((1, )))
+        profile.delete((1, ))
+        self.assertFalse(profile.exists((1, )))
+
+    def test_namespace(self):
+
+        self.memo.regions['users'] = dict(namespace='users', versioned_namespace=True)
+        self.assertEqual(self.memo.get('a', self.append_args, region='users'), 1)
+        self.assertEqual(self.memo.get('a', self.append_args), 2)
+        self.assertEqual(self.memo.get('a', self.append_args, region='users'), 1)
+
+        self.memo.invalidate_namespace('users')
+        self.assertEqual(self.memo.get('a', self.append_args, region='users'), 3)
+        self.assertEqual(self.memo.get('a', self.append_args), 2)
+
+    def test_get_many(self):
+        keys = ['a', 'b', 'c']
+        self.assertEqual(self.memo.get_many(keys, self.append_args, tags=['x']), [1, 2, 3])
+        self.assertEqual(self.memo.get_many(keys, self.append_args, tags=['x']), [1, 2, 3])
+        self.memo.invalidate_tag('x')
+        self.assertEqual(self.memo.get_many(keys, self.append_args, tags=['x']), [4, 5, 6])
+
+    def test_evicted_generation(self):
+        self.assertEqual(self.memo.get('a', self.append_args, tags=['x']), 1)
+        del self.store[TAG_PREFIX + 'x']
+        self.assertEqual(self.memo.get('a', self.append_args, tags=['x']), 2)
+        self.assertEqual(self.memo.get('a', self.append_args, tags=['x']), 2)
+
+
+def _square(x):
+    return x * x
+
+
+class TestWarm(TestCase):
+
+    def test_warm(self):
+
+        @self.memo
+        def square(x):
+            self.append_args(x)
+            if x < 0:
+                raise ValueError(x)
+            return x * x
+
+        square(2)
+        reports = []
+        report = square.warm([(x, ) for x in range(-1, 5)], workers=3, progress=reports.append)
+        self.assertEqual(report.total, 6)
+        self.assertEqual(report.skipped, 1)
+        self.assertEqual(report.computed, 4)
+        self.assertEqual([key for key, e in report.failed], [square.key((-1, ))])
+        self.assertIsInstance(report.failed[0][1], ValueError)
+        self.assertEqual(report.done, 6)
+        self.assertEqual(len(reports), 6)
+        self.assertIn('6/6 done', repr(report))
+
+        # Nothing more was calculated on the way.
+        self.assertEqual(square(4), 16)
+        self.assertEqual(sorted(args[0] for args, _ in self.records), [-1, 0, 1, 2, 3, 4])
+
+    def test_concurrent_warmers(self):
+
+        store = MemoryStore()
+        memo = Memoizer(store)
+        calls = []
+
+        @memo
+        def slow(x):
+            calls.append(x)
+            _sleep(0.01)
+            return x
+
+        args = [(x, ) for x in range(10)]
+        threads = [threading.Thread(target=slow.warm, args=(args, 5)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(calls), list(range(10)))
+
+    def test_executor(self):
+        with ProcessPoolExecutor(2) as executor:
+            report = self.memo.warm(['a', 'b'], _square, [(2, ), (3, )], executor=executor)
+        self.assertEqual(report.computed, 2)
+        self.assertEqual(self.memo.get('b'), 9)
+
+
+class TestAdmission(TestCase):
+
+    def slow(self, value, seconds=0.02):
+        _sleep(seconds)
+        return self.append_args(value) and value
+
+    def test_min_compute_time(self):
+        self.assertEqual(self.memo.get('fast', self.append_args, min_compute_time=0.01), 1)
+        self.assertNotIn('fast', self.store)
+        self.assertEqual(self.memo.get('slow', self.slow, ('x', ), min_compute_time=0.01), 'x')
+        self.assertIn('slow', self.store)
+
+    def test_max_size(self):
+        self.memo.regions['small'] = dict(max_size=1000)
+        self.assertEqual(self.memo.get('big', bytes, (2000, ), region='small'), bytes(2000))
+        self.assertNotIn('big', self.store)
+        self.memo.get('little', bytes, (10, ), region='small')
+        self.assertIn('little', self.store)
+
+    def test_min_benefit(self):
+        # 20ms for 100kB is 0.2s/MB.
+        self.memo.get('cheap', self.slow, (bytes(100000), ), min_benefit=1)
+        self.assertNotIn('cheap', self.store)
+        self.memo.get('dear', self.slow, (bytes(100), ), min_benefit=1)
+        self.assertIn('dear', self.store)
+
+    def test_get_many(self):
+        stats = self.memo.enable_stats()
+        self.memo.get_many(['a', 'b'], bytes, [(10, ), (2000, )], max_size=1000)
+        self.assertIn('a', self.store)
+        self.assertNotIn('b', self.store)
+        self.assertEqual(self.memo.stats()[('default', None)]['counts']['reject'], 1)
+
+
+class TestNegativeCaching(TestCase):
+
+    def test_exceptions(self):
+
+        def fail(x):
+            self.append_args(x)
+            raise KeyError(x)
+
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                self.memo.get('key', fail, (1, ), cache_exceptions=KeyError, negative_max_age=1)
+        self.assertEqual(len(self.records), 1)
+        self.assertIsInstance(self.store['key'][VALUE_INDEX], CachedException)
+        self.assertAlmostEqual(self.memo.ttl('key'), 1, 1)
+
+        # Even without a function.
+        self.assertRaises(KeyError, self.memo.get, 'key')
+
+        sleep(2)
+        self.assertEqual(self.memo.get('key', self.append_args), 2)
+
+    def test_fresh_exceptions(self):
+
+        def fail():
+            raise KeyError('x')
+
+        raised = []
+        for _ in range(2):
+            try:
+                try:
+                    raise ValueError('unrelated')
+                except ValueError:
+                    self.memo.get('key', fail, cache_exceptions=KeyError)
+            except KeyError as e:
+                raised.append(e)
+
+        # Each is a copy, raised from here.
+        self.assertIsNot(raised[0], raised[1])
+        self.assertEqual(raised[1].args, ('x', ))
+        stored = self.store['key'][VALUE_INDEX].exception
+        self.assertIsNone(stored.__traceback__)
+        self.assertIsNone(stored.__context__)
+        self.assertIsInstance(raised[1].__context__, ValueError)
+
+    def test_get_many_exceptions(self):
+
+        def fail(x):
+            self.append_args(x)
+            if x == 2:
+                raise KeyError(x)
+            return x
+
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                self.memo.get_many(['a', 'b'], fail, [(1, ), (2, )], cache_exceptions=KeyError)
+        self.assertEqual(self.records, [((1, ), {}), ((2, ), {})])
+        self.assertEqual(self.memo.get('a'), 1)
+
+        def fail_many(args_list):
+            self.append_args()
+            raise KeyError()
+
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                self.memo.get_many(['c', 'd'], func_many=fail_many, cache_exceptions=KeyError)
+        self.assertEqual(len(self.records), 3)
+
+    def test_uncached_exceptions(self):
+
+        def fail():
+            self.append_args()
+            raise ValueError()
+
+        for _ in range(2):
+            self.assertRaises(ValueError, self.memo.get, 'key', fail, cache_exceptions=KeyError)
+        self.assertEqual(len(self.records), 2)
+        self.assertNotIn('key', self.store)
+
+    def test_negative_values(self):
+
+        @self.memo(max_age=60, negative_values=[None], negative_max_age=1)
+        def find(x):
+            self.append_args(x)
+            return x or None
+
+        self.assertIs(find(0), None)
+        self.assertEqual(find(1), 1)
+        self.assertAlmostEqual(find.ttl((0, )), 1, 1)
+        self.assertAlmostEqual(find.ttl((1, )), 60, 1)
+
+        # A cached None is distinguishable from a miss.
+        missing = object()
+        self.assertIs(self.memo.get(find.key((0, )), default=missing), None)
+        self.assertIs(self.memo.get('nope', default=missing), missing)
+
+        sleep(2)
+        self.assertIs(self.memo.get(find.key((0, )), default=missing), missing)
+        self.assertEqual(find(1), 1)
+        self.assertEqual(len(self.records), 2)
+
+    def test_negative_values_bypass_admission(self):
+        self.memo.get('key', lambda: None, min_compute_time=1, negative_values=[None])
+        self.assertIn('key', self.store)
+
+
+class TestDeleteMany(TestCase):
+
+    def test_delete_many(self):
+        for key in 'abc':
+            self.memo.get(key, self.append_args, namespace='ns')
+        self.memo.delete_many(['a', 'b', 'x'], namespace='ns')
+        self.assertEqual(sorted(self.store), ['ns:c'])
+
+
+class MetaStore(dict):
+    """Keeps metadata apart, and counts how often values are fetched."""
+
+    def __init__(self):
+        super(MetaStore, self).__init__()
+        self.fetched = 0
+
+    def get(self, key):
+        self.fetched += 1
+        return super(MetaStore, self).get(key)
+
+    def meta(self, key):
+        data = super(MetaStore, self).get(key)
+        return data and data[:VALUE_INDEX] + (None, )
+
+
+class TestMeta(TestCase):
+
+    def setUp(self):
+        super(TestMeta, self).setUp()
+        self.store = MetaStore()
+        self.memo = Memoizer(self.store)
+
+    def test_etag_mismatch_skips_value(self):
+        self.assertEqual(self.memo.get('key', self.append_args, etag='a'), 1)
+        self.store.fetched = 0
+
+        self.assertEqual(self.memo.get('key', self.append_args, etag='a'), 1)
+        self.assertEqual(self.store.fetched, 1)
+
+        self.store.fetched = 0
+        self.assertEqual(self.memo.get('key', self.append_args, etag='b'), 2)
+        self.assertEqual(self.store.fetched, 0)
+        self.assertIs(self.memo.get('key', etag='c'), None)
+        self.assertEqual(self.store.fetched, 0)
+
+    def test_stale_value_is_fetched(self):
+        self.memo.get('key', self.append_args, etag='a', max_age=1)
+        sleep(2)
+        self.assertEqual(self.memo.get('key', self.append_args, etag='a', max_age=1,
+            stale_ttl=5), 1)
+
+    def test_metadata_only(self):
+        self.memo.get('key', self.append_args, etag='a', max_age=10)
+        self.store.fetched = 0
+        self.assertEqual(self.memo.etag('key'), 'a')
+        self.assertTrue(self.memo.exists('key'))
+        self.assertFalse(self.memo.exists('nope'))
+        self.assertAlmostEqual(self.memo.ttl('key'), 10, 1)
+        self.assertEqual(self.store.fetched, 0)
+
+
+class TestEarlyExpiry(TestCase):
+
+    def entry(self, duration, max_age):
+        return (CURRENT_PROTOCOL_VERSION, time(), time() + max_age, None, 'old', duration)
+
+    def test_duration_is_stored(self):
+        self.memo.get('key', _sleep, (0.01, ))
+        self.assertGreaterEqual(self.store['key'][DURATION_INDEX], 0.01)
+
+    def test_older_protocol(self):
+
+        # Protocol 1 tuples lack only the duration, so remain readable.
+        self.store['key'] = ('1', time(), time() + 60, 'etag', 'old')
+        self.assertEqual(self.memo.get('key', self.append_args, early_expiry=True), 'old')
+        self.assertEqual(self.memo.etag('key'), 'etag')
+        self.assertAlmostEqual(self.memo.ttl('key'), 60, 2)
+        self.assertTrue(self.memo.exists('key'))
+
+        self.memo.expire_at('key', time() + 10)
+        self.assertEqual(len(self.store['key']), 5)
+        self.assertEqual(self.store['key'][ETAG_INDEX:], ('etag', 'old'))
+        self.assertAlmostEqual(self.memo.ttl('key'), 10, 2)
+
+        sleep(11)
+        self.assertEqual(self.memo.get('key', self.append_args), 1)
+        self.assertEqual(self.store['key'][PROTOCOL_INDEX], CURRENT_PROTOCOL_VERSION)
+
+    def test_early_expiry(self):
+
+        # Quick to calculate, and far from expiring.
+        self.store['key'] = self.entry(0.001, 60)
+        for _ in range(100):
+            self.assertEqual(self.memo.get('key', self.append_args, early_expiry=True), 'old')
+
+        # Slow to calculate, and about to expire.
+        self.store['key'] = self.entry(1e6, 1)
+        self.assertEqual(self.memo.get('key', self.append_args, early_expiry=True), 1)
+
+        # Not without a function, nor for other methods.
+        self.store['key'] = self.entry(1e6, 1)
+        self.assertEqual(self.memo.get('key', early_expiry=True), 'old')
+        self.assertTrue(self.memo.exists('key', early_expiry=True))
+
+    def test_early_expiry_spreads_out(self):
+        counts = []
+        for start in range(10):
+            self.store['key'] = self.entry(1, 10)
+            sleep(start)
+            recomputed = 0
+            for _ in range(200):
+                if self.memo.get('key', lambda: 'new', early_expiry=2) == 'new':
+                    recomputed += 1
+                    self.store['key'] = self.entry(1, 10 - start)
+            counts.append(recomputed)
+        # Rarer the further from expiry.
+        self.assertLess(counts[0], counts[-1])
+        self.assertLess(counts[0], 20)
+
+    def test_max_age_jitter(self):
+        ttls = set()
+        for i in range(20):
+            self.memo.get(str(i), self.append_args, max_age=60, max_age_jitter=0.5)
+            ttl = self.memo.ttl(str(i))
+            self.assertTrue(29 < ttl <= 60, ttl)
+            ttls.add(round(ttl, 3))
+        self.assertGreater(len(ttls), 1)
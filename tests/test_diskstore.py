@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from memoize.diskstore import DiskStore, INDEX_HEADER
+
+from .common import *
+
+
+def entry(value, expiry=None):
+    return (CURRENT_PROTOCOL_VERSION, time(), expiry, None, value)
+
+
+def _write_range(path, start, stop):
+    store = DiskStore(path, capacity=8)
+    for i in range(start, stop):
+        store['key%d' % i] = entry(i)
+
+
+class TestDiskStore(TestCase):
+
+    def setUp(self):
+        super(TestDiskStore, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_memoizer(self):
+        store = DiskStore(self.path)
+        memo = Memoizer(store)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertAlmostEqual(memo.ttl('key'), 1, 1)
+        memo.delete('key')
+        self.assertFalse(memo.exists('key'))
+        self.assertRaises(KeyError, store.__delitem__, 'key')
+
+    def test_meta(self):
+        store = DiskStore(self.path)
+        store['key'] = (CURRENT_PROTOCOL_VERSION, time(), None, 'etag', 'value')
+        self.assertEqual(store.meta('key')[ETAG_INDEX], 'etag')
+        self.assertIs(store.meta('key')[VALUE_INDEX], None)
+        self.assertIs(store.meta('nope'), None)
+
+    def test_persistence(self):
+        store = DiskStore(self.path, capacity=8)
+        for i in range(100):
+            store['key%d' % i] = entry(i)
+        store['key0'] = entry('new')
+        del store['key1']
+
+        store = DiskStore(self.path)
+        self.assertEqual(store['key0'][VALUE_INDEX], 'new')
+        self.assertEqual(store.get('key1'), None)
+        self.assertEqual([data[VALUE_INDEX] for data in store.get_many(['key2', 'key99', 'nope'])
+            if data], [2, 99])
+
+    def test_shared_between_processes(self):
+        reader = DiskStore(self.path, capacity=8)
+        procs = [multiprocessing.Process(target=_write_range, args=(self.path, i * 50, (i + 1) * 50))
+            for i in range(4)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        # The writers grew the index, which we notice without reopening.
+        for i in range(200):
+            self.assertEqual(reader['key%d' % i][VALUE_INDEX], i)
+
+    def test_compaction(self):
+        store = DiskStore(self.path)
+        other = DiskStore(self.path)
+        for i in range(10):
+            store['short%d' % i] = entry('x' * 100, time() + 1)
+            store['long%d' % i] = entry('y' * 100, time() + 100)
+            store['long%d' % i] = entry('z' * 100, time() + 100)
+        self.assertFalse(store.needs_compaction())
+
+        sleep(2)
+        self.assertTrue(store.needs_compaction())
+        size = os.path.getsize(os.path.join(self.path, 'log.0'))
+        store.compact()
+        self.assertFalse(store.needs_compaction())
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'log.0')))
+        self.assertLess(os.path.getsize(os.path.join(self.path, 'log.1')), size / 2)
+
+        # Other instances follow along.
+        self.assertEqual(other.get('short0'), None)
+        self.assertEqual(other['long0'][VALUE_INDEX], 'z' * 100)
+        other['new'] = entry('new')
+        self.assertEqual(store['new'][VALUE_INDEX], 'new')
+
+    def test_torn_write(self):
+        store = DiskStore(self.path)
+        store['a'] = entry(1)
+        store['b'] = entry(2)
+        log_path = os.path.join(self.path, 'log.0')
+        index_path = os.path.join(self.path, 'index.0')
+
+        # A crash midway through writing a record, before it was indexed.
+        size = os.path.getsize(log_path)
+        with open(log_path, 'ab') as fh:
+            fh.write(b'\0\0\0\0\0\0\0\0\0\0\0\1\0\0\1\0abc')
+        store = DiskStore(self.path)
+        self.assertEqual(os.path.getsize(log_path), size)
+        self.assertEqual(store['b'][VALUE_INDEX], 2)
+
+        # A record which was written, but not indexed.
+        with open(index_path, 'r+b') as fh:
+            header = list(INDEX_HEADER.unpack(fh.read(INDEX_HEADER.size)))
+            header[3] = 8
+            fh.seek(0)
+            fh.write(INDEX_HEADER.pack(*header))
+        store = DiskStore(self.path)
+        self.assertEqual(store['a'][VALUE_INDEX], 1)
+        self.assertEqual(store['b'][VALUE_INDEX], 2)
+        self.assertFalse(store.needs_compaction())
+
+        # A lost index.
+        os.unlink(index_path)
+        store = DiskStore(self.path)
+        self.assertEqual(store['a'][VALUE_INDEX], 1)
+        self.assertEqual(store['b'][VALUE_INDEX], 2)
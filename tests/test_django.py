@@ -1,9 +1,16 @@
+import shutil
+import tempfile
+
 import memoize.djangocache
+from memoize.core import VALUE_INDEX
 
 import django
 from django.test import TestCase
 from django.core.cache import caches
 
+from .common import time
+from .test_benchmarks import best_of, report
+
 
 class DjangoTest(TestCase):
     @classmethod
@@ -15,7 +22,15 @@ class DjangoTest(TestCase):
         """
         This is mandatory to spin up django
         """
+        cls.cache_dir = tempfile.mkdtemp()
         settings.configure(
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'files': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                    'LOCATION': cls.cache_dir,
+                },
+            },
             INSTALLED_APPS=[],
             DATABASES={
                 'default': {
@@ -26,6 +41,11 @@ class DjangoTest(TestCase):
         setup_test_environment()
         super(DjangoTest, cls).setUpClass()
 
+    @classmethod
+    def tearDownClass(cls):
+        super(DjangoTest, cls).tearDownClass()
+        shutil.rmtree(cls.cache_dir)
+
     def test_can_memoize_using_django_cache(self):
         cache = caches['default']
 
@@ -40,5 +60,101 @@ class DjangoTest(TestCase):
         r = memo.get('test', f, (1,), max_age=16)
 
         self.assertEqual(r, 1)
-        self.assertEqual(cache.get('test')[-1], 1)
+        self.assertEqual(cache.get('test')[VALUE_INDEX], 1)
         self.assertTrue(store.exists('test'))
+
+    def test_get_many(self):
+
+        store = memoize.djangocache.Cache('default')
+        memo = memoize.Memoizer(store, namespace='many')
+
+        memo.get('b', lambda: 'B')
+        values = memo.get_many(['a', 'b', 'c'], str, [(1, ), (), (3, )], max_age=16)
+        self.assertEqual(values, ['1', 'B', '3'])
+        self.assertEqual(store.get_many(['many:a', 'many:x'])[0][VALUE_INDEX], '1')
+        self.assertIs(store.get_many(['many:a', 'many:x'])[1], None)
+
+    def test_invalidate_namespace(self):
+
+        store = memoize.djangocache.Cache('default')
+        memo = memoize.Memoizer(store, namespace='versioned', versioned_namespace=True)
+        counter = iter(range(10))
+
+        self.assertEqual(memo.get('a', lambda: next(counter)), 0)
+        self.assertEqual(memo.get('a', lambda: next(counter)), 0)
+        memo.invalidate_namespace('versioned')
+        self.assertEqual(memo.get('a', lambda: next(counter)), 1)
+
+    def test_separate_meta(self):
+
+        store = memoize.djangocache.Cache('default', separate_meta=True)
+        memo = memoize.Memoizer(store)
+
+        self.assertEqual(memo.get('meta', lambda: 1, etag='a', max_age=16), 1)
+        self.assertIs(store.meta('meta')[VALUE_INDEX], None)
+        self.assertEqual(memo.etag('meta'), 'a')
+        self.assertEqual(memo.get('meta', lambda: 2, etag='b', max_age=16), 2)
+        memo.delete('meta')
+        self.assertIs(store.meta('meta'), None)
+
+    def test_item_protocol(self):
+
+        store = memoize.djangocache.Cache('default')
+        memo = memoize.Memoizer(store)
+
+        memo.get('item', lambda: 1)
+        self.assertEqual(store['item'][VALUE_INDEX], 1)
+        self.assertIn('item', store)
+        del store['item']
+        self.assertNotIn('item', store)
+        self.assertRaises(KeyError, store.__getitem__, 'item')
+        self.assertRaises(KeyError, store.__delitem__, 'item')
+
+    def test_timeouts(self):
+
+        cache = caches['default']
+        store = memoize.djangocache.Cache('default')
+        memo = memoize.Memoizer(store)
+
+        # Sub-second timeouts are rounded up, rather than down to "never store".
+        self.assertEqual(memo.get('short', lambda: 1, max_age=0.25), 1)
+        self.assertEqual(cache.get('short')[VALUE_INDEX], 1)
+
+        memo.expire('short', 30)
+        self.assertAlmostEqual(memo.ttl('short'), 30, 1)
+
+        # Django drops values which have expired.
+        memo.expire_at('short', time() - 1)
+        self.assertIs(cache.get('short'), None)
+        self.assertRaises(KeyError, store.expire_at, 'short', time() + 10)
+
+    def test_delete_many(self):
+
+        store = memoize.djangocache.Cache('default', separate_meta=True)
+        memo = memoize.Memoizer(store, namespace='deleting')
+
+        memo.get_many(['a', 'b', 'c'], str, [(1, ), (2, ), (3, )])
+        memo.delete_many(['a', 'b'])
+        self.assertEqual(memo.get_many(['a', 'b', 'c']), [None, None, '3'])
+        self.assertIs(store.meta('deleting:a'), None)
+
+    def test_backends(self):
+
+        for name in ('default', 'files'):
+
+            cache = caches[name]
+            store = memoize.djangocache.Cache(name)
+            memo = memoize.Memoizer(store)
+            value = list(range(100))
+
+            cache.set('raw', value)
+            memo.get('memo', lambda: value, max_age=60)
+
+            raw_time = best_of(lambda: cache.get('raw'), number=500, repeat=3)
+            report('get (Django %s)' % name, raw_time)
+            hit_time = best_of(lambda: memo.get('memo', list, max_age=60), number=500, repeat=3)
+            report('hit (Memoizer over Django %s)' % name, hit_time, raw_time)
+
+            self.assertEqual(memo.get('memo', list, max_age=60), value)
+            # The overhead of a hit is small next to the backend itself.
+            self.assertLess(hit_time, raw_time * 20)
@@ -0,0 +1,147 @@
+from unittest import skipIf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from memoize.func import compile_key
+from memoize.keys import canonical, compile_hashed_key, register_memokey
+
+from .common import *
+
+
+def zero():
+    pass
+
+def positional(a, b):
+    pass
+
+def defaults(a, b=2, c=3):
+    pass
+
+def varargs(*args, **kwargs):
+    pass
+
+
+class TestCompileKey(TestCase):
+
+    def test_zero_arg(self):
+        key = compile_key(zero)
+        self.assertEqual(key((), {}), __name__ + '.zero()')
+        self.assertEqual(key((1, ), {}), __name__ + '.zero(1)')
+
+    def test_positional(self):
+        key = compile_key(positional)
+        self.assertEqual(key((1, 2), {}), __name__ + '.positional(1, 2)')
+        self.assertEqual(key((1, ), {'b': 2}), __name__ + '.positional(1, 2)')
+        self.assertEqual(key((), {'b': 2, 'a': 1}), __name__ + '.positional(1, 2)')
+
+    def test_defaults(self):
+        key = compile_key(defaults)
+        self.assertEqual(key((1, ), {}), __name__ + '.defaults(1, 2, 3)')
+        self.assertEqual(key((1, 4), {}), __name__ + '.defaults(1, 4, 3)')
+        self.assertEqual(key((1, ), {'b': 5}), __name__ + '.defaults(1, 5, 3)')
+        self.assertEqual(key((1, 2, 3), {}), __name__ + '.defaults(1, 2, 3)')
+
+    def test_varargs(self):
+        key = compile_key(varargs)
+        self.assertEqual(key((1, 2), {}), __name__ + '.varargs(1, 2)')
+        self.assertEqual(key((1, ), {'x': 2}), __name__ + '.varargs(1, x=2)')
+
+    def test_master_key(self):
+        key = compile_key(positional, "'master'")
+        self.assertEqual(key((1, 2), {}), "'master':" + __name__ + '.positional(1, 2)')
+
+    def test_kwargs_not_mutated(self):
+        key = compile_key(defaults)
+        kwargs = {'b': 5, 'x': 6}
+        key((1, ), kwargs)
+        self.assertEqual(kwargs, {'b': 5, 'x': 6})
+
+    def test_uninspectable(self):
+        key = compile_key(len)
+        self.assertEqual(key(('abc', ), {}), 'builtins.len(\'abc\')')
+
+    def test_memokey(self):
+        key = compile_key(defaults)
+        self.assertEqual(key((Point(1, 2), ), {}),
+            __name__ + '.defaults(<%s.Point (1, 2)>, 2, 3)' % __name__)
+        self.assertEqual(key((1, ), {'b': Point(1, 2)}), key((1, Point(1, 2)), {}))
+        self.assertEqual(key((1, ), {'x': Point(3, 4)}),
+            __name__ + '.defaults(1, 2, 3, x=<%s.Point (3, 4)>)' % __name__)
+        self.assertNotEqual(key((Point(1, 2), ), {}), key((Point(2, 1), ), {}))
+        self.assertNotEqual(key((Point(1, 2), ), {}), key(((1, 2), ), {}))
+
+
+class Point(object):
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __memokey__(self):
+        return (self.x, self.y)
+
+
+class Opaque(object):
+    pass
+
+
+class TestHashedKey(TestCase):
+
+    def test_normalized(self):
+        key = compile_hashed_key(defaults)
+        self.assertEqual(key((1, ), {}), key((1, 2, 3), {}))
+        self.assertEqual(key((1, ), {'b': 2}), key((), {'a': 1, 'b': 2}))
+        self.assertNotEqual(key((1, ), {}), key((2, ), {}))
+        self.assertTrue(key((1, ), {}).startswith(__name__ + '.defaults:'))
+
+    def test_bounded(self):
+        key = compile_hashed_key(positional, "'master'")
+        self.assertTrue(key((list(range(100000)), 'x' * 100000), {}).startswith(
+            "'master':" + __name__ + '.positional:'))
+        self.assertEqual(len(key((list(range(100000)), 2), {})), len(key((1, 2), {})))
+
+    def test_canonical(self):
+        values = [None, True, 1, 1.0, '1', b'1', [1], (1, ), {1: 1}, set([1]), Point(1, 1)]
+        encodings = set(map(canonical, values))
+        self.assertEqual(len(encodings), len(values))
+
+        # Stable, regardless of insertion order.
+        a = dict((i, str(i)) for i in range(100))
+        b = dict((i, str(i)) for i in reversed(range(100)))
+        self.assertEqual(canonical(a), canonical(b))
+        self.assertEqual(canonical(set(range(100))), canonical(set(reversed(range(100)))))
+
+    def test_memokey(self):
+        self.assertEqual(canonical(Point(1, 2)), canonical(Point(1, 2)))
+        self.assertNotEqual(canonical(Point(1, 2)), canonical(Point(2, 1)))
+
+        register_memokey(Opaque, lambda obj: 'opaque')
+        self.assertEqual(canonical(Opaque()), canonical(Opaque()))
+
+    @skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        a = numpy.arange(12)
+        self.assertEqual(canonical(a), canonical(numpy.arange(12)))
+        self.assertNotEqual(canonical(a), canonical(a.astype('float64')))
+        self.assertNotEqual(canonical(a), canonical(a.reshape(3, 4)))
+        self.assertEqual(canonical(a.reshape(3, 4).T), canonical(a.reshape(3, 4).T.copy()))
+
+    def test_memoizer(self):
+
+        @self.memo(key_strategy='hash')
+        def func(rows):
+            return self.append_args(rows)
+
+        self.assertEqual(func([1, 2, 3]), 1)
+        self.assertEqual(func([1, 2, 3]), 1)
+        self.assertEqual(func([3, 2, 1]), 2)
+        key = func.key(([1, 2, 3], ))
+        self.assertIn(key, self.store)
+        self.assertEqual(len(key), len(__name__) + len('.func:') + 32)
+
+        # As a default for all functions.
+        memo = Memoizer({}, key_strategy='hash')
+        self.assertEqual(memo(positional).key((1, 2)), compile_hashed_key(positional)((1, 2), {}))
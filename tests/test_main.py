@@ -1,7 +1,11 @@
+import copy
 import functools
+import gc
 import sys
+import weakref
 
 from memoize.core import *
+from memoize.func import BoundMethod
 
 from .common import *
 
@@ -298,6 +302,90 @@ class TestMain(TestCase):
         assert b.append(1) == 1
 
 
+    def test_per_instance_methods(self):
+
+        store = {}
+        memo = Memoizer(store)
+
+        class A(object):
+
+            def __init__(self):
+                self.records = []
+
+            def __repr__(self):
+                return 'A()' # The same for every instance.
+
+            @memo(per_instance=True)
+            def append(self, *args, **kwargs):
+                self.records.append((args, kwargs))
+                return len(self.records)
+
+        a = A()
+        b = A()
+        self.assertIsNot(a.append, b.append)
+        self.assertEqual(a.append(1), 1)
+        self.assertEqual(a.append(1), 1)
+        self.assertTrue(a.append.exists((1, )))
+        self.assertEqual(b.append(1), 1)
+        self.assertEqual(len(store), 2)
+
+        # Nothing refers back to the instance, so it is freed straight away;
+        # its values are deleted on the next access.
+        ref = weakref.ref(a)
+        gc.disable()
+        try:
+            del a
+            self.assertIs(ref(), None)
+        finally:
+            gc.enable()
+        self.assertEqual(len(store), 2)
+        self.assertEqual(b.append(1), 1)
+        self.assertEqual(len(store), 1)
+
+        # Many temporary instances don't leave their values behind.
+        for i in range(100):
+            A().append(1)
+        b.append
+        self.assertEqual(len(store), 1)
+
+        # Copies have their own token.
+        for c in (copy.copy(b), copy.deepcopy(b)):
+            c.records = []
+            self.assertIs(c.append._instance, c)
+            self.assertEqual(c.append(1), 1)
+        self.assertEqual(b.append(1), 1)
+
+    def test_per_instance_memokey(self):
+
+        store = {}
+        memo = Memoizer(store)
+
+        class Account(object):
+
+            def __init__(self, id):
+                self.id = id
+
+            def __memokey__(self):
+                return self.id
+
+            @memo(per_instance=True)
+            def balance(self):
+                return len(store)
+
+        self.assertEqual(Account(1).balance(), 0)
+        self.assertEqual(Account(1).balance(), 0)
+        self.assertEqual(Account(2).balance(), 1)
+        self.assertIn(
+            'tests.test_main.balance(<tests.test_main.TestMain.test_per_instance_memokey.<locals>.Account 1>)',
+            store)
+
+        # The memokey is checked on every call, as it may change (e.g. when saved).
+        account = Account(None)
+        self.assertEqual(account.balance(), 2)
+        account.id = 3
+        self.assertEqual(account.balance(), 3)
+        self.assertTrue(account.balance.exists())
+
     @py3k_only
     def test_annotations(self):
 
@@ -324,3 +412,113 @@ def func(value: 'yyy') -> 'zzz':
 
 
 
+
+
+class TestRegionCache(TestCase):
+
+    def test_region_changes(self):
+
+        store = {}
+        memo = Memoizer(store, namespace='master')
+        memo.regions['a'] = dict(namespace='a')
+        memo.regions['b'] = dict(parent='a')
+
+        @memo(region='b')
+        def f():
+            return 1
+
+        f()
+        assert 'a:%s.f()' % __name__ in store
+
+        # Nested modification.
+        memo.regions['a']['namespace'] = 'a2'
+        f()
+        assert 'a2:%s.f()' % __name__ in store
+
+        # New regions.
+        memo.regions.update(b=dict(namespace='b'))
+        f()
+        assert 'b:%s.f()' % __name__ in store
+
+        # Replacing all regions.
+        memo.regions = dict(default=dict(store=store), b=dict(namespace='c'))
+        f()
+        assert 'c:%s.f()' % __name__ in store
+
+        del memo.regions['b']['namespace']
+        f()
+        assert '%s.f()' % __name__ in store
+
+    def test_later_region(self):
+
+        store = {}
+        memo = Memoizer(store)
+
+        # Regions may be defined after the functions which use them.
+        @memo(region='later')
+        def f(x):
+            return x
+
+        class A(object):
+            @memo(region='later')
+            def g(self):
+                return 2
+
+        memo.regions['later'] = dict(key_strategy='hash', per_instance=True)
+        self.assertEqual(f(1), 1)
+        self.assertEqual(A().g(), 2)
+        self.assertNotIn('%s.f(1)' % __name__, store)
+        self.assertIsInstance(A().g, BoundMethod)
+
+    def test_function_opt_changes(self):
+
+        store = {}
+        memo = Memoizer(store)
+
+        @memo
+        def f():
+            return 1
+
+        f()
+        assert store[f.key()][EXPIRY_INDEX] is None
+        f.delete()
+
+        f.max_age = 10
+        f()
+        assert store[f.key()][EXPIRY_INDEX] is not None
+        f.delete()
+
+        f.opts['namespace'] = 'ns'
+        f()
+        assert 'ns:' + f.key() in store
+
+    def test_call_opts(self):
+
+        store_a = {}
+        memo = Memoizer({})
+        memo.regions['a'] = dict(store=store_a)
+
+        @memo(namespace='ns')
+        def f():
+            return 1
+
+        f.get(region='a')
+        assert list(store_a) == ['ns:' + f.key()]
+        f.get(namespace='other', region='a')
+        assert 'other:' + f.key() in store_a
+
+    def test_resolved_opts_are_readonly(self):
+
+        memo = Memoizer({})
+
+        @memo(max_age=10)
+        def f():
+            return 1
+
+        view = f._resolved_opts()
+        assert view['max_age'] == 10
+        assert view['store'] is memo.regions['default']['store']
+        def modify():
+            view['max_age'] = 5
+        self.assertRaises(TypeError, modify)
+        assert f._resolved_opts() is view
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+from unittest import skipIf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from memoize.mmapstore import MmapStore
+
+from .common import *
+
+
+def entry(value, expiry=None):
+    return (CURRENT_PROTOCOL_VERSION, time(), expiry, None, value)
+
+
+class TestMmapStore(TestCase):
+
+    def setUp(self):
+        super(TestMmapStore, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.store = MmapStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_memoizer(self):
+        memo = Memoizer(self.store)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertAlmostEqual(memo.ttl('key'), 1, 1)
+        memo.delete('key')
+        self.assertFalse(memo.exists('key'))
+        self.assertRaises(KeyError, self.store.__delitem__, 'key')
+
+    def test_bytes_are_views(self):
+        self.store['key'] = entry(b'x' * 4096)
+        value = self.store.get('key')[VALUE_INDEX]
+        self.assertIsInstance(value, memoryview)
+        self.assertTrue(value.readonly)
+        self.assertEqual(value, b'x' * 4096)
+
+        # Views survive their file being replaced or removed.
+        self.store['key'] = entry(b'y' * 4096)
+        self.assertEqual(self.store.get('key')[VALUE_INDEX], b'y' * 4096)
+        del self.store['key']
+        self.assertEqual(value, b'x' * 4096)
+
+    @skipIf(numpy is None, 'numpy is not installed')
+    def test_array(self):
+        memo = Memoizer(self.store)
+        func = memo(lambda: numpy.arange(1000000))
+        self.assertEqual(func().sum(), 499999500000)
+        value = func()
+        self.assertEqual(value.sum(), 499999500000)
+        self.assertFalse(value.flags.writeable)
+
+    def test_expiry(self):
+        self.store['key'] = entry('value', time() + 1)
+        self.assertAlmostEqual(self.store.ttl('key'), 1, 1)
+        self.assertTrue('key' in self.store)
+        sleep(2)
+        self.store.purge()
+        self.assertFalse('key' in self.store)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(self.path)), 0)
@@ -1,4 +1,4 @@
-from memoize.options import OptionProperty
+from memoize.options import OptionProperty, RegionDict, VersionedDict
 
 from .common import *
 
@@ -56,3 +56,35 @@ class TestOptionProperty(TestCase):
 
 
 
+
+
+class TestVersionedDict(TestCase):
+
+    def test_versions(self):
+        x = VersionedDict(a=1)
+        versions = set([x.version])
+        def check():
+            assert x.version not in versions
+            versions.add(x.version)
+        x['b'] = 2
+        check()
+        del x['b']
+        check()
+        x.update(c=3)
+        check()
+        x.setdefault('d', 4)
+        check()
+        x.pop('d')
+        check()
+        x.popitem()
+        check()
+        x.clear()
+        check()
+        self.assertEqual(x, {})
+
+    def test_regions(self):
+        regions = RegionDict(default={'a': 1})
+        self.assertIsInstance(regions['default'], VersionedDict)
+        version = regions.version
+        regions['default']['a'] = 2
+        self.assertNotEqual(regions.version, version)
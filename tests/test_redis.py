@@ -0,0 +1,252 @@
+import os
+from unittest import skipIf
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import memoize.redis
+
+from .common import *
+
+
+# Set REDIS_URL to test against a real (and disposable!) database.
+REDIS_URL = os.environ.get('REDIS_URL')
+
+
+def make_redis():
+    if REDIS_URL:
+        import redis
+        db = redis.Redis.from_url(REDIS_URL)
+    else:
+        db = fakeredis.FakeRedis()
+    db.flushdb()
+    return db
+
+
+@skipIf(not (REDIS_URL or fakeredis), 'fakeredis is not installed')
+class TestRedisStore(TestCase):
+
+    def setUp(self):
+        super(TestRedisStore, self).setUp()
+        self.redis = make_redis()
+        self.store = memoize.redis.wrap(self.redis)
+        self.memo = Memoizer(self.store)
+
+    def test_get(self):
+        self.assertEqual(self.memo.get('key', self.append_args), 1)
+        self.assertEqual(self.memo.get('key', self.append_args), 1)
+        self.assertTrue(self.memo.exists('key'))
+        self.assertIs(self.memo.ttl('key'), None)
+        self.assertEqual(self.redis.pttl('key'), -1)
+
+    def test_native_expiry(self):
+        self.memo.get('key', self.append_args, max_age=10)
+        self.assertAlmostEqual(self.redis.pttl('key') / 1000.0, 10, 1)
+        self.assertAlmostEqual(self.memo.ttl('key'), 10, 1)
+
+        self.memo.expire('key', 5)
+        self.assertAlmostEqual(self.redis.pttl('key') / 1000.0, 5, 1)
+
+        # Already expired values are not stored at all.
+        self.memo.expire_at('key', time() - 1)
+        self.assertFalse(self.redis.exists('key'))
+
+    def test_sub_second(self):
+        self.memo.get('key', self.append_args, max_age=0.25)
+        pttl = self.redis.pttl('key')
+        self.assertTrue(200 < pttl <= 251, pttl)
+
+    def test_grace(self):
+        store = memoize.redis.Store(self.redis, grace=30)
+        memo = Memoizer(store)
+        memo.get('key', self.append_args, max_age=10)
+        self.assertAlmostEqual(self.redis.pttl('key') / 1000.0, 40, 1)
+        self.assertAlmostEqual(memo.ttl('key'), 10, 1)
+
+    def test_delete(self):
+        self.memo.get('key', self.append_args)
+        self.memo.delete('key')
+        self.assertFalse(self.redis.exists('key'))
+        self.assertRaises(KeyError, self.store.__delitem__, 'key')
+        self.assertRaises(KeyError, self.store.__getitem__, 'key')
+
+        self.memo.get('a', self.append_args)
+        self.memo.get('b', self.append_args)
+        self.memo.delete_many(['a', 'b', 'c'])
+        self.assertFalse(self.redis.exists('a', 'b'))
+
+    def test_bulk(self):
+        self.memo.get('b', lambda: 'B')
+        values = self.memo.get_many(['a', 'b', 'c'], str, [(1, ), (), (3, )], max_age=10)
+        self.assertEqual(values, ['1', 'B', '3'])
+        self.assertAlmostEqual(self.redis.pttl('c') / 1000.0, 10, 1)
+        self.assertEqual(self.memo.get_many(['a', 'x']), ['1', None])
+
+    def test_serializer(self):
+
+        import json
+
+        class JSON(object):
+            def dumps(self, data):
+                return json.dumps(data)
+            def loads(self, raw):
+                return tuple(json.loads(raw))
+
+        memo = Memoizer(memoize.redis.Store(self.redis, serializer=JSON()))
+        self.assertEqual(memo.get('key', lambda: [1, 2]), [1, 2])
+        self.assertEqual(json.loads(self.redis.get('key'))[VALUE_INDEX], [1, 2])
+        self.assertEqual(memo.get('key', lambda: None), [1, 2])
+
+    def test_envelope(self):
+        from memoize.codec import Envelope, read_header
+        memo = Memoizer(memoize.redis.Store(self.redis, serializer=Envelope()))
+        self.assertEqual(memo.get('key', lambda: [1, 2], max_age=10, etag='a'), [1, 2])
+        self.assertEqual(memo.get('key', lambda: None, max_age=10, etag='a'), [1, 2])
+        self.assertIsNotNone(read_header(self.redis.getrange('key', 0, 31)).expiry)
+
+    def test_meta(self):
+        from memoize.codec import Envelope
+        self.assertIs(self.store.meta, None)
+
+        store = memoize.redis.Store(self.redis, serializer=Envelope())
+        memo = Memoizer(store)
+        etag = 'e' * 200 # Longer than is read at first.
+        memo.get('key', lambda: b'x' * 10000, max_age=10, etag=etag)
+        data = store.meta('key')
+        self.assertEqual(data[ETAG_INDEX], etag)
+        self.assertIs(data[VALUE_INDEX], None)
+        self.assertIs(store.meta('nope'), None)
+        self.assertEqual(memo.etag('key'), etag)
+        self.assertEqual(memo.get('key', lambda: b'y', max_age=10, etag='new'), b'y')
+
+    def test_tags(self):
+        self.assertEqual(self.memo.get('key', self.append_args, tags=['x']), 1)
+        self.assertEqual(self.memo.get('key', self.append_args, tags=['x']), 1)
+        self.memo.invalidate_tag('x')
+        self.assertEqual(self.memo.get('key', self.append_args, tags=['x']), 2)
+        self.assertEqual(self.redis.pttl(TAG_PREFIX + 'x'), -1)
+
+    def test_cached_exception(self):
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                self.memo.get('key', {}.__getitem__, ('x', ), cache_exceptions=KeyError,
+                    negative_max_age=10)
+        self.assertTrue(0 < self.redis.pttl('key') <= 10000)
+
+    def test_lock(self):
+        lock = self.store.lock('key')
+        self.assertTrue(lock.acquire(1))
+        self.assertTrue(self.redis.exists('key.lock'))
+        lock.release()
+        self.assertFalse(self.redis.exists('key.lock'))
+
+
+@skipIf(not (REDIS_URL or fakeredis), 'fakeredis is not installed')
+class TestRedisLock(TestCase):
+
+    def setUp(self):
+        super(TestRedisLock, self).setUp()
+        self.redis = make_redis()
+
+    def test_exclusive(self):
+        a = memoize.redis.Lock(self.redis, 'key')
+        b = memoize.redis.Lock(self.redis, 'key')
+        self.assertTrue(a.acquire(0))
+        self.assertFalse(b.acquire(0))
+        self.assertAlmostEqual(self.redis.pttl('key') / 1000.0, 60, 0)
+        a.release()
+        self.assertFalse(self.redis.exists('key'))
+        self.assertTrue(b.acquire(0))
+
+    def test_release_checks_token(self):
+        a = memoize.redis.Lock(self.redis, 'key')
+        b = memoize.redis.Lock(self.redis, 'key')
+        self.assertTrue(a.acquire(0))
+
+        # Simulate the lock expiring and being taken by someone else.
+        self.redis.delete('key')
+        self.assertTrue(b.acquire(0))
+
+        a.release()
+        self.assertTrue(self.redis.exists('key'))
+        b.release()
+        self.assertFalse(self.redis.exists('key'))
+
+    def test_waiter_is_woken(self):
+
+        import threading
+        import time as real_time
+
+        a = memoize.redis.Lock(self.redis, 'key')
+        b = memoize.redis.Lock(self.redis, 'key', poll_interval=30)
+        self.assertTrue(a.acquire(0))
+
+        results = []
+        def wait():
+            start = real_time.time()
+            results.append(b.acquire(10))
+            results.append(real_time.time() - start)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        real_time.sleep(0.1)
+        a.release()
+        thread.join(10)
+
+        self.assertTrue(results[0])
+        self.assertLess(results[1], 1)
+
+    def test_waiter_sees_expiry(self):
+        a = memoize.redis.Lock(self.redis, 'key', expires=0.1)
+        b = memoize.redis.Lock(self.redis, 'key', poll_interval=30)
+        self.assertTrue(a.acquire(0))
+        self.assertTrue(b.acquire(5))
+
+    def test_timeout(self):
+        a = memoize.redis.Lock(self.redis, 'key')
+        b = memoize.redis.Lock(self.redis, 'key', poll_interval=0.05)
+        self.assertTrue(a.acquire(0))
+        self.assertFalse(b.acquire(0.1))
+
+
+@skipIf(not (REDIS_URL or fakeredis), 'fakeredis is not installed')
+class TestRedisInvalidator(TestCase):
+
+    def test_fan_out(self):
+
+        import time as real_time
+        from memoize.stores import TieredStore
+
+        redis = make_redis()
+        remote = memoize.redis.Store(redis)
+
+        a_invalidator = memoize.redis.Invalidator(redis)
+        b_invalidator = memoize.redis.Invalidator(redis)
+        a = TieredStore({}, remote, invalidator=a_invalidator)
+        b = TieredStore({}, remote, invalidator=b_invalidator)
+        try:
+
+            memo_a = Memoizer(a)
+            memo_b = Memoizer(b)
+            memo_a.get('key', lambda: 1)
+            self.assertEqual(memo_b.get('key', lambda: 2), 1)
+            self.assertIn('key', b.local)
+            self.assertIn('key', a.local)
+
+            memo_a.delete('key')
+            for _ in range(100):
+                if 'key' not in b.local:
+                    break
+                real_time.sleep(0.01)
+            self.assertNotIn('key', b.local)
+            self.assertEqual(memo_b.get('key', lambda: 2), 2)
+
+            # Our own messages do not drop our local copy.
+            real_time.sleep(0.2)
+            self.assertIn('key', b.local)
+
+        finally:
+            a_invalidator.close()
+            b_invalidator.close()
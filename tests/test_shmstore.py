@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+from unittest import skipIf
+
+from memoize.shmstore import SharedMemoryStore
+
+from .common import *
+
+
+def entry(value, expiry=None):
+    return (CURRENT_PROTOCOL_VERSION, time(), expiry, None, value)
+
+
+def _call(func, queue):
+    queue.put(func())
+
+
+@skipIf(not hasattr(os, 'fork'), 'requires fork')
+class TestSharedMemoryStore(TestCase):
+
+    def test_memoizer(self):
+        store = SharedMemoryStore(entries=16)
+        memo = Memoizer(store)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertAlmostEqual(memo.ttl('key'), 1, 1)
+        memo.delete('key')
+        self.assertFalse(memo.exists('key'))
+        self.assertRaises(KeyError, store.__delitem__, 'key')
+
+    def test_nested_calls(self):
+
+        # Every key shares the one lock.
+        memo = Memoizer(SharedMemoryStore(entries=16, lock_stripes=1), timeout=5)
+        events = []
+        memo.add_hook(lambda event, *args: events.append(event))
+
+        @memo
+        def inner(x):
+            return x * 2
+
+        @memo
+        def outer(x):
+            return inner(x) + 1
+
+        self.assertEqual(outer(1), 3)
+        self.assertEqual(events.count('lock_wait'), 2)
+        self.assertNotIn('lock_timeout', events)
+
+    def test_shared_with_forks(self):
+
+        context = multiprocessing.get_context('fork')
+        store = SharedMemoryStore(entries=16, context=context)
+        memo = Memoizer(store)
+        calls = context.Value('i', 0)
+
+        @memo
+        def slow():
+            with calls.get_lock():
+                calls.value += 1
+            sleep(0.1)
+            return os.getpid()
+
+        queue = context.Queue()
+        procs = [context.Process(target=_call, args=(slow, queue)) for _ in range(4)]
+        for proc in procs:
+            proc.start()
+        results = [queue.get(timeout=10) for _ in procs]
+        for proc in procs:
+            proc.join()
+
+        # One of them calculated it, and the rest (and we) got its value.
+        self.assertEqual(calls.value, 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(slow(), results[0])
+
+    def test_lru(self):
+        store = SharedMemoryStore(entries=4, ways=4)
+        for i in range(4):
+            store['key%d' % i] = entry(i)
+            sleep(0.01)
+        store.get('key0')
+        store['key4'] = entry(4)
+        self.assertEqual(store.evictions, 1)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.get('key1'), None)
+        self.assertEqual(store['key0'][VALUE_INDEX], 0)
+
+        # Expired entries go first, and aren't counted.
+        store['key2'] = entry(2, time() - 1)
+        store['key5'] = entry(5)
+        self.assertEqual(store.evictions, 1)
+        self.assertEqual(store.get('key2'), None)
+
+        store.clear()
+        self.assertEqual(len(store), 0)
+
+    def test_too_big(self):
+        store = SharedMemoryStore(entries=4, slot_size=256)
+        store['key'] = entry('small')
+        store['key'] = entry('x' * 1000)
+        self.assertEqual(store.get('key'), None)
@@ -0,0 +1,85 @@
+from .common import *
+
+
+class TestStats(TestCase):
+
+    def test_hooks(self):
+
+        events = []
+        def hook(event, region, namespace, duration):
+            events.append((event, region, namespace, duration is not None))
+
+        self.memo.regions['short'] = dict(max_age=1, namespace='s')
+        self.memo.add_hook(hook)
+
+        self.memo.get('key', self.append_args)
+        self.memo.get('key', self.append_args)
+        self.memo.get('key', self.append_args, region='short')
+        sleep(2)
+        self.memo.get('key', self.append_args, region='short')
+
+        self.assertEqual(events, [
+            ('miss', 'default', None, False),
+            ('compute', 'default', None, True),
+            ('hit', 'default', None, False),
+            ('miss', 'short', 's', False),
+            ('compute', 'short', 's', True),
+            ('expired', 'short', 's', False),
+            ('compute', 'short', 's', True),
+        ])
+
+        self.memo.remove_hook(hook)
+        self.memo.get('key', self.append_args)
+        self.assertEqual(len(events), 7)
+
+    def test_locks_and_errors(self):
+
+        class Lock(object):
+            def __init__(self, key):
+                pass
+            def acquire(self, timeout):
+                return timeout > 1
+            def release(self):
+                pass
+
+        events = []
+        self.memo.add_hook(lambda event, *args: events.append(event))
+
+        self.memo.get('a', self.append_args, lock=Lock)
+        self.memo.get('b', self.append_args, lock=Lock, timeout=0)
+
+        def fails():
+            raise ValueError('nope')
+        self.assertRaises(ValueError, self.memo.get, 'c', fails)
+
+        self.assertEqual(events, [
+            'miss', 'lock_wait', 'compute',
+            'miss', 'lock_timeout', 'compute',
+            'miss', 'error',
+        ])
+
+    def test_snapshot(self):
+
+        self.assertEqual(self.memo.stats(), {})
+        stats = self.memo.enable_stats()
+        self.assertIs(self.memo.enable_stats(), stats)
+
+        for i in range(3):
+            self.memo.get('key', self.append_args)
+        self.memo.get('key', self.append_args, namespace='ns')
+
+        snapshot = self.memo.stats()
+        default = snapshot[('default', None)]
+        self.assertEqual(default['counts'], dict(miss=1, compute=1, hit=2))
+        self.assertAlmostEqual(default['hit_ratio'], 2.0 / 3)
+        self.assertEqual(default['timings']['compute']['count'], 1)
+        self.assertEqual(sum(default['timings']['compute']['buckets'].values()), 1)
+        self.assertEqual(snapshot[('default', 'ns')]['counts'], dict(miss=1, compute=1))
+
+        stats.reset()
+        self.assertEqual(self.memo.stats(), {})
+
+        self.memo.disable_stats()
+        self.memo.get('key', self.append_args)
+        self.assertEqual(self.memo.stats(), {})
+        self.assertEqual(self.memo._hooks, [])
@@ -0,0 +1,236 @@
+import threading
+
+from memoize.stores import MemoryStore, TieredStore
+
+from .common import *
+
+
+def entry(value, expiry=None):
+    return (CURRENT_PROTOCOL_VERSION, time(), expiry, None, value)
+
+
+class TestMemoryStore(TestCase):
+
+    def test_memoizer(self):
+        store = MemoryStore()
+        memo = Memoizer(store)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertAlmostEqual(memo.ttl('key'), 1, 2)
+        memo.delete('key')
+        self.assertFalse(memo.exists('key'))
+        self.assertEqual(memo.get('key', self.append_args), 2)
+
+    def test_item_protocol(self):
+        store = MemoryStore()
+        self.assertIs(store.get('key'), None)
+        self.assertRaises(KeyError, lambda: store['key'])
+        store['key'] = data = entry(1)
+        self.assertIs(store['key'], data)
+        self.assertIn('key', store)
+        del store['key']
+        self.assertNotIn('key', store)
+        self.assertRaises(KeyError, store.__delitem__, 'key')
+
+    def test_lru_entries(self):
+        store = MemoryStore(max_entries=3, shards=1)
+        for key in 'abc':
+            store[key] = entry(key)
+        store.get('a')
+        store['d'] = entry('d')
+        self.assertEqual(sorted(store.keys()), ['a', 'c', 'd'])
+        self.assertEqual(store.evictions, 1)
+
+    def test_max_bytes(self):
+        store = MemoryStore(max_bytes=100, shards=1, sizeof=lambda data: data[VALUE_INDEX])
+        store['a'] = entry(40)
+        store['b'] = entry(40)
+        self.assertEqual(store.bytes, 80)
+        store['c'] = entry(40)
+        self.assertEqual(sorted(store.keys()), ['b', 'c'])
+        self.assertEqual(store.bytes, 80)
+
+        # Too big to ever fit.
+        store['d'] = entry(101)
+        self.assertNotIn('d', store)
+        self.assertEqual(store.bytes, 80)
+
+    def test_expired_first(self):
+        store = MemoryStore(max_entries=3, shards=1)
+        store['a'] = entry('a')
+        store['b'] = entry('b', time() + 1)
+        store['c'] = entry('c')
+        sleep(2)
+        store['d'] = entry('d')
+        self.assertEqual(sorted(store.keys()), ['a', 'c', 'd'])
+        self.assertEqual(store.evictions, 0)
+
+    def test_purge(self):
+        store = MemoryStore()
+        store['a'] = entry('a', time() + 1)
+        store['b'] = entry('b', time() + 10)
+        sleep(2)
+        store.purge()
+        self.assertEqual(store.keys(), ['b'])
+        self.assertIs(store.ttl('a'), None)
+        self.assertAlmostEqual(store.ttl('b'), 8, 2)
+
+    def test_grace(self):
+        store = MemoryStore(grace=5)
+        store['a'] = entry('a', time() + 1)
+        sleep(2)
+        self.assertIsNotNone(store.get('a'))
+        sleep(5)
+        self.assertIsNone(store.get('a'))
+
+    def test_tinylfu(self):
+        store = MemoryStore(max_entries=2, shards=1, policy='tinylfu')
+        store['a'] = entry('a')
+        store['b'] = entry('b')
+        for _ in range(5):
+            store.get('a')
+            store.get('b')
+
+        # A one-hit wonder does not displace popular entries.
+        store['c'] = entry('c')
+        self.assertEqual(sorted(store.keys()), ['a', 'b'])
+
+        # But a popular one does.
+        for _ in range(10):
+            store.get('d')
+        store['d'] = entry('d')
+        self.assertEqual(sorted(store.keys()), ['b', 'd'])
+
+        # Only lookups are counted, so a miss and then a fill count once.
+        sketch = store._shards[0].sketch
+        store.get('e')
+        store['e'] = entry('e')
+        self.assertEqual(sketch.frequency('e'), 1)
+
+    def test_tinylfu_update(self):
+        store = MemoryStore(max_bytes=10, shards=1, policy='tinylfu',
+            sizeof=lambda data: len(data[VALUE_INDEX]))
+        store['a'] = entry('a' * 4)
+        store['b'] = entry('b' * 4)
+        for _ in range(5):
+            store.get('b')
+        store.get('a')
+
+        # Updates are not refused, even if they need a more popular entry evicted.
+        store['a'] = entry('a' * 7)
+        self.assertEqual(store['a'][VALUE_INDEX], 'a' * 7)
+        self.assertEqual(store.keys(), ['a'])
+
+    def test_lock(self):
+        store = MemoryStore()
+        lock = store.lock('key')
+        other = store.lock('key')
+        self.assertTrue(lock.acquire(1))
+        self.assertFalse(other.acquire(0))
+        self.assertTrue(store.lock('another').acquire(0))
+        lock.release()
+        self.assertTrue(other.acquire(0))
+        other.release()
+        self.assertEqual(store._key_locks, {'another': store._key_locks['another']})
+
+    def test_threads(self):
+        store = MemoryStore(max_entries=64, shards=4)
+        memo = Memoizer(store)
+
+        def worker(offset):
+            for i in range(200):
+                memo.get(str((i + offset) % 100), str, (i, ))
+
+        threads = [threading.Thread(target=worker, args=(i, )) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(len(store), 64)
+
+
+class TestTieredStore(TestCase):
+
+    def setUp(self):
+        super(TestTieredStore, self).setUp()
+        self.local = {}
+        self.remote = {}
+        self.store = TieredStore(self.local, self.remote)
+        self.memo = Memoizer(self.store)
+
+    def test_populates_local(self):
+        self.remote['key'] = entry(1)
+        self.assertEqual(self.memo.get('key'), 1)
+        self.assertEqual(self.local['key'][VALUE_INDEX], self.remote['key'])
+
+        # Served locally.
+        del self.remote['key']
+        self.assertEqual(self.memo.get('key'), 1)
+
+    def test_writes_both(self):
+        self.assertEqual(self.memo.get('key', self.append_args, max_age=5), 1)
+        self.assertEqual(self.remote['key'][VALUE_INDEX], 1)
+        self.assertEqual(self.local['key'][VALUE_INDEX][VALUE_INDEX], 1)
+        self.memo.delete('key')
+        self.assertEqual(self.local, {})
+        self.assertEqual(self.remote, {})
+
+    def test_expiry(self):
+        self.memo.get('key', self.append_args, max_age=1)
+        sleep(2)
+        self.assertEqual(self.memo.get('key', self.append_args, max_age=1), 2)
+        self.assertAlmostEqual(self.memo.ttl('key'), 1, 2)
+
+    def test_local_max_age(self):
+        store = TieredStore(self.local, self.remote, local_max_age=1)
+        self.remote['key'] = entry(1)
+        self.assertEqual(store.get('key')[VALUE_INDEX], 1)
+        self.remote['key'] = entry(2)
+        self.assertEqual(store.get('key')[VALUE_INDEX], 1)
+        sleep(2)
+        self.assertEqual(store.get('key')[VALUE_INDEX], 2)
+
+    def test_get_many(self):
+        self.remote['a'] = entry('a')
+        self.memo.get('b', lambda: 'b')
+        self.assertEqual(self.memo.get_many(['a', 'b', 'c']), ['a', 'b', None])
+        self.assertIn('a', self.local)
+
+    def test_with_memory_store(self):
+        store = TieredStore(MemoryStore(max_entries=10), self.remote)
+        memo = Memoizer(store)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertEqual(memo.get('key', self.append_args, max_age=1), 1)
+        self.assertTrue(store.lock('key').acquire(0))
+
+    def test_invalidation(self):
+
+        class Invalidator(object):
+            def __init__(self):
+                self.callbacks = []
+                self.published = []
+            def subscribe(self, callback):
+                self.callbacks.append(callback)
+            def publish(self, key):
+                self.published.append(key)
+                for callback in self.callbacks:
+                    callback(key)
+
+        invalidator = Invalidator()
+        peer_local = {}
+        peer = TieredStore(peer_local, self.remote)
+        invalidator.subscribe(peer.invalidate_local)
+        store = TieredStore(self.local, self.remote, invalidator=invalidator)
+        memo = Memoizer(store)
+
+        memo.get('key', self.append_args)
+        self.assertEqual(peer.get('key')[VALUE_INDEX], 1)
+        self.assertIn('key', peer_local)
+
+        memo.expire('key', 10)
+        self.assertNotIn('key', peer_local)
+        peer.get('key')
+        memo.delete('key')
+        self.assertNotIn('key', peer_local)
+        self.assertEqual(invalidator.published, ['key', 'key', 'key'])